@@ -4,313 +4,233 @@ Args: event - dict with httpMethod, body, queryStringParameters
       context - object with attributes: request_id, function_name
 Returns: HTTP response dict with admin data or error
 '''
-import json
-import os
-import psycopg2
-import hashlib
-import hmac
-import base64
-import time
-from typing import Dict, Any, Optional
+from typing import Dict, Any, List, Optional
+from metrics import instrument, timed
+from activity import rollup
+from jwt_keys import decode_jwt
+from db import get_db_connection, shard_connection, fan_out, release, record_write, statement, execute
+from router import Router, Request, HTTPError, respond, error
+import reads
+from reads import SELECT_ROLE, inactive_since, serve
+import last_seen
+from sessions import is_legacy_token, is_revoked, revoke_user_sessions, note_revoked
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url)
+COUNT_STALE = statement('admin_count_stale', "SELECT COUNT(*) FROM users WHERE COALESCE(last_seen_at, created_at) < %s AND is_active = TRUE AND role <> 'admin'")
+DISABLE_STALE = statement('admin_disable_stale', """
+    UPDATE users SET is_active = FALSE, updated_at = CURRENT_TIMESTAMP
+    WHERE id IN (
+        SELECT id FROM users WHERE COALESCE(last_seen_at, created_at) < %s AND is_active = TRUE AND role <> 'admin'
+        ORDER BY id LIMIT %s
+    )
+    RETURNING id
+""")
+UPDATE_ROLE = statement('admin_update_role', "UPDATE users SET role = %s WHERE id = %s RETURNING id, email, role")
+UPDATE_STATUS = statement('admin_update_status', "UPDATE users SET is_active = %s WHERE id = %s RETURNING id, email, is_active")
 
+# Stale-account cleanup disables at most this many users per shard and call, and never users seen more recently.
+STALE_DISABLE_LIMIT = 1000
+STALE_MIN_DAYS = 30
+
+@timed('jwt_verify')
 def verify_jwt(token: str) -> Optional[Dict[str, Any]]:
-    secret = os.environ.get('JWT_SECRET_KEY', 'default_secret_key')
+    return decode_jwt(token)
+
+def is_admin(user_id: int) -> bool:
+    conn = shard_connection(user_id)
+    cur = conn.cursor()
     
-    parts = token.split('.')
-    if len(parts) != 3:
-        return None
+    execute(cur, SELECT_ROLE, (user_id,))
+    user = cur.fetchone()
+    cur.close()
+    release(conn)
     
-    header, payload, signature = parts
+    return user and user[0] == 'admin'
+
+def target_user(body_data: Dict[str, Any]) -> int:
+    try:
+        return int(body_data.get('user_id') or 0)
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'User ID must be a number')
+
+def authenticate(request: Request) -> Dict[str, Any]:
+    auth_header = request.header('x-auth-token')
     
-    expected_signature = base64.urlsafe_b64encode(
-        hmac.new(
-            secret.encode(),
-            f"{header}.{payload}".encode(),
-            hashlib.sha256
-        ).digest()
-    ).decode().rstrip('=')
+    if not auth_header:
+        raise HTTPError(401, 'No token provided')
     
-    if signature != expected_signature:
-        return None
+    payload = verify_jwt(auth_header)
+    if not payload or not ('sid' in payload or is_legacy_token(payload)):
+        raise HTTPError(401, 'Invalid token')
     
-    padding = '=' * (4 - len(payload) % 4)
-    decoded_payload = json.loads(base64.urlsafe_b64decode(payload + padding))
+    if 'sid' in payload and is_revoked(payload['sid']):
+        raise HTTPError(401, 'Session revoked')
     
-    if decoded_payload.get('exp', 0) < time.time():
-        return None
+    if not is_admin(payload['user_id']):
+        raise HTTPError(403, 'Admin access required')
     
-    return decoded_payload
+    last_seen.seen(payload['user_id'])
+    return payload
 
-def is_admin(user_id: int) -> bool:
-    conn = get_db_connection()
-    cur = conn.cursor()
+router = Router('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, X-Auth-Token, X-Min-LSN', authenticate, finish=last_seen.flush_due)
+
+@router.route('GET', 'users', auth=True)
+def list_users(request: Request) -> Dict[str, Any]:
+    return serve(reads.users, request)
+
+@router.route('PUT', 'user-role', auth=True)
+def update_user_role(request: Request) -> Dict[str, Any]:
+    body_data = request.body
+    target_user_id = target_user(body_data)
+    new_role = body_data.get('role', 'user')
     
-    cur.execute("SELECT role FROM users WHERE id = %s", (user_id,))
-    user = cur.fetchone()
-    cur.close()
-    conn.close()
+    if not target_user_id:
+        return error(400, 'User ID required')
     
-    return user and user[0] == 'admin'
-
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method: str = event.get('httpMethod', 'GET')
+    if new_role not in ['user', 'admin', 'moderator']:
+        return error(400, 'Invalid role')
     
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+    conn = shard_connection(target_user_id)
+    cur = conn.cursor()
     
-    path = event.get('queryStringParameters', {}).get('action', '')
-    auth_header = event.get('headers', {}).get('x-auth-token', '')
+    execute(cur, UPDATE_ROLE, (new_role, target_user_id))
+    updated_user = cur.fetchone()
+    conn.commit()
+    consistency = record_write(conn, target_user_id)
+    cur.close()
+    release(conn)
     
-    if not auth_header:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'No token provided'})
-        }
+    if not updated_user:
+        return error(404, 'User not found')
     
-    payload = verify_jwt(auth_header)
-    if not payload:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid token'})
+    return respond(200, {
+        'message': 'Role updated',
+        'user': {
+            'id': updated_user[0],
+            'email': updated_user[1],
+            'role': updated_user[2]
         }
+    }, consistency)
+
+@router.route('PUT', 'user-status', auth=True)
+def update_user_status(request: Request) -> Dict[str, Any]:
+    body_data = request.body
+    target_user_id = target_user(body_data)
+    is_active = body_data.get('is_active', True)
     
-    user_id = payload['user_id']
+    if not target_user_id:
+        return error(400, 'User ID required')
     
-    if not is_admin(user_id):
-        return {
-            'statusCode': 403,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Admin access required'})
-        }
+    conn = get_db_connection()
+    cur = conn.cursor()
+    user_conn = shard_connection(target_user_id, conn)
+    user_cur = user_conn.cursor()
+    
+    execute(user_cur, UPDATE_STATUS, (is_active, target_user_id))
+    updated_user = user_cur.fetchone()
+    user_conn.commit()
+    consistency = record_write(user_conn, target_user_id)
+    user_cur.close()
+    if user_conn is not conn:
+        release(user_conn)
+    
+    # A disabled user's access tokens stop working within one revocation reload,
+    # and the refresh tokens behind them are dead immediately. Sessions live in
+    # DATABASE_URL; the user is already disabled there when this commits.
+    revoked = revoke_user_sessions(cur, target_user_id, 'user_disabled') if updated_user and not is_active else ()
+    conn.commit()
+    cur.close()
+    release(conn)
     
-    if method == 'GET' and path == 'users':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        page = int(event.get('queryStringParameters', {}).get('page', '1'))
-        limit = 20
-        offset = (page - 1) * limit
-        
-        cur.execute(
-            "SELECT id, email, first_name, last_name, role, is_active, two_factor_enabled, created_at FROM users ORDER BY created_at DESC LIMIT %s OFFSET %s",
-            (limit, offset)
-        )
-        users = cur.fetchall()
-        
-        cur.execute("SELECT COUNT(*) FROM users")
-        total_count = cur.fetchone()[0]
-        
-        cur.close()
-        conn.close()
-        
-        users_list = []
-        for user in users:
-            users_list.append({
-                'id': user[0],
-                'email': user[1],
-                'first_name': user[2],
-                'last_name': user[3],
-                'role': user[4],
-                'is_active': user[5],
-                'two_factor_enabled': user[6],
-                'created_at': user[7].isoformat() if user[7] else None
-            })
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'users': users_list,
-                'total': total_count,
-                'page': page,
-                'pages': (total_count + limit - 1) // limit
-            })
-        }
+    if not updated_user:
+        return error(404, 'User not found')
     
-    if method == 'PUT' and path == 'user-role':
-        body_data = json.loads(event.get('body', '{}'))
-        target_user_id = body_data.get('user_id')
-        new_role = body_data.get('role', 'user')
-        
-        if not target_user_id:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'User ID required'})
-            }
-        
-        if new_role not in ['user', 'admin', 'moderator']:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid role'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "UPDATE users SET role = %s WHERE id = %s RETURNING id, email, role",
-            (new_role, target_user_id)
-        )
-        updated_user = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        if not updated_user:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'User not found'})
-            }
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'message': 'Role updated',
-                'user': {
-                    'id': updated_user[0],
-                    'email': updated_user[1],
-                    'role': updated_user[2]
-                }
-            })
-        }
+    note_revoked(revoked)
     
-    if method == 'PUT' and path == 'user-status':
-        body_data = json.loads(event.get('body', '{}'))
-        target_user_id = body_data.get('user_id')
-        is_active = body_data.get('is_active', True)
-        
-        if not target_user_id:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'User ID required'})
-            }
-        
-        conn = get_db_connection()
+    return respond(200, {
+        'message': 'User status updated',
+        'user': {
+            'id': updated_user[0],
+            'email': updated_user[1],
+            'is_active': updated_user[2]
+        }
+    }, consistency)
+
+@router.route('POST', 'disable-stale', auth=True)
+def disable_stale(request: Request) -> Dict[str, Any]:
+    '''
+    Disables active non-admin users not seen for body.days (at least
+    STALE_MIN_DAYS) and revokes their sessions; with dry_run only counts them.
+    "more" is true when a shard hit STALE_DISABLE_LIMIT and another call is due.
+    '''
+    body_data = request.body
+    days = body_data.get('days')
+    if not isinstance(days, int) or days < STALE_MIN_DAYS:
+        return error(400, f'days must be a number of at least {STALE_MIN_DAYS}')
+    cutoff = inactive_since(days)
+    
+    if body_data.get('dry_run'):
+        def count(conn: Any) -> int:
+            cur = conn.cursor()
+            execute(cur, COUNT_STALE, (cutoff,))
+            stale = cur.fetchone()[0]
+            cur.close()
+            return stale
+        
+        return respond(200, {'cutoff': cutoff.isoformat(), 'stale': sum(fan_out(count, min_lsn=request.header('x-min-lsn')))})
+    
+    def disable(conn: Any) -> List[int]:
         cur = conn.cursor()
-        
-        cur.execute(
-            "UPDATE users SET is_active = %s WHERE id = %s RETURNING id, email, is_active",
-            (is_active, target_user_id)
-        )
-        updated_user = cur.fetchone()
+        execute(cur, DISABLE_STALE, (cutoff, STALE_DISABLE_LIMIT))
+        user_ids = [row[0] for row in cur.fetchall()]
         conn.commit()
         cur.close()
-        conn.close()
-        
-        if not updated_user:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'User not found'})
-            }
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'message': 'User status updated',
-                'user': {
-                    'id': updated_user[0],
-                    'email': updated_user[1],
-                    'is_active': updated_user[2]
-                }
-            })
-        }
+        return user_ids
     
-    if method == 'GET' and path == 'activity-log':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        page = int(event.get('queryStringParameters', {}).get('page', '1'))
-        limit = 50
-        offset = (page - 1) * limit
-        
-        cur.execute(
-            "SELECT al.id, al.user_id, u.email, al.action, al.ip_address, al.created_at FROM user_activity_log al LEFT JOIN users u ON al.user_id = u.id ORDER BY al.created_at DESC LIMIT %s OFFSET %s",
-            (limit, offset)
-        )
-        logs = cur.fetchall()
-        
-        cur.execute("SELECT COUNT(*) FROM user_activity_log")
-        total_count = cur.fetchone()[0]
-        
-        cur.close()
-        conn.close()
-        
-        logs_list = []
-        for log in logs:
-            logs_list.append({
-                'id': log[0],
-                'user_id': log[1],
-                'email': log[2],
-                'action': log[3],
-                'ip_address': log[4],
-                'created_at': log[5].isoformat() if log[5] else None
-            })
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'logs': logs_list,
-                'total': total_count,
-                'page': page,
-                'pages': (total_count + limit - 1) // limit
-            })
-        }
+    disabled = fan_out(disable, write=True)
     
-    if method == 'GET' and path == 'stats':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("SELECT COUNT(*) FROM users")
-        total_users = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM users WHERE role = 'admin'")
-        admin_count = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM users WHERE two_factor_enabled = TRUE")
-        two_factor_count = cur.fetchone()[0]
-        
-        cur.execute("SELECT COUNT(*) FROM users WHERE is_active = TRUE")
-        active_users = cur.fetchone()[0]
-        
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'total_users': total_users,
-                'admin_count': admin_count,
-                'two_factor_enabled_count': two_factor_count,
-                'active_users': active_users
-            })
-        }
-    
-    return {
-        'statusCode': 404,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Endpoint not found'})
-    }
\ No newline at end of file
+    # As in user-status: sessions live in DATABASE_URL and are revoked once the users are disabled.
+    conn = get_db_connection()
+    cur = conn.cursor()
+    revoked: List[int] = []
+    for user_ids in disabled:
+        for user_id in user_ids:
+            revoked.extend(revoke_user_sessions(cur, user_id, 'user_stale'))
+    conn.commit()
+    cur.close()
+    release(conn)
+    note_revoked(revoked)
+    
+    return respond(200, {
+        'cutoff': cutoff.isoformat(),
+        'disabled': sum(len(user_ids) for user_ids in disabled),
+        'more': any(len(user_ids) == STALE_DISABLE_LIMIT for user_ids in disabled)
+    })
+
+@router.route('GET', 'activity-log', auth=True)
+def activity_log(request: Request) -> Dict[str, Any]:
+    return serve(reads.activity_log, request)
+
+@router.route('GET', 'stats', auth=True)
+def stats(request: Request) -> Dict[str, Any]:
+    return serve(reads.stats, request)
+
+@router.route('GET', 'timeseries', auth=True)
+def timeseries(request: Request) -> Dict[str, Any]:
+    return serve(reads.timeseries, request)
+
+@router.route('POST', 'rollup', auth=True)
+def run_rollup(request: Request) -> Dict[str, Any]:
+    results = fan_out(rollup, write=True)
+    if len(results) == 1:
+        return respond(200, results[0])
+    
+    watermarks = [result['last_created_at'] for result in results]
+    return respond(200, {
+        'batches': sum(result['batches'] for result in results),
+        'last_created_at': None if None in watermarks else min(watermarks),
+        'shards': results
+    })
+
+@instrument
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return router.dispatch(event, context)
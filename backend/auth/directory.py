@@ -0,0 +1,63 @@
+'''
+The user directory shared by the auth and oauth functions (each function
+directory carries its own copy because functions are deployed independently).
+
+user_directory in DATABASE_URL maps every email to its global user id and
+hands out the ids, so a user can be written to its home shard (db.shard_for)
+with an id that is unique across shards. It is the only place where emails are
+unique across shards: registration claims the email here first and commits
+before the users row is written, and login and password reset find the user id
+here before going to the shard.
+
+oauth_identities, next to it, maps every (provider, provider user id) to its
+global user id, so the OAuth callback finds a returning identity without
+going through the email the provider reports, which may have changed.
+'''
+from typing import Any, Optional, Tuple
+from db import shard_for, statement, execute
+
+NEXT_ID = statement('directory_next_id', "SELECT nextval(pg_get_serial_sequence('user_directory', 'id'))")
+CLAIM = statement('directory_claim', "INSERT INTO user_directory (id, email, shard) VALUES (%s, %s, %s) ON CONFLICT (email) DO NOTHING RETURNING id")
+FIND = statement('directory_find', "SELECT id FROM user_directory WHERE email = %s")
+RELEASE = statement('directory_release', "DELETE FROM user_directory WHERE id = %s")
+FIND_IDENTITY = statement('directory_find_identity', "SELECT user_id FROM oauth_identities WHERE oauth_provider = %s AND oauth_id = %s")
+RECORD_IDENTITY = statement('directory_record_identity', """
+    INSERT INTO oauth_identities (oauth_provider, oauth_id, user_id) VALUES (%s, %s, %s)
+    ON CONFLICT (oauth_provider, oauth_id) DO UPDATE SET user_id = EXCLUDED.user_id
+""")
+
+def find_user_id(cur: Any, email: str) -> Optional[int]:
+    execute(cur, FIND, (email,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def claim_email(cur: Any, email: str) -> Optional[int]:
+    '''A new user id for email, or None when the email is taken. The caller commits before writing the user.'''
+    execute(cur, NEXT_ID)
+    user_id = cur.fetchone()[0]
+    execute(cur, CLAIM, (user_id, email, shard_for(user_id)))
+    return user_id if cur.fetchone() else None
+
+def claim_or_find(cur: Any, email: str) -> Tuple[int, bool]:
+    '''(user id, True when it was claimed just now) for email.'''
+    while True:
+        user_id = claim_email(cur, email)
+        if user_id is not None:
+            return user_id, True
+        user_id = find_user_id(cur, email)
+        if user_id is not None:
+            return user_id, False
+        # Released between the claim and the lookup; claim again.
+
+def release_email(cur: Any, user_id: int):
+    '''Undoes a claim whose user could not be written.'''
+    execute(cur, RELEASE, (user_id,))
+
+def find_identity(cur: Any, provider: str, oauth_id: str) -> Optional[int]:
+    execute(cur, FIND_IDENTITY, (provider, oauth_id))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def record_identity(cur: Any, provider: str, oauth_id: str, user_id: int):
+    '''Points the identity at user_id, replacing a stale entry. The caller commits.'''
+    execute(cur, RECORD_IDENTITY, (provider, oauth_id, user_id))
@@ -0,0 +1,238 @@
+'''
+Idempotency-Key support shared by the auth, oauth, email and chat functions
+(each function directory carries its own copy because functions are deployed
+independently). Routes opt in with router.route(..., idempotent=True).
+
+A request that carries an Idempotency-Key header runs at most once per key
+within IDEMPOTENCY_TTL_SECONDS: the first one claims the key, runs the handler
+and stores its response; retries get that response back (with
+Idempotent-Replayed: true) without running anything. A retry that arrives
+while the first request is still running waits for it, on an in-process event
+when both landed on the same instance, otherwise by polling the claim, for up
+to IDEMPOTENCY_WAIT_SECONDS before answering 409.
+
+Keys are scoped to the function and stored as a hash; the request fingerprint
+(method, action, X-Auth-Token and body) must match, so a key reused for a
+different request, or by someone else, answers 422 instead of replaying.
+Only successful (2xx/3xx) responses are stored; after an error or an exception
+the claim is dropped and the next retry runs again.
+
+Completed responses are kept in an in-memory LRU of IDEMPOTENCY_CACHE_SIZE
+entries and, in functions that have a database, in the idempotency_keys table
+so other instances see them too. A claim whose instance died is taken over
+after IDEMPOTENCY_LOCK_SECONDS. Stored responses carry credentials (register
+and the OAuth callback return a live token and refresh token), so the table
+only holds them sealed with AES-GCM under a key derived from the raw
+Idempotency-Key and the request body, neither of which is stored: replaying
+needs the original request, and reading the table does not give the tokens.
+Clients should use random keys (UUIDs).
+'''
+import base64
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from typing import Dict, Any, Callable, Optional, Tuple
+from router import HTTPError, Request, error
+
+try:
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from db import get_db_connection, release, statement, execute
+except ImportError:
+    get_db_connection = None
+
+TTL_SECONDS = int(os.environ.get('IDEMPOTENCY_TTL_SECONDS', '86400'))
+LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', '60'))
+WAIT_SECONDS = float(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '30'))
+CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', '1000'))
+PURGE_PROBABILITY = 0.01
+MAX_KEY_LENGTH = 255
+
+if get_db_connection is not None:
+    # Claims a new key, an expired one, or one whose owner stopped renewing it; no row means someone else holds it.
+    CLAIM = statement('idempotency_claim', """
+        INSERT INTO idempotency_keys (key, fingerprint, locked_until, expires_at)
+        VALUES (%s, %s, LOCALTIMESTAMP + make_interval(secs => %s), LOCALTIMESTAMP + make_interval(secs => %s))
+        ON CONFLICT (key) DO UPDATE SET
+            fingerprint = EXCLUDED.fingerprint,
+            response = NULL,
+            locked_until = EXCLUDED.locked_until,
+            expires_at = EXCLUDED.expires_at
+        WHERE idempotency_keys.expires_at < LOCALTIMESTAMP
+            OR (idempotency_keys.response IS NULL AND idempotency_keys.locked_until < LOCALTIMESTAMP)
+        RETURNING key
+    """)
+    LOOKUP = statement('idempotency_lookup', "SELECT fingerprint, response FROM idempotency_keys WHERE key = %s AND expires_at > LOCALTIMESTAMP")
+    COMPLETE = statement('idempotency_complete', "UPDATE idempotency_keys SET response = %s, locked_until = NULL WHERE key = %s")
+    RELEASE = statement('idempotency_release', "DELETE FROM idempotency_keys WHERE key = %s AND response IS NULL")
+    PURGE = statement('idempotency_purge', "DELETE FROM idempotency_keys WHERE key IN (SELECT key FROM idempotency_keys WHERE expires_at < LOCALTIMESTAMP LIMIT 1000)")
+
+class Entry:
+    __slots__ = ('fingerprint', 'response', 'expires_at', 'done')
+    
+    def __init__(self, fingerprint: str):
+        self.fingerprint = fingerprint
+        self.response: Optional[Dict[str, Any]] = None
+        self.expires_at = time.monotonic() + TTL_SECONDS
+        self.done = threading.Event()
+
+_entries: 'OrderedDict[str, Entry]' = OrderedDict()
+_entries_lock = threading.Lock()
+
+def fingerprint(request: Request) -> str:
+    digest = hashlib.sha256()
+    for part in (request.method, request.action, request.header('x-auth-token'), request.event.get('body') or ''):
+        digest.update(part.encode() if isinstance(part, str) else part)
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+def response_key(idempotency_key: str, request: Request) -> bytes:
+    '''AES key for the stored response: the raw key and the body, under a different prefix than fingerprint().'''
+    digest = hashlib.sha256(b'idempotency-response\0')
+    for part in (getattr(request.context, 'function_name', '') or '', idempotency_key, request.event.get('body') or ''):
+        digest.update(part.encode() if isinstance(part, str) else part)
+        digest.update(b'\0')
+    return digest.digest()
+
+def seal(secret: bytes, response: Dict[str, Any]) -> str:
+    nonce = os.urandom(12)
+    sealed = AESGCM(secret).encrypt(nonce, json.dumps(response).encode(), None)
+    return json.dumps({'sealed': base64.b64encode(nonce + sealed).decode()})
+
+def unseal(secret: bytes, stored: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    '''The stored response, or None when it cannot be opened with this key (or predates sealing).'''
+    try:
+        raw = base64.b64decode(stored['sealed'])
+        return json.loads(AESGCM(secret).decrypt(raw[:12], raw[12:], None))
+    except Exception:
+        return None
+
+def replay(entry_fingerprint: str, response: Dict[str, Any], request_fingerprint: str) -> Dict[str, Any]:
+    if entry_fingerprint != request_fingerprint:
+        return error(422, 'Idempotency-Key was already used for a different request')
+    return dict(response, headers=dict(response.get('headers') or {}, **{'Idempotent-Replayed': 'true'}))
+
+def remember(key: str, entry: Entry):
+    with _entries_lock:
+        _entries[key] = entry
+        _entries.move_to_end(key)
+        while len(_entries) > CACHE_SIZE:
+            oldest_key, oldest = next(iter(_entries.items()))
+            if not oldest.done.is_set():
+                # Never evict a request that others may be waiting on; the cache can run over briefly.
+                break
+            del _entries[oldest_key]
+
+def local_entry(key: str, request_fingerprint: str) -> Tuple[Entry, bool]:
+    '''(entry, owner): the existing live entry for key, or a new pending one this request owns.'''
+    with _entries_lock:
+        entry = _entries.get(key)
+        if entry is not None and entry.expires_at > time.monotonic() and (entry.response is not None or not entry.done.is_set()):
+            _entries.move_to_end(key)
+            return entry, False
+        entry = Entry(request_fingerprint)
+    remember(key, entry)
+    return entry, True
+
+def run_sql(stmt: Any, params: Tuple[Any, ...], fetch: bool = False) -> Optional[Tuple[Any, ...]]:
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        execute(cur, stmt, params)
+        row = cur.fetchone() if fetch else None
+        conn.commit()
+    finally:
+        cur.close()
+        release(conn)
+    return row
+
+def stored_replay(secret: bytes, row: Tuple[Any, ...], request_fingerprint: str) -> Dict[str, Any]:
+    if row[0] != request_fingerprint:
+        return error(422, 'Idempotency-Key was already used for a different request')
+    response = unseal(secret, row[1])
+    if response is None:
+        return error(409, 'The stored response for this Idempotency-Key cannot be replayed')
+    return replay(row[0], response, request_fingerprint)
+
+def wait_for_owner(key: str, secret: bytes, request_fingerprint: str) -> Optional[Dict[str, Any]]:
+    '''
+    Polls another instance's claim until it completes (its response, replayed),
+    expires (None: claim it again) or WAIT_SECONDS pass (409).
+    '''
+    deadline = time.monotonic() + WAIT_SECONDS
+    delay = 0.05
+    while True:
+        row = run_sql(LOOKUP, (key,), fetch=True)
+        if row is None:
+            return None
+        if row[1] is not None:
+            return stored_replay(secret, row, request_fingerprint)
+        if row[0] != request_fingerprint:
+            return error(422, 'Idempotency-Key was already used for a different request')
+        if time.monotonic() >= deadline:
+            return error(409, 'A request with this Idempotency-Key is still in progress')
+        if run_sql(CLAIM, (key, request_fingerprint, LOCK_SECONDS, TTL_SECONDS), fetch=True):
+            return None
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+
+def execute_once(key: str, secret: bytes, request_fingerprint: str, request: Request, func: Callable[[Request], Dict[str, Any]]) -> Dict[str, Any]:
+    entry, owner = local_entry(key, request_fingerprint)
+    if not owner:
+        if entry.fingerprint != request_fingerprint:
+            return error(422, 'Idempotency-Key was already used for a different request')
+        if not entry.done.wait(WAIT_SECONDS):
+            return error(409, 'A request with this Idempotency-Key is still in progress')
+        if entry.response is not None:
+            return replay(entry.fingerprint, entry.response, request_fingerprint)
+        # The owner failed; this retry runs it again.
+        return execute_once(key, secret, request_fingerprint, request, func)
+    
+    claimed = False
+    try:
+        if get_db_connection is not None:
+            if random.random() < PURGE_PROBABILITY:
+                run_sql(PURGE, ())
+            while not claimed:
+                claimed = bool(run_sql(CLAIM, (key, request_fingerprint, LOCK_SECONDS, TTL_SECONDS), fetch=True))
+                if not claimed:
+                    stored = wait_for_owner(key, secret, request_fingerprint)
+                    if stored is not None:
+                        return stored
+        
+        try:
+            response = func(request)
+        except HTTPError as http_error:
+            response = error(http_error.status_code, http_error.message, **http_error.extra)
+        if response.get('statusCode', 200) < 400:
+            if claimed:
+                run_sql(COMPLETE, (seal(secret, response), key))
+            entry.response = response
+        return response
+    finally:
+        if entry.response is None:
+            with _entries_lock:
+                if _entries.get(key) is entry:
+                    del _entries[key]
+            if claimed:
+                run_sql(RELEASE, (key,))
+        entry.done.set()
+
+def idempotent(func: Callable[[Request], Dict[str, Any]]) -> Callable[[Request], Dict[str, Any]]:
+    '''Wraps a route so that requests with an Idempotency-Key header run once per key.'''
+    @wraps(func)
+    def wrapper(request: Request) -> Dict[str, Any]:
+        idempotency_key = request.header('idempotency-key')
+        if not idempotency_key:
+            return func(request)
+        if len(idempotency_key) > MAX_KEY_LENGTH:
+            return error(400, f'Idempotency-Key must be at most {MAX_KEY_LENGTH} characters')
+        
+        function_name = getattr(request.context, 'function_name', '') or ''
+        key = hashlib.sha256(f'{function_name}\0{idempotency_key}'.encode()).hexdigest()
+        return execute_once(key, response_key(idempotency_key, request), fingerprint(request), request, func)
+    return wrapper
@@ -4,391 +4,484 @@ Args: event - dict with httpMethod, body, queryStringParameters
       context - object with attributes: request_id, function_name
 Returns: HTTP response dict with user data or error
 '''
-import json
-import os
-import psycopg2
 import hashlib
-import hmac
-import base64
+import os
 import time
+import secrets
+import threading
+import psycopg2
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional
 from datetime import datetime, timedelta
+from metrics import instrument, timed
+import avatars
+from activity import log_activity
+from mailer import send_template
+from jwt_keys import encode_jwt, decode_jwt, public_jwks
+from db import get_db_connection, shard_connection, release, record_write, statement, execute
+from directory import claim_email, find_user_id, release_email
+from router import Router, Request, HTTPError, respond, error
+import reads
+from reads import serve
+import last_seen
+from sessions import ACCESS_TOKEN_TTL, create_session, rotate_session, revoke_session, revoke_user_sessions, note_revoked, is_legacy_token, is_revoked
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url)
+INSERT_USER = statement('auth_insert_user', "INSERT INTO users (id, email, password_hash, first_name, last_name) VALUES (%s, %s, %s, %s, %s)")
+LOGIN_USER = statement('auth_login_user', "SELECT id, email, first_name, last_name, avatar_url FROM users WHERE id = %s AND password_hash = %s AND is_active = TRUE")
+UPDATE_PROFILE = statement('auth_update_profile', "UPDATE users SET first_name = %s, last_name = %s, avatar_url = COALESCE(%s, avatar_url), updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING id, email, first_name, last_name, avatar_url")
+SET_AVATAR = statement('auth_set_avatar', "UPDATE users SET avatar_url = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING id, email, first_name, last_name, avatar_url")
+INSERT_RESET_TOKEN = statement('auth_insert_reset_token', "INSERT INTO password_reset_tokens (user_id, token, expires_at) VALUES (%s, %s, %s)")
+SELECT_RESET_TOKEN = statement('auth_select_reset_token', "SELECT user_id, expires_at, used FROM password_reset_tokens WHERE token = %s")
+UPDATE_PASSWORD = statement('auth_update_password', "UPDATE users SET password_hash = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING email")
+USE_RESET_TOKEN = statement('auth_use_reset_token', "UPDATE password_reset_tokens SET used = TRUE WHERE token = %s")
+COUNT_RESET_REQUESTS = statement('auth_count_reset_requests', """
+    SELECT
+        (SELECT COUNT(*) FROM password_reset_requests WHERE lower(email) = lower(%s) AND created_at > %s),
+        (SELECT COUNT(*) FROM password_reset_requests WHERE ip_address = %s AND created_at > %s)
+""")
+INSERT_RESET_REQUEST = statement('auth_insert_reset_request', "INSERT INTO password_reset_requests (email, ip_address) VALUES (%s, %s)")
+CLAIM_RESET_REQUEST = statement('auth_claim_reset_request', "SELECT id, email FROM password_reset_requests WHERE sent_at IS NULL AND created_at > %s ORDER BY id LIMIT 1 FOR UPDATE SKIP LOCKED")
+MARK_RESET_REQUEST_SENT = statement('auth_mark_reset_request_sent', "UPDATE password_reset_requests SET sent_at = CURRENT_TIMESTAMP WHERE id = %s")
+PURGE_RESET_REQUESTS = statement('auth_purge_reset_requests', "DELETE FROM password_reset_requests WHERE created_at < %s")
 
+# Base URL for links in emails. Never taken from the request: a caller could
+# point reset links at their own host. Without it no reset link is sent.
+APP_URL = os.environ.get('APP_URL', '').rstrip('/')
+
+# reset-password-request mails whatever address it is given, so requests are
+# limited per address and per client IP within RESET_REQUEST_WINDOW_SECONDS.
+RESET_REQUESTS_PER_ADDRESS = int(os.environ.get('RESET_REQUESTS_PER_ADDRESS', '3'))
+RESET_REQUESTS_PER_IP = int(os.environ.get('RESET_REQUESTS_PER_IP', '10'))
+RESET_REQUEST_WINDOW_SECONDS = int(os.environ.get('RESET_REQUEST_WINDOW_SECONDS', '3600'))
+# A queued request not delivered within the lifetime of a reset link is dropped.
+RESET_TOKEN_TTL = timedelta(hours=1)
+
+_delivery: Optional[ThreadPoolExecutor] = None
+_delivery_pid = 0
+_delivery_lock = threading.Lock()
+
+@timed('password_hash')
 def hash_password(password: str) -> str:
     return hashlib.sha256(password.encode()).hexdigest()
 
-def generate_jwt(user_id: int, email: str) -> str:
-    secret = os.environ.get('JWT_SECRET_KEY', 'default_secret_key')
-    
-    header = base64.urlsafe_b64encode(json.dumps({
-        "alg": "HS256",
-        "typ": "JWT"
-    }).encode()).decode().rstrip('=')
-    
-    payload = base64.urlsafe_b64encode(json.dumps({
+@timed('jwt_sign')
+def generate_jwt(user_id: int, email: str, session_id: int) -> str:
+    return encode_jwt({
         "user_id": user_id,
         "email": email,
-        "exp": int(time.time()) + 86400 * 7
-    }).encode()).decode().rstrip('=')
-    
-    signature = base64.urlsafe_b64encode(
-        hmac.new(
-            secret.encode(),
-            f"{header}.{payload}".encode(),
-            hashlib.sha256
-        ).digest()
-    ).decode().rstrip('=')
-    
-    return f"{header}.{payload}.{signature}"
+        "sid": session_id,
+        "exp": int(time.time()) + ACCESS_TOKEN_TTL
+    })
 
+@timed('jwt_verify')
 def verify_jwt(token: str) -> Optional[Dict[str, Any]]:
-    secret = os.environ.get('JWT_SECRET_KEY', 'default_secret_key')
+    return decode_jwt(token)
+
+def authenticate(request: Request) -> Dict[str, Any]:
+    auth_header = request.header('x-auth-token')
     
-    parts = token.split('.')
-    if len(parts) != 3:
-        return None
+    if not auth_header:
+        raise HTTPError(401, 'No token provided')
     
-    header, payload, signature = parts
+    payload = verify_jwt(auth_header)
+    if not payload or not ('sid' in payload or is_legacy_token(payload)):
+        raise HTTPError(401, 'Invalid token')
     
-    expected_signature = base64.urlsafe_b64encode(
-        hmac.new(
-            secret.encode(),
-            f"{header}.{payload}".encode(),
-            hashlib.sha256
-        ).digest()
-    ).decode().rstrip('=')
+    if 'sid' in payload and is_revoked(payload['sid']):
+        raise HTTPError(401, 'Session revoked')
     
-    if signature != expected_signature:
-        return None
+    last_seen.seen(payload['user_id'])
+    return payload
+
+def notify(email_type: str, email: str, data: Dict[str, Any]):
+    '''Sends a notification email; the request has already succeeded, so a delivery failure is only logged.'''
+    try:
+        send_template(email_type, email, data)
+    except OSError as exc:
+        print(f'{email_type} email to {email} failed: {exc!r}')
+
+def delivery_pool() -> ThreadPoolExecutor:
+    '''The reset email thread, created on first use in each process (tools/prefork.py forks after import).'''
+    global _delivery, _delivery_pid
+    with _delivery_lock:
+        if _delivery is None or _delivery_pid != os.getpid():
+            _delivery = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reset-mail')
+            _delivery_pid = os.getpid()
+        return _delivery
+
+def deliver_reset_requests() -> int:
+    '''
+    Sends the queued password_reset_requests and returns how many went out:
+    a reset link for an address with an account, otherwise a note that no
+    account uses it. Each row is claimed with SKIP LOCKED and marked sent in
+    the transaction that created its token, so concurrent runs (the thread of
+    every instance that queued a request, tools/send_reset_emails.py) never
+    send one twice. An SMTP failure ends the run and leaves the row for the
+    next one; rows older than RESET_TOKEN_TTL are no longer sent.
+    '''
+    sent = 0
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        while True:
+            execute(cur, CLAIM_RESET_REQUEST, (datetime.now() - RESET_TOKEN_TTL,))
+            claimed = cur.fetchone()
+            if not claimed:
+                break
+            request_id, email = claimed
+            
+            user_id = find_user_id(cur, email)
+            try:
+                if user_id is None:
+                    send_template('password_reset_unknown', email, {'app_url': APP_URL})
+                else:
+                    token = secrets.token_urlsafe(32)
+                    execute(cur, INSERT_RESET_TOKEN, (user_id, token, datetime.now() + RESET_TOKEN_TTL))
+                    send_template('password_reset', email, {'reset_url': f'{APP_URL}/reset-password', 'reset_token': token})
+            except OSError as exc:
+                conn.rollback()
+                print(f'reset email to {email} failed: {exc!r}')
+                break
+            execute(cur, MARK_RESET_REQUEST_SENT, (request_id,))
+            conn.commit()
+            sent += 1
+        
+        execute(cur, PURGE_RESET_REQUESTS, (datetime.now() - timedelta(seconds=max(RESET_REQUEST_WINDOW_SECONDS, RESET_TOKEN_TTL.total_seconds())),))
+        conn.commit()
+    except psycopg2.Error as exc:
+        print(f'reset email delivery failed: {exc}')
+    finally:
+        cur.close()
+        release(conn)
+    return sent
+
+def issue_tokens(cur: Any, request: Request, user_id: int, email: str) -> Dict[str, Any]:
+    session_id, refresh_token = create_session(cur, user_id, request.source_ip, request.header('user-agent'))
+    return {
+        'token': generate_jwt(user_id, email, session_id),
+        'refresh_token': refresh_token,
+        'expires_in': ACCESS_TOKEN_TTL
+    }
+
+router = Router('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, X-Auth-Token, X-Min-LSN, Idempotency-Key', authenticate, finish=last_seen.flush_due)
+
+@router.route('GET', 'jwks')
+def jwks(request: Request) -> Dict[str, Any]:
+    return respond(200, public_jwks(), {'Cache-Control': 'public, max-age=300'})
+
+@router.route('POST', 'register', idempotent=True)
+def register(request: Request) -> Dict[str, Any]:
+    body_data = request.body
+    email = body_data.get('email', '')
+    password = body_data.get('password', '')
+    first_name = body_data.get('first_name', '')
+    last_name = body_data.get('last_name', '')
     
-    padding = '=' * (4 - len(payload) % 4)
-    decoded_payload = json.loads(base64.urlsafe_b64decode(payload + padding))
+    if not email or not password:
+        return error(400, 'Email and password required')
     
-    if decoded_payload.get('exp', 0) < time.time():
-        return None
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    # The email is claimed in the directory and committed before the user is
+    # written to its shard, so of two registrations for one email only one gets
+    # an id, whichever shards they would land on.
+    user_id = claim_email(cur, email)
+    if user_id is None:
+        conn.rollback()
+        cur.close()
+        release(conn)
+        return error(400, 'User already exists')
+    conn.commit()
+    
+    password_hash = hash_password(password)
+    user_conn = shard_connection(user_id, conn)
+    user_cur = user_conn.cursor()
+    try:
+        execute(user_cur, INSERT_USER, (user_id, email, password_hash, first_name, last_name))
+        log_activity(user_cur, user_id, 'register', request.source_ip, request.header('user-agent'))
+        user_conn.commit()
+    except psycopg2.Error:
+        user_conn.rollback()
+        release_email(cur, user_id)
+        conn.commit()
+        raise
+    finally:
+        user_cur.close()
+        if user_conn is not conn:
+            release(user_conn)
     
-    return decoded_payload
+    tokens = issue_tokens(cur, request, user_id, email)
+    conn.commit()
+    cur.close()
+    release(conn)
+    last_seen.login(user_id)
+    
+    notify('welcome', email, {'name': first_name, 'app_url': APP_URL})
+    
+    return respond(200, dict(tokens, user={
+        'id': user_id,
+        'email': email,
+        'first_name': first_name,
+        'last_name': last_name
+    }))
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+@router.route('POST', 'login')
+def login(request: Request) -> Dict[str, Any]:
+    body_data = request.body
+    email = body_data.get('email', '')
+    password = body_data.get('password', '')
     
-    path = event.get('queryStringParameters', {}).get('action', '')
+    if not email or not password:
+        return error(400, 'Email and password required')
     
-    if method == 'POST' and path == 'register':
-        body_data = json.loads(event.get('body', '{}'))
-        email = body_data.get('email', '')
-        password = body_data.get('password', '')
-        first_name = body_data.get('first_name', '')
-        last_name = body_data.get('last_name', '')
-        
-        if not email or not password:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Email and password required'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-        if cur.fetchone():
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'User already exists'})
-            }
-        
-        password_hash = hash_password(password)
-        cur.execute(
-            "INSERT INTO users (email, password_hash, first_name, last_name) VALUES (%s, %s, %s, %s) RETURNING id",
-            (email, password_hash, first_name, last_name)
-        )
-        user_id = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        token = generate_jwt(user_id, email)
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'token': token,
-                'user': {
-                    'id': user_id,
-                    'email': email,
-                    'first_name': first_name,
-                    'last_name': last_name
-                }
-            })
-        }
+    conn = get_db_connection()
+    cur = conn.cursor()
     
-    if method == 'POST' and path == 'login':
-        body_data = json.loads(event.get('body', '{}'))
-        email = body_data.get('email', '')
-        password = body_data.get('password', '')
-        
-        if not email or not password:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Email and password required'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        password_hash = hash_password(password)
-        cur.execute(
-            "SELECT id, email, first_name, last_name, avatar_url FROM users WHERE email = %s AND password_hash = %s AND is_active = TRUE",
-            (email, password_hash)
-        )
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
-        
-        if not user:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid credentials'})
-            }
-        
-        token = generate_jwt(user[0], user[1])
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'token': token,
-                'user': {
-                    'id': user[0],
-                    'email': user[1],
-                    'first_name': user[2],
-                    'last_name': user[3],
-                    'avatar_url': user[4]
-                }
-            })
-        }
+    password_hash = hash_password(password)
+    user_id = find_user_id(cur, email)
+    user_conn = shard_connection(user_id, conn)
+    user_cur = user_conn.cursor()
     
-    if method == 'GET' and path == 'profile':
-        auth_header = event.get('headers', {}).get('x-auth-token', '')
-        
-        if not auth_header:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'No token provided'})
-            }
-        
-        payload = verify_jwt(auth_header)
-        if not payload:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid token'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "SELECT id, email, first_name, last_name, avatar_url, created_at FROM users WHERE id = %s",
-            (payload['user_id'],)
-        )
-        user = cur.fetchone()
+    user = None
+    if user_id is not None:
+        execute(user_cur, LOGIN_USER, (user_id, password_hash))
+        user = user_cur.fetchone()
+    
+    if not user:
+        log_activity(user_cur, None, 'login_failed', request.source_ip, request.header('user-agent'))
+        user_conn.commit()
+        user_cur.close()
         cur.close()
-        conn.close()
-        
-        if not user:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'User not found'})
-            }
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'user': {
-                    'id': user[0],
-                    'email': user[1],
-                    'first_name': user[2],
-                    'last_name': user[3],
-                    'avatar_url': user[4],
-                    'created_at': user[5].isoformat() if user[5] else None
-                }
-            })
+        if user_conn is not conn:
+            release(user_conn)
+        release(conn)
+        return error(401, 'Invalid credentials')
+    
+    tokens = issue_tokens(cur, request, user[0], user[1])
+    log_activity(user_cur, user[0], 'login', request.source_ip, request.header('user-agent'))
+    conn.commit()
+    user_conn.commit()
+    user_cur.close()
+    cur.close()
+    if user_conn is not conn:
+        release(user_conn)
+    release(conn)
+    last_seen.login(user[0])
+    
+    return respond(200, dict(tokens, user={
+        'id': user[0],
+        'email': user[1],
+        'first_name': user[2],
+        'last_name': user[3],
+        'avatar_url': user[4]
+    }))
+
+@router.route('POST', 'refresh')
+def refresh(request: Request) -> Dict[str, Any]:
+    refresh_token = request.body.get('refresh_token', '')
+    
+    if not refresh_token:
+        return error(400, 'Refresh token required')
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    rotated = rotate_session(cur, refresh_token)
+    conn.commit()
+    cur.close()
+    release(conn)
+    
+    if not rotated:
+        return error(401, 'Invalid refresh token')
+    
+    session_id, user_id, email, new_refresh_token = rotated
+    last_seen.seen(user_id)
+    
+    return respond(200, {
+        'token': generate_jwt(user_id, email, session_id),
+        'refresh_token': new_refresh_token,
+        'expires_in': ACCESS_TOKEN_TTL
+    })
+
+@router.route('POST', 'logout', auth=True)
+def logout(request: Request) -> Dict[str, Any]:
+    session_id = request.user.get('sid')
+    if session_id is None:
+        # A token from before sessions: there is nothing to revoke, it just expires.
+        return respond(200, {'message': 'Logged out'})
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    revoke_session(cur, session_id, 'logout')
+    conn.commit()
+    cur.close()
+    release(conn)
+    
+    note_revoked([session_id])
+    
+    return respond(200, {'message': 'Logged out'})
+
+@router.route('GET', 'profile', auth=True)
+def get_profile(request: Request) -> Dict[str, Any]:
+    return serve(reads.profile, request)
+
+@router.route('PUT', 'profile', auth=True)
+def update_profile(request: Request) -> Dict[str, Any]:
+    body_data = request.body
+    first_name = body_data.get('first_name', '')
+    last_name = body_data.get('last_name', '')
+    # Avatars are uploaded with POST avatar; only clearing it or pointing at an
+    # already stored avatar is accepted here. Without durable avatar storage
+    # there is nothing to upload to, and a picture URL is stored as given.
+    avatar_url = body_data.get('avatar_url')
+    if avatar_url and avatars.DURABLE and not avatars.is_hosted(str(avatar_url)):
+        return error(400, 'Upload avatars with action=avatar')
+    
+    conn = shard_connection(request.user['user_id'])
+    cur = conn.cursor()
+    
+    execute(cur, UPDATE_PROFILE, (first_name, last_name, avatar_url, request.user['user_id']))
+    user = cur.fetchone()
+    conn.commit()
+    consistency = record_write(conn, request.user['user_id'])
+    cur.close()
+    release(conn)
+    
+    if not user:
+        return error(404, 'User not found')
+    
+    return respond(200, {
+        'user': {
+            'id': user[0],
+            'email': user[1],
+            'first_name': user[2],
+            'last_name': user[3],
+            'avatar_url': user[4]
         }
+    }, consistency)
+
+@router.route('GET', 'avatar')
+def get_avatar(request: Request) -> Dict[str, Any]:
+    return avatars.response(request.params.get('key', ''), request.header('if-none-match'))
+
+@router.route('POST', 'avatar', auth=True)
+def upload_avatar(request: Request) -> Dict[str, Any]:
+    image = request.body.get('image', '')
     
-    if method == 'PUT' and path == 'profile':
-        auth_header = event.get('headers', {}).get('x-auth-token', '')
-        
-        if not auth_header:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'No token provided'})
-            }
-        
-        payload = verify_jwt(auth_header)
-        if not payload:
-            return {
-                'statusCode': 401,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid token'})
-            }
-        
-        body_data = json.loads(event.get('body', '{}'))
-        first_name = body_data.get('first_name', '')
-        last_name = body_data.get('last_name', '')
-        avatar_url = body_data.get('avatar_url', '')
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "UPDATE users SET first_name = %s, last_name = %s, avatar_url = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s RETURNING id, email, first_name, last_name, avatar_url",
-            (first_name, last_name, avatar_url, payload['user_id'])
-        )
-        user = cur.fetchone()
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'user': {
-                    'id': user[0],
-                    'email': user[1],
-                    'first_name': user[2],
-                    'last_name': user[3],
-                    'avatar_url': user[4]
-                }
-            })
+    if not image or not isinstance(image, str):
+        return error(400, 'Image required')
+    
+    if not avatars.DURABLE:
+        return error(503, 'Avatar storage is not configured')
+    
+    try:
+        avatar_url = avatars.ingest(avatars.decode_upload(image))
+    except ValueError as exc:
+        return error(400, str(exc))
+    
+    conn = shard_connection(request.user['user_id'])
+    cur = conn.cursor()
+    
+    execute(cur, SET_AVATAR, (avatar_url, request.user['user_id']))
+    user = cur.fetchone()
+    conn.commit()
+    consistency = record_write(conn, request.user['user_id'])
+    cur.close()
+    release(conn)
+    
+    if not user:
+        return error(404, 'User not found')
+    
+    return respond(200, {
+        'user': {
+            'id': user[0],
+            'email': user[1],
+            'first_name': user[2],
+            'last_name': user[3],
+            'avatar_url': user[4]
         }
+    }, consistency)
+
+@router.route('POST', 'reset-password-request', idempotent=True)
+def reset_password_request(request: Request) -> Dict[str, Any]:
+    email = request.body.get('email', '')
     
-    if method == 'POST' and path == 'reset-password-request':
-        body_data = json.loads(event.get('body', '{}'))
-        email = body_data.get('email', '')
-        
-        if not email:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Email required'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute("SELECT id FROM users WHERE email = %s", (email,))
-        user = cur.fetchone()
-        
-        if not user:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'message': 'If email exists, reset link sent'})
-            }
-        
-        import secrets
-        token = secrets.token_urlsafe(32)
-        expires_at = datetime.now() + timedelta(hours=1)
-        
-        cur.execute(
-            "INSERT INTO password_reset_tokens (user_id, token, expires_at) VALUES (%s, %s, %s)",
-            (user[0], token, expires_at)
-        )
-        conn.commit()
+    if not email or not isinstance(email, str):
+        return error(400, 'Email required')
+    if not APP_URL:
+        print('reset-password-request refused: APP_URL is not set')
+        return error(503, 'Password reset is not configured')
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    since = datetime.now() - timedelta(seconds=RESET_REQUEST_WINDOW_SECONDS)
+    execute(cur, COUNT_RESET_REQUESTS, (email, since, request.source_ip, since))
+    address_requests, ip_requests = cur.fetchone()
+    if address_requests >= RESET_REQUESTS_PER_ADDRESS or ip_requests >= RESET_REQUESTS_PER_IP:
         cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'message': 'Reset link sent',
-                'reset_token': token
-            })
-        }
+        release(conn)
+        return error(429, 'Too many reset requests, try again later')
     
-    if method == 'POST' and path == 'reset-password':
-        body_data = json.loads(event.get('body', '{}'))
-        token = body_data.get('token', '')
-        new_password = body_data.get('new_password', '')
-        
-        if not token or not new_password:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Token and new password required'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "SELECT user_id, expires_at, used FROM password_reset_tokens WHERE token = %s",
-            (token,)
-        )
-        reset_token = cur.fetchone()
-        
-        if not reset_token or reset_token[2] or reset_token[1] < datetime.now():
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid or expired token'})
-            }
-        
-        password_hash = hash_password(new_password)
-        cur.execute(
-            "UPDATE users SET password_hash = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
-            (password_hash, reset_token[0])
-        )
-        cur.execute(
-            "UPDATE password_reset_tokens SET used = TRUE WHERE token = %s",
-            (token,)
-        )
-        conn.commit()
+    execute(cur, INSERT_RESET_REQUEST, (email, request.source_ip))
+    conn.commit()
+    cur.close()
+    release(conn)
+    
+    # The lookup and the email (the link, or a note that no account uses the
+    # address) happen on the delivery thread, so neither the response nor its
+    # timing tells whether the account exists. The queued row survives this
+    # instance being frozen; the next delivery run anywhere sends it.
+    delivery_pool().submit(deliver_reset_requests)
+    
+    return respond(200, {'message': 'If email exists, reset link sent'})
+
+@router.route('POST', 'reset-password')
+def reset_password(request: Request) -> Dict[str, Any]:
+    body_data = request.body
+    token = body_data.get('token', '')
+    new_password = body_data.get('new_password', '')
+    
+    if not token or not new_password:
+        return error(400, 'Token and new password required')
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    execute(cur, SELECT_RESET_TOKEN, (token,))
+    reset_token = cur.fetchone()
+    
+    if not reset_token or reset_token[2] or reset_token[1] < datetime.now():
         cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'message': 'Password reset successful'})
-        }
+        release(conn)
+        return error(400, 'Invalid or expired token')
     
-    return {
-        'statusCode': 404,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Endpoint not found'})
-    }
\ No newline at end of file
+    user_id = reset_token[0]
+    user_conn = shard_connection(user_id, conn)
+    user_cur = user_conn.cursor()
+    
+    password_hash = hash_password(new_password)
+    execute(user_cur, UPDATE_PASSWORD, (password_hash, user_id))
+    email = user_cur.fetchone()[0]
+    log_activity(user_cur, user_id, 'password_reset', request.source_ip, request.header('user-agent'))
+    user_conn.commit()
+    user_cur.close()
+    if user_conn is not conn:
+        release(user_conn)
+    
+    execute(cur, USE_RESET_TOKEN, (token,))
+    revoked = revoke_user_sessions(cur, user_id, 'password_reset')
+    conn.commit()
+    cur.close()
+    release(conn)
+    
+    note_revoked(revoked)
+    notify('password_changed', email, {})
+    
+    return respond(200, {'message': 'Password reset successful'})
+
+@instrument
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return router.dispatch(event, context)
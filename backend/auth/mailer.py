@@ -0,0 +1,111 @@
+'''
+Transactional email shared by the email and auth functions (each function
+directory carries its own copy because functions are deployed independently).
+
+render() builds the subject and HTML of a template (welcome, password_reset,
+password_reset_unknown, password_changed) with the caller's values escaped;
+send_email() delivers it over SMTP within the calling request. There is no
+background queue: a serverless instance may be frozen or dropped as soon as
+it has answered, so an email is only sent once send_email() has returned.
+Delivery errors (OSError, which includes smtplib.SMTPException) are left to
+the caller.
+'''
+import html
+import os
+import smtplib
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from typing import Dict, Any, Optional, Tuple
+from metrics import timed
+
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', '10'))
+
+STYLE = '''
+                body { font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif; background-color: #E0E5EC; padding: 20px; }
+                .container { max-width: 600px; margin: 0 auto; background: #ffffff; border-radius: 20px; padding: 40px; box-shadow: 8px 8px 16px #c5cdd8, -8px -8px 16px #ffffff; }
+                h1 { color: #4A5568; font-size: 32px; margin-bottom: 20px; }
+                p { color: #718096; font-size: 16px; line-height: 1.6; }
+                .button { display: inline-block; background: #A3B1C6; color: white; padding: 12px 30px; border-radius: 15px; text-decoration: none; margin-top: 20px; }'''
+
+PAGE = '''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <style>{style}
+            </style>
+        </head>
+        <body>
+            <div class="container">{content}
+            </div>
+        </body>
+        </html>
+        '''
+
+TEMPLATES: Dict[str, Tuple[str, str]] = {
+    'welcome': ('Добро пожаловать! 🎉', '''
+                <h1>Добро пожаловать, {name}!</h1>
+                <p>Спасибо за регистрацию в нашей системе. Мы рады видеть вас!</p>
+                <p>Теперь вы можете воспользоваться всеми возможностями платформы.</p>
+                <a href="{app_url}" class="button">Перейти в приложение</a>'''),
+    'password_reset': ('Восстановление пароля 🔐', '''
+                <h1>Восстановление пароля</h1>
+                <p>Вы запросили восстановление пароля. Нажмите кнопку ниже, чтобы создать новый пароль:</p>
+                <a href="{reset_url}?token={reset_token}" class="button">Восстановить пароль</a>
+                <p style="margin-top: 30px; font-size: 14px;">Ссылка действительна в течение 1 часа.</p>
+                <p style="font-size: 14px; color: #A0AEC0;">Если вы не запрашивали восстановление пароля, просто проигнорируйте это письмо.</p>'''),
+    'password_reset_unknown': ('Восстановление пароля 🔐', '''
+                <h1>Восстановление пароля</h1>
+                <p>Кто-то запросил восстановление пароля для этого адреса, но аккаунта с ним у нас нет.</p>
+                <p>Если это были вы, возможно, вы регистрировались с другим адресом.</p>
+                <a href="{app_url}" class="button">Перейти в приложение</a>
+                <p style="font-size: 14px; color: #A0AEC0;">Если вы ничего не запрашивали, просто проигнорируйте это письмо.</p>'''),
+    'password_changed': ('Пароль изменен ✅', '''
+                <h1>Пароль успешно изменен</h1>
+                <p>Ваш пароль был успешно изменен.</p>
+                <p style="margin-top: 20px; font-size: 14px; color: #A0AEC0;">Если это были не вы, немедленно свяжитесь с поддержкой.</p>'''),
+}
+
+DEFAULTS = {'name': 'друг', 'app_url': '', 'reset_url': '', 'reset_token': ''}
+
+def render(email_type: str, data: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    '''(subject, html) for a known template, otherwise None.'''
+    template = TEMPLATES.get(email_type)
+    if template is None:
+        return None
+    subject, content = template
+    values = {key: html.escape(str(data.get(key) or default)) for key, default in DEFAULTS.items()}
+    return subject, PAGE.format(style=STYLE, content=content.format(**values))
+
+@timed('smtp')
+def send_email(to_email: str, subject: str, html_content: str) -> bool:
+    smtp_host = os.environ.get('SMTP_HOST', 'smtp.gmail.com')
+    smtp_port = int(os.environ.get('SMTP_PORT', '587'))
+    smtp_user = os.environ.get('SMTP_USER', '')
+    smtp_password = os.environ.get('SMTP_PASSWORD', '')
+    
+    if not smtp_user or not smtp_password:
+        return False
+    
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = subject
+    msg['From'] = smtp_user
+    msg['To'] = to_email
+    
+    html_part = MIMEText(html_content, 'html')
+    msg.attach(html_part)
+    
+    with smtplib.SMTP(smtp_host, smtp_port, timeout=SMTP_TIMEOUT) as server:
+        server.starttls()
+        server.login(smtp_user, smtp_password)
+        server.send_message(msg)
+    
+    return True
+
+def send_template(email_type: str, to_email: str, data: Dict[str, Any]) -> bool:
+    rendered = render(email_type, data)
+    if rendered is None:
+        raise ValueError(f'Unknown email type {email_type}')
+    if not send_email(to_email, *rendered):
+        print(f'{email_type} email to {to_email} not sent: SMTP_USER/SMTP_PASSWORD not configured')
+        return False
+    return True
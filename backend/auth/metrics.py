@@ -0,0 +1,209 @@
+'''
+Per-request instrumentation shared by all functions (each function directory
+carries its own copy because functions are deployed independently).
+
+Every request gets its total duration measured; a sampled share of requests
+(METRICS_SAMPLE_RATE) also records phase timings: DB connect, each query,
+JWT sign/verify, hashing and outbound HTTP/SMTP/OpenAI calls. Records are
+printed as one JSON line and optionally exported to StatsD
+(METRICS_STATSD_ADDR=host:port) or kept for a Prometheus text exposition.
+'''
+import json
+import os
+import random
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+from typing import Dict, Any, Callable, Iterator, List, Optional, Tuple
+
+SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', '0.1'))
+SLOW_REQUEST_MS = float(os.environ.get('METRICS_SLOW_REQUEST_MS', '1000'))
+STATSD_ADDR = os.environ.get('METRICS_STATSD_ADDR', '')
+STATSD_PREFIX = os.environ.get('METRICS_STATSD_PREFIX', 'backend')
+PROMETHEUS_ENABLED = os.environ.get('METRICS_PROMETHEUS', 'false').lower() == 'true'
+
+HISTOGRAM_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_local = threading.local()
+_prometheus_lock = threading.Lock()
+_request_histograms: Dict[Tuple[str, str, str], List[float]] = {}
+_phase_totals: Dict[Tuple[str, str], List[float]] = {}
+_statsd_socket: Optional[socket.socket] = None
+_statsd_target: Optional[Tuple[str, int]] = None
+
+if STATSD_ADDR:
+    host, _, port = STATSD_ADDR.rpartition(':')
+    _statsd_target = (host or '127.0.0.1', int(port))
+    _statsd_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    _statsd_socket.setblocking(False)
+
+def current_record() -> Optional[Dict[str, Any]]:
+    return getattr(_local, 'record', None)
+
+@contextmanager
+def phase(name: str, detail: str = '') -> Iterator[None]:
+    '''Times the enclosed block as phase name when the current request is sampled; a no-op otherwise.'''
+    record = getattr(_local, 'record', None)
+    if record is None:
+        yield
+        return
+    
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        totals = record['phases'].setdefault(name, [0, 0.0])
+        totals[0] += 1
+        totals[1] += elapsed_ms
+        if detail:
+            record['details'].append((name, detail, round(elapsed_ms, 2)))
+
+def timed(name: str) -> Callable:
+    '''Decorator form of phase() for helpers such as generate_jwt or hash_password.'''
+    def decorator(func: Callable) -> Callable:
+        @wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            if getattr(_local, 'record', None) is None:
+                return func(*args, **kwargs)
+            with phase(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def instrument(handler: Callable) -> Callable:
+    '''Wraps a function's handler(event, context) with request timing and phase collection.'''
+    @wraps(handler)
+    def wrapper(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        sampled = SAMPLE_RATE >= 1 or (SAMPLE_RATE > 0 and random.random() < SAMPLE_RATE)
+        _local.record = {'phases': {}, 'details': []} if sampled else None
+        started = time.perf_counter()
+        status = 500
+        
+        try:
+            response = handler(event, context)
+            status = response.get('statusCode', 200)
+            return response
+        finally:
+            duration_ms = (time.perf_counter() - started) * 1000
+            record = _local.record
+            _local.record = None
+            
+            if sampled or duration_ms >= SLOW_REQUEST_MS:
+                emit(event, context, status, duration_ms, record)
+            if PROMETHEUS_ENABLED:
+                observe(event, context, status, duration_ms, record)
+    
+    return wrapper
+
+def emit(
+    event: Dict[str, Any],
+    context: Any,
+    status: int,
+    duration_ms: float,
+    record: Optional[Dict[str, Any]]
+):
+    function_name = getattr(context, 'function_name', '') or ''
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    line: Dict[str, Any] = {
+        'event': 'request_metrics',
+        'request_id': getattr(context, 'request_id', None),
+        'function_name': function_name,
+        'method': event.get('httpMethod', ''),
+        'action': action,
+        'status': status,
+        'duration_ms': round(duration_ms, 2),
+        'sampled': record is not None
+    }
+    if record is not None:
+        line['phases'] = {
+            name: {'count': totals[0], 'ms': round(totals[1], 2)}
+            for name, totals in record['phases'].items()
+        }
+        if record['details']:
+            line['details'] = record['details']
+    
+    print(json.dumps(line))
+    
+    if _statsd_socket is not None and record is not None:
+        send_statsd(function_name, action or 'none', status, duration_ms, record)
+
+def send_statsd(function_name: str, action: str, status: int, duration_ms: float, record: Dict[str, Any]):
+    base = f"{STATSD_PREFIX}.{function_name.replace('-', '_')}.{action.replace('-', '_')}"
+    rate = f'|@{SAMPLE_RATE}' if SAMPLE_RATE < 1 else ''
+    lines = [
+        f'{base}.duration_ms:{duration_ms:.2f}|ms{rate}',
+        f'{base}.status_{status}:1|c{rate}'
+    ]
+    for name, totals in record['phases'].items():
+        lines.append(f'{base}.phase.{name}:{totals[1]:.2f}|ms{rate}')
+    
+    try:
+        _statsd_socket.sendto('\n'.join(lines).encode(), _statsd_target)
+    except OSError:
+        pass
+
+def observe(
+    event: Dict[str, Any],
+    context: Any,
+    status: int,
+    duration_ms: float,
+    record: Optional[Dict[str, Any]]
+):
+    function_name = getattr(context, 'function_name', '') or ''
+    action = (event.get('queryStringParameters') or {}).get('action', '')
+    key = (function_name, action, str(status))
+    
+    with _prometheus_lock:
+        histogram = _request_histograms.get(key)
+        if histogram is None:
+            # bucket counts..., +Inf count, sum
+            histogram = _request_histograms[key] = [0.0] * (len(HISTOGRAM_BUCKETS_MS) + 2)
+        for index, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+            if duration_ms <= bound:
+                histogram[index] += 1
+        histogram[-2] += 1
+        histogram[-1] += duration_ms
+        
+        if record is not None:
+            for name, totals in record['phases'].items():
+                phase_totals = _phase_totals.setdefault((function_name, name), [0.0, 0.0])
+                phase_totals[0] += totals[0]
+                phase_totals[1] += totals[1]
+
+def render_prometheus() -> str:
+    '''Prometheus text exposition of everything observed by this instance so far.'''
+    lines = [
+        '# TYPE request_duration_ms histogram'
+    ]
+    with _prometheus_lock:
+        for (function_name, action, status), histogram in sorted(_request_histograms.items()):
+            labels = f'function="{function_name}",action="{action}",status="{status}"'
+            for index, bound in enumerate(HISTOGRAM_BUCKETS_MS):
+                lines.append(f'request_duration_ms_bucket{{{labels},le="{bound}"}} {int(histogram[index])}')
+            lines.append(f'request_duration_ms_bucket{{{labels},le="+Inf"}} {int(histogram[-2])}')
+            lines.append(f'request_duration_ms_count{{{labels}}} {int(histogram[-2])}')
+            lines.append(f'request_duration_ms_sum{{{labels}}} {histogram[-1]:.3f}')
+        
+        lines.append('# TYPE phase_duration_ms summary')
+        for (function_name, name), totals in sorted(_phase_totals.items()):
+            labels = f'function="{function_name}",phase="{name}"'
+            lines.append(f'phase_duration_ms_count{{{labels}}} {int(totals[0])}')
+            lines.append(f'phase_duration_ms_sum{{{labels}}} {totals[1]:.3f}')
+    
+    return '\n'.join(lines) + '\n'
+
+try:
+    import psycopg2.extensions
+    
+    class TimedCursor(psycopg2.extensions.cursor):
+        '''Cursor that records every execute() as a "query" phase with the statement's first words.'''
+        def execute(self, query: Any, vars: Any = None) -> Any:
+            if getattr(_local, 'record', None) is None:
+                return super().execute(query, vars)
+            with phase('query', ' '.join(str(query).split()[:6])):
+                return super().execute(query, vars)
+except ImportError:
+    TimedCursor = None
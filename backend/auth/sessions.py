@@ -0,0 +1,134 @@
+'''
+Server-side login sessions behind short-lived access tokens (each function
+directory carries its own copy because functions are deployed independently).
+
+A login creates an auth_sessions row. The client gets an access JWT carrying the
+session id (sid), valid for ACCESS_TOKEN_TTL seconds, and an opaque refresh
+token "<sid>.<secret>" of which only the SHA-256 is stored. Every refresh
+rotates the secret; presenting an already rotated secret revokes the session,
+since it means the token was copied.
+
+Revocation is checked without a query per request: each instance keeps the ids
+of sessions revoked within the last ACCESS_TOKEN_TTL seconds (older revocations
+cannot have a live access token left) and reloads that small set every
+REVOCATION_REFRESH_SECONDS.
+
+Access tokens issued before sessions existed carry no sid and so cannot be
+revoked. is_legacy_token() still accepts them until their own exp, which was at
+most LEGACY_TOKEN_MAX_AGE after issue, so the upgrade does not sign everyone
+out; nothing issues them any more. ACCEPT_LEGACY_TOKENS=false refuses them.
+'''
+import hashlib
+import hmac
+import os
+import secrets
+import threading
+import time
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Tuple
+
+from db import read_connection, release, statement, execute
+
+INSERT_SESSION = statement('session_insert', "INSERT INTO auth_sessions (user_id, refresh_token_hash, ip_address, user_agent, expires_at) VALUES (%s, %s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second') RETURNING id")
+SELECT_SESSION_FOR_REFRESH = statement('session_select_for_refresh', "SELECT s.user_id, d.email, s.refresh_token_hash, s.previous_token_hash, s.revoked_at IS NOT NULL, s.expires_at < CURRENT_TIMESTAMP FROM auth_sessions s JOIN user_directory d ON d.id = s.user_id WHERE s.id = %s FOR UPDATE OF s")
+ROTATE_SESSION = statement('session_rotate', "UPDATE auth_sessions SET previous_token_hash = refresh_token_hash, refresh_token_hash = %s, refreshed_at = CURRENT_TIMESTAMP WHERE id = %s")
+REVOKE_SESSION = statement('session_revoke', "UPDATE auth_sessions SET revoked_at = CURRENT_TIMESTAMP, revoked_reason = %s WHERE id = %s AND revoked_at IS NULL RETURNING id")
+REVOKE_USER_SESSIONS = statement('session_revoke_user', "UPDATE auth_sessions SET revoked_at = CURRENT_TIMESTAMP, revoked_reason = %s WHERE user_id = %s AND revoked_at IS NULL RETURNING id")
+SELECT_RECENT_REVOCATIONS = statement('session_recent_revocations', "SELECT id FROM auth_sessions WHERE revoked_at > CURRENT_TIMESTAMP - %s * INTERVAL '1 second'")
+
+ACCESS_TOKEN_TTL = int(os.environ.get('ACCESS_TOKEN_TTL', '900'))
+REFRESH_TOKEN_TTL = int(os.environ.get('REFRESH_TOKEN_TTL', str(86400 * 30)))
+REVOCATION_REFRESH_SECONDS = float(os.environ.get('REVOCATION_REFRESH_SECONDS', '15'))
+ACCEPT_LEGACY_TOKENS = os.environ.get('ACCEPT_LEGACY_TOKENS', 'true').lower() == 'true'
+# Lifetime of the access tokens issued before sessions.
+LEGACY_TOKEN_MAX_AGE = 86400 * 7
+
+_revoked: FrozenSet[int] = frozenset()
+_next_refresh = 0.0
+_refresh_lock = threading.Lock()
+
+def hash_secret(secret: str) -> str:
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+def create_session(cur: Any, user_id: int, ip_address: str = '', user_agent: str = '') -> Tuple[int, str]:
+    '''Inserts a session for user_id and returns (session_id, refresh_token); the caller commits.'''
+    secret = secrets.token_urlsafe(32)
+    execute(cur, INSERT_SESSION, (user_id, hash_secret(secret), ip_address[:45] or None, user_agent or None, REFRESH_TOKEN_TTL))
+    session_id = cur.fetchone()[0]
+    return session_id, f'{session_id}.{secret}'
+
+def rotate_session(cur: Any, refresh_token: str) -> Optional[Tuple[int, int, str, str]]:
+    '''
+    Swaps the refresh token's secret for a new one and returns
+    (session_id, user_id, email, new_refresh_token), or None when the token is
+    unknown, expired or revoked (disabling a user revokes its sessions). Reuse
+    of the previous secret revokes the session. The caller commits.
+    '''
+    session_part, _, secret = refresh_token.partition('.')
+    if not session_part.isdigit() or not secret:
+        return None
+    
+    execute(cur, SELECT_SESSION_FOR_REFRESH, (int(session_part),))
+    session = cur.fetchone()
+    if not session or session[4] or session[5]:
+        return None
+    
+    session_id = int(session_part)
+    presented = hash_secret(secret)
+    if session[3] and hmac.compare_digest(presented, session[3]):
+        revoke_session(cur, session_id, 'refresh_token_reuse')
+        return None
+    if not hmac.compare_digest(presented, session[2]):
+        return None
+    
+    new_secret = secrets.token_urlsafe(32)
+    execute(cur, ROTATE_SESSION, (hash_secret(new_secret), session_id))
+    return session_id, session[0], session[1], f'{session_id}.{new_secret}'
+
+def revoke_session(cur: Any, session_id: int, reason: str) -> bool:
+    execute(cur, REVOKE_SESSION, (reason, session_id))
+    return cur.fetchone() is not None
+
+def revoke_user_sessions(cur: Any, user_id: int, reason: str) -> Tuple[int, ...]:
+    '''Revokes every open session of user_id and returns their ids; the caller commits.'''
+    execute(cur, REVOKE_USER_SESSIONS, (reason, user_id))
+    return tuple(row[0] for row in cur.fetchall())
+
+def note_revoked(session_ids: Iterable[int]):
+    '''Applies committed revocations to this instance at once instead of at the next reload.'''
+    global _revoked
+    with _refresh_lock:
+        _revoked = _revoked | frozenset(session_ids)
+
+def refresh_revocations():
+    global _revoked, _next_refresh
+    if not _refresh_lock.acquire(blocking=False):
+        # Another thread is reloading; the current set is at most one interval old.
+        return
+    try:
+        if time.monotonic() < _next_refresh:
+            return
+        _next_refresh = time.monotonic() + REVOCATION_REFRESH_SECONDS
+        conn = read_connection()
+        try:
+            cur = conn.cursor()
+            execute(cur, SELECT_RECENT_REVOCATIONS, (ACCESS_TOKEN_TTL + REVOCATION_REFRESH_SECONDS,))
+            _revoked = frozenset(row[0] for row in cur.fetchall())
+            cur.close()
+        finally:
+            release(conn)
+    except Exception as exc:
+        # Keep the previous set; the next interval retries.
+        print(f'revocation refresh failed: {exc}')
+    finally:
+        _refresh_lock.release()
+
+def is_legacy_token(payload: Dict[str, Any]) -> bool:
+    '''A verified, unexpired access token from before sessions: no sid, so no revocation check applies.'''
+    if not ACCEPT_LEGACY_TOKENS or 'sid' in payload or 'user_id' not in payload:
+        return False
+    return payload.get('exp', 0) <= time.time() + LEGACY_TOKEN_MAX_AGE
+
+def is_revoked(session_id: Any) -> bool:
+    if time.monotonic() >= _next_refresh:
+        refresh_revocations()
+    return session_id in _revoked
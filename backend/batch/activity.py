@@ -0,0 +1,81 @@
+'''
+Activity logging and hourly/daily rollups shared by the auth, oauth, two-factor,
+admin and batch functions (each function directory carries its own copy because
+functions are deployed independently).
+
+log_activity() appends one user_activity_log row in the caller's transaction.
+
+rollup() folds the rows logged since the watermark in activity_rollup_state
+into activity_rollup_hourly and activity_rollup_daily (events per bucket and
+action), in batches of ACTIVITY_ROLLUP_BATCH rows, and advances the watermark in
+the same transaction, so a run that fails is simply repeated. Rows younger than
+ACTIVITY_ROLLUP_SETTLE_SECONDS are left for the next run: ids are handed out at
+insert but become visible at commit, and the settle time keeps a slow
+transaction's row from landing behind the watermark. Run it every minute with
+tools/rollup_activity.py or the admin rollup action. Time-series reads then
+touch one rollup row per bucket instead of the raw log.
+'''
+import os
+from datetime import datetime
+from typing import Dict, Any, Optional
+from db import statement, execute
+
+# Actions written by the functions; the admin timeseries action reports these.
+ACTIONS = ('register', 'login', 'login_failed', 'oauth_login', 'password_reset', '2fa_verified', '2fa_failed')
+
+ROLLUP_BATCH = int(os.environ.get('ACTIVITY_ROLLUP_BATCH', '50000'))
+ROLLUP_SETTLE_SECONDS = int(os.environ.get('ACTIVITY_ROLLUP_SETTLE_SECONDS', '60'))
+
+INSERT_ACTIVITY = statement('activity_insert', "INSERT INTO user_activity_log (user_id, action, ip_address, user_agent) VALUES (%s, %s, %s, %s)")
+LOCK_WATERMARK = statement('activity_lock_watermark', "SELECT last_id, last_created_at FROM activity_rollup_state WHERE id = TRUE FOR UPDATE")
+# The next ACTIVITY_ROLLUP_BATCH rows past the watermark, cut before the first
+# one that has not settled yet.
+NEXT_BATCH_END = statement('activity_next_batch_end', """
+    WITH batch AS (
+        SELECT id, created_at FROM user_activity_log WHERE id > %s ORDER BY id LIMIT %s
+    )
+    SELECT MAX(id), MAX(created_at) FROM batch
+    WHERE id < COALESCE((SELECT MIN(id) FROM batch WHERE created_at >= LOCALTIMESTAMP - make_interval(secs => %s)), 2147483647)
+""")
+ROLLUP_HOURLY = statement('activity_rollup_hourly', """
+    INSERT INTO activity_rollup_hourly (bucket, action, events)
+    SELECT date_trunc('hour', created_at), action, COUNT(*) FROM user_activity_log
+    WHERE id > %s AND id <= %s GROUP BY 1, 2
+    ON CONFLICT (action, bucket) DO UPDATE SET events = activity_rollup_hourly.events + EXCLUDED.events
+""")
+ROLLUP_DAILY = statement('activity_rollup_daily', """
+    INSERT INTO activity_rollup_daily (bucket, action, events)
+    SELECT created_at::date, action, COUNT(*) FROM user_activity_log
+    WHERE id > %s AND id <= %s GROUP BY 1, 2
+    ON CONFLICT (action, bucket) DO UPDATE SET events = activity_rollup_daily.events + EXCLUDED.events
+""")
+ADVANCE_WATERMARK = statement('activity_advance_watermark', "UPDATE activity_rollup_state SET last_id = %s, last_created_at = %s, updated_at = CURRENT_TIMESTAMP WHERE id = TRUE")
+
+def log_activity(cur: Any, user_id: Optional[int], action: str, source_ip: str = '', user_agent: str = ''):
+    execute(cur, INSERT_ACTIVITY, (user_id, action, source_ip[:45] or None, user_agent or None))
+
+def rollup(conn: Any, max_batches: int = 1000) -> Dict[str, Any]:
+    '''Aggregates settled log rows past the watermark; returns {batches, last_id, last_created_at}.'''
+    cur = conn.cursor()
+    batches = 0
+    last_id = 0
+    last_created_at: Optional[datetime] = None
+    
+    while batches < max_batches:
+        execute(cur, LOCK_WATERMARK)
+        last_id, last_created_at = cur.fetchone()
+        execute(cur, NEXT_BATCH_END, (last_id, ROLLUP_BATCH, ROLLUP_SETTLE_SECONDS))
+        upper, upper_created_at = cur.fetchone()
+        if upper is None:
+            conn.rollback()
+            break
+        
+        execute(cur, ROLLUP_HOURLY, (last_id, upper))
+        execute(cur, ROLLUP_DAILY, (last_id, upper))
+        execute(cur, ADVANCE_WATERMARK, (upper, upper_created_at))
+        conn.commit()
+        last_id, last_created_at = upper, upper_created_at
+        batches += 1
+    
+    cur.close()
+    return {'batches': batches, 'last_id': last_id, 'last_created_at': last_created_at.isoformat() if last_created_at else None}
@@ -0,0 +1,93 @@
+'''
+Business: Batch reads - run several read-only actions of the other functions in one request
+Args: event - dict with httpMethod, body, queryStringParameters
+      context - object with attributes: request_id, function_name
+Returns: HTTP response dict with one {status, body} result per sub-request, in order
+'''
+from typing import Dict, Any, List, Optional
+import psycopg2
+from metrics import instrument, timed
+from jwt_keys import decode_jwt
+from db import shard_read_connection, release
+from router import Router, Request, HTTPError, respond, error
+from reads import READERS, Reads
+import last_seen
+from sessions import is_legacy_token, is_revoked
+
+MAX_SUB_REQUESTS = 20
+
+@timed('jwt_verify')
+def verify_jwt(token: str) -> Optional[Dict[str, Any]]:
+    return decode_jwt(token)
+
+def authenticate(request: Request) -> Dict[str, Any]:
+    auth_header = request.header('x-auth-token')
+    
+    if not auth_header:
+        raise HTTPError(401, 'No token provided')
+    
+    payload = verify_jwt(auth_header)
+    if not payload or not ('sid' in payload or is_legacy_token(payload)):
+        raise HTTPError(401, 'Invalid token')
+    
+    if 'sid' in payload and is_revoked(payload['sid']):
+        raise HTTPError(401, 'Session revoked')
+    
+    last_seen.seen(payload['user_id'])
+    return payload
+
+def query_params(body: Dict[str, Any]) -> Dict[str, str]:
+    '''A sub-request's body as the query string parameters its function would have received.'''
+    return {name: str(value) for name, value in body.items() if value is not None}
+
+def run_one(reads: Reads, sub_request: Any) -> Dict[str, Any]:
+    '''Result of one sub-request; failures become its own status instead of failing the batch.'''
+    if not isinstance(sub_request, dict):
+        return {'status': 400, 'body': {'error': 'Sub-request must be an object'}}
+    
+    entry = READERS.get((sub_request.get('function'), sub_request.get('action')))
+    if entry is None:
+        return {'status': 404, 'body': {'error': 'Unknown or non-batchable action'}}
+    
+    func, admin_only = entry
+    body = sub_request.get('body') or {}
+    try:
+        if not isinstance(body, dict):
+            raise HTTPError(400, 'body must be an object')
+        if admin_only and reads.role != 'admin':
+            raise HTTPError(403, 'Admin access required')
+        return {'status': 200, 'body': func(reads, query_params(body))}
+    except HTTPError as http_error:
+        return {'status': http_error.status_code, 'body': dict({'error': http_error.message}, **http_error.extra)}
+    except psycopg2.Error as exc:
+        # An aborted transaction would fail every later sub-request too.
+        reads.conn.rollback()
+        print(f"batch {sub_request.get('function')}/{sub_request.get('action')} failed: {exc}")
+        return {'status': 500, 'body': {'error': 'Database error'}}
+
+router = Router('POST, OPTIONS', 'Content-Type, X-Auth-Token, X-Min-LSN', authenticate, finish=last_seen.flush_due)
+
+@router.route('POST', auth=True)
+def batch(request: Request) -> Dict[str, Any]:
+    sub_requests = request.body.get('requests')
+    if not isinstance(sub_requests, list) or not sub_requests:
+        return error(400, 'requests must be a non-empty list')
+    if len(sub_requests) > MAX_SUB_REQUESTS:
+        return error(400, f'At most {MAX_SUB_REQUESTS} requests per batch')
+    
+    # The sub-requests are answered by the functions' own readers (reads.py), in
+    # order, over one connection to the caller's shard; the token was checked
+    # once by authenticate and the role is looked up at most once.
+    user_id = request.user['user_id']
+    conn = shard_read_connection(user_id, request.header('x-min-lsn'))
+    try:
+        reads = Reads(user_id, conn, request.header('x-min-lsn'))
+        results: List[Dict[str, Any]] = [run_one(reads, sub_request) for sub_request in sub_requests]
+    finally:
+        release(conn)
+    
+    return respond(200, {'results': results})
+
+@instrument
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return router.dispatch(event, context)
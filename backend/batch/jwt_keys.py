@@ -0,0 +1,250 @@
+'''
+JWT signing and verification with a key ring (each function directory carries
+its own copy because functions are deployed independently).
+
+Asymmetric mode: the issuing functions (auth, oauth) get a private key in
+JWT_SIGNING_KEY (PEM; Ed25519 signs EdDSA, RSA signs RS256) and a key id in
+JWT_SIGNING_KID. Verifiers only get public keys: JWT_JWKS holds a JWKS document
+inline, a file path or an http(s) URL such as the auth function's
+?action=jwks. The document is loaded once per instance and cached; an unknown
+kid triggers a reload (at most every JWKS_MIN_RELOAD_SECONDS), so during a
+rotation the new public key is published first, then the signer switches kid,
+and the old key is dropped once tokens signed with it have expired.
+
+HMAC mode: without a signing key or JWKS, tokens are HS256 with JWT_SECRET_KEY
+as before. Once a key ring is configured, HS256 is only accepted while
+JWT_SECRET_KEY is still set, which allows an overlap window for the switch.
+
+There is no built-in fallback key: a function with no key material configured
+refuses to sign (encode_jwt raises) and rejects every token.
+
+The "cryptography" package is needed for the asymmetric algorithms only.
+'''
+import base64
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import urllib.request
+from typing import Dict, Any, Callable, List, Optional, Tuple
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ed25519, padding, rsa
+except ImportError:
+    InvalidSignature = None
+
+SIGNING_KEY = os.environ.get('JWT_SIGNING_KEY', '')
+SIGNING_KID = os.environ.get('JWT_SIGNING_KID', '')
+JWKS_SOURCE = os.environ.get('JWT_JWKS', '')
+JWKS_CACHE_SECONDS = float(os.environ.get('JWKS_CACHE_SECONDS', '3600'))
+JWKS_MIN_RELOAD_SECONDS = float(os.environ.get('JWKS_MIN_RELOAD_SECONDS', '60'))
+HMAC_SECRET = os.environ.get('JWT_SECRET_KEY', '')
+HMAC_ENABLED = bool(HMAC_SECRET)
+
+if not (SIGNING_KEY or JWKS_SOURCE or HMAC_SECRET):
+    print('JWT keys not configured (JWT_SIGNING_KEY, JWT_JWKS or JWT_SECRET_KEY): tokens can be neither issued nor verified')
+
+Verifier = Callable[[bytes, bytes], bool]
+
+def b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+def require_cryptography():
+    if InvalidSignature is None:
+        raise RuntimeError('the cryptography package is required for EdDSA/RS256 JWT keys')
+
+class Signer:
+    '''Signs with one key; header is the pre-encoded JOSE header shared by all its tokens.'''
+    def __init__(self, alg: str, kid: str, sign: Callable[[bytes], bytes], public_jwk: Optional[Dict[str, Any]] = None):
+        self.alg = alg
+        self.kid = kid
+        self.sign = sign
+        self.public_jwk = public_jwk
+        fields = {'alg': alg, 'typ': 'JWT'}
+        if kid:
+            fields['kid'] = kid
+        self.header = b64url_encode(json.dumps(fields, separators=(',', ':')).encode())
+
+def hmac_signer(secret: str) -> Signer:
+    key = secret.encode()
+    return Signer('HS256', '', lambda data: hmac.new(key, data, hashlib.sha256).digest())
+
+def hmac_verifier(secret: str) -> Verifier:
+    key = secret.encode()
+    return lambda data, signature: hmac.compare_digest(hmac.new(key, data, hashlib.sha256).digest(), signature)
+
+def private_key_signer(pem: str, kid: str) -> Signer:
+    require_cryptography()
+    private_key = serialization.load_pem_private_key(pem.encode(), password=None)
+    public_key = private_key.public_key()
+    
+    if isinstance(private_key, ed25519.Ed25519PrivateKey):
+        raw = public_key.public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+        jwk = {'kty': 'OKP', 'crv': 'Ed25519', 'x': b64url_encode(raw), 'alg': 'EdDSA', 'use': 'sig', 'kid': kid}
+        return Signer('EdDSA', kid, private_key.sign, jwk)
+    
+    if isinstance(private_key, rsa.RSAPrivateKey):
+        numbers = public_key.public_numbers()
+        jwk = {
+            'kty': 'RSA',
+            'n': b64url_encode(numbers.n.to_bytes((numbers.n.bit_length() + 7) // 8, 'big')),
+            'e': b64url_encode(numbers.e.to_bytes((numbers.e.bit_length() + 7) // 8, 'big')),
+            'alg': 'RS256',
+            'use': 'sig',
+            'kid': kid
+        }
+        return Signer('RS256', kid, lambda data: private_key.sign(data, padding.PKCS1v15(), hashes.SHA256()), jwk)
+    
+    raise ValueError('JWT signing key must be Ed25519 or RSA')
+
+def jwk_verifier(jwk: Dict[str, Any]) -> Tuple[str, Verifier]:
+    '''Returns (alg, verify) for one public JWK.'''
+    require_cryptography()
+    
+    if jwk.get('kty') == 'OKP' and jwk.get('crv') == 'Ed25519':
+        public_key = ed25519.Ed25519PublicKey.from_public_bytes(b64url_decode(jwk['x']))
+        
+        def verify(data: bytes, signature: bytes) -> bool:
+            try:
+                public_key.verify(signature, data)
+                return True
+            except InvalidSignature:
+                return False
+        return 'EdDSA', verify
+    
+    if jwk.get('kty') == 'RSA':
+        public_key = rsa.RSAPublicNumbers(
+            int.from_bytes(b64url_decode(jwk['e']), 'big'),
+            int.from_bytes(b64url_decode(jwk['n']), 'big')
+        ).public_key()
+        
+        def verify(data: bytes, signature: bytes) -> bool:
+            try:
+                public_key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+                return True
+            except InvalidSignature:
+                return False
+        return 'RS256', verify
+    
+    raise ValueError(f"unsupported JWK kty={jwk.get('kty')} crv={jwk.get('crv')}")
+
+def read_source(source: str) -> str:
+    if source.lstrip().startswith('{'):
+        return source
+    if source.startswith(('http://', 'https://')):
+        with urllib.request.urlopen(source, timeout=5) as response:
+            return response.read().decode()
+    with open(source) as f:
+        return f.read()
+
+def read_signing_key() -> Optional[Signer]:
+    if not SIGNING_KEY:
+        return None
+    pem = SIGNING_KEY
+    if not pem.lstrip().startswith('-----'):
+        with open(pem) as f:
+            pem = f.read()
+    return private_key_signer(pem, SIGNING_KID)
+
+# None in verifier-only functions, which are configured with public keys alone.
+signer: Optional[Signer] = read_signing_key() or (hmac_signer(HMAC_SECRET) if HMAC_ENABLED else None)
+own_jwk: Optional[Dict[str, Any]] = signer.public_jwk if signer is not None else None
+
+class KeyRing:
+    '''kid -> (alg, verify) from the JWKS document plus this function's own signing key.'''
+    def __init__(self):
+        self.keys: Dict[str, Tuple[str, Verifier]] = {}
+        self.jwks: List[Dict[str, Any]] = []
+        self.loaded_at = float('-inf')
+        self.lock = threading.Lock()
+    
+    def load(self):
+        jwks = [own_jwk] if own_jwk is not None else []
+        if JWKS_SOURCE:
+            jwks.extend(
+                jwk for jwk in json.loads(read_source(JWKS_SOURCE)).get('keys', [])
+                if own_jwk is None or jwk.get('kid') != own_jwk['kid']
+            )
+        self.keys = {jwk.get('kid', ''): jwk_verifier(jwk) for jwk in jwks}
+        self.jwks = jwks
+    
+    def reload(self, seen_loaded_at: float):
+        with self.lock:
+            if self.loaded_at != seen_loaded_at:
+                # Another thread reloaded while this one waited.
+                return
+            try:
+                self.load()
+            except Exception as exc:
+                # Keep serving the cached keys; retry after the minimum interval.
+                print(f'JWKS load failed: {exc}')
+            self.loaded_at = time.monotonic()
+    
+    def get(self, kid: str) -> Optional[Tuple[str, Verifier]]:
+        loaded_at = self.loaded_at
+        age = time.monotonic() - loaded_at
+        entry = self.keys.get(kid)
+        if age < JWKS_CACHE_SECONDS and (entry is not None or age < JWKS_MIN_RELOAD_SECONDS):
+            return entry
+        self.reload(loaded_at)
+        return self.keys.get(kid)
+
+key_ring = KeyRing()
+hmac_verify: Optional[Verifier] = hmac_verifier(HMAC_SECRET) if HMAC_ENABLED else None
+
+def encode_jwt(payload: Dict[str, Any]) -> str:
+    if signer is None:
+        raise RuntimeError('No JWT signing key is configured for this function (JWT_SIGNING_KEY or JWT_SECRET_KEY)')
+    body = b64url_encode(json.dumps(payload, separators=(',', ':')).encode())
+    signing_input = f'{signer.header}.{body}'
+    return f'{signing_input}.{b64url_encode(signer.sign(signing_input.encode()))}'
+
+def decode_jwt(token: str) -> Optional[Dict[str, Any]]:
+    '''Returns the payload of a correctly signed, unexpired token, otherwise None.'''
+    parts = token.split('.')
+    if len(parts) != 3:
+        return None
+    
+    header_part, payload_part, signature_part = parts
+    try:
+        header = json.loads(b64url_decode(header_part))
+        signature = b64url_decode(signature_part)
+    except ValueError:
+        return None
+    
+    if not isinstance(header, dict):
+        return None
+    
+    alg = header.get('alg')
+    if alg == 'HS256':
+        verify = hmac_verify
+    else:
+        entry = key_ring.get(str(header.get('kid', '')))
+        # The key decides the algorithm; a header naming another one is rejected.
+        verify = entry[1] if entry is not None and entry[0] == alg else None
+    
+    if verify is None or not verify(f'{header_part}.{payload_part}'.encode(), signature):
+        return None
+    
+    try:
+        payload = json.loads(b64url_decode(payload_part))
+    except ValueError:
+        return None
+    
+    if not isinstance(payload, dict) or payload.get('exp', 0) < time.time():
+        return None
+    
+    return payload
+
+def public_jwks() -> Dict[str, Any]:
+    '''The JWKS document to publish: this signer's public key plus the configured ring.'''
+    if time.monotonic() - key_ring.loaded_at >= JWKS_CACHE_SECONDS:
+        key_ring.reload(key_ring.loaded_at)
+    return {'keys': key_ring.jwks}
@@ -0,0 +1,272 @@
+'''
+Table-driven request routing shared by all functions (each function directory
+carries its own copy because functions are deployed independently).
+
+Routes are registered per (method, action) and looked up with one dict access,
+so unknown endpoints return 404 without running any handler code. The JSON
+body is parsed lazily at most once, and all responses go through respond(),
+which uses orjson when it is installed.
+
+Text responses of RESPONSE_COMPRESSION_MIN_BYTES or more are compressed with
+the best encoding the client accepts (zstd with zstandard installed, br with
+brotli installed, gzip always) and returned base64-encoded with
+isBase64Encoded, as the platform expects binary bodies. Compressed forms of
+responses marked Cache-Control: public are kept in an LRU keyed on the SHA-256
+of the body and capped at RESPONSE_COMPRESSION_CACHE_BYTES of compressed data,
+so repeated identical bodies (the JWKS, for example) are compressed once.
+tools/bench_compression.py measures bytes saved and CPU time per payload size.
+'''
+import base64
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Callable, Optional, Tuple
+from metrics import phase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+
+COMPRESSION_MIN_BYTES = int(os.environ.get('RESPONSE_COMPRESSION_MIN_BYTES', '1024'))
+COMPRESSION_CACHE_BYTES = int(os.environ.get('RESPONSE_COMPRESSION_CACHE_BYTES', str(4 * 1024 * 1024)))
+GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', '6'))
+BROTLI_QUALITY = int(os.environ.get('RESPONSE_BROTLI_QUALITY', '5'))
+ZSTD_LEVEL = int(os.environ.get('RESPONSE_ZSTD_LEVEL', '3'))
+# Larger bodies are still compressed, just not kept.
+COMPRESSION_CACHE_MAX_BYTES = COMPRESSION_CACHE_BYTES // 16
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+_zstd_local = threading.local()
+
+def zstd_compress(data: bytes) -> bytes:
+    # A compressor is not safe to share between threads but is worth reusing.
+    compressor = getattr(_zstd_local, 'compressor', None)
+    if compressor is None:
+        compressor = _zstd_local.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+    return compressor.compress(data)
+
+# Server preference, used when the client weighs several encodings the same.
+ENCODERS: Dict[str, Callable[[bytes], bytes]] = {}
+if zstandard is not None:
+    ENCODERS['zstd'] = zstd_compress
+if brotli is not None:
+    ENCODERS['br'] = lambda data: brotli.compress(data, quality=BROTLI_QUALITY)
+ENCODERS['gzip'] = lambda data: gzip.compress(data, GZIP_LEVEL, mtime=0)
+
+# (encoding, SHA-256 of the body) -> base64 of the compressed body
+_compressed: 'OrderedDict[Tuple[str, bytes], str]' = OrderedDict()
+_compressed_bytes = 0
+_compressed_lock = threading.Lock()
+
+def dumps(payload: Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(payload).decode()
+    return json.dumps(payload)
+
+class HTTPError(Exception):
+    '''Raised inside a route (or authenticate) to answer with {"error": message}.'''
+    def __init__(self, status_code: int, message: str, **extra: Any):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+        self.extra = extra
+
+class Request:
+    __slots__ = ('event', 'context', 'method', 'action', 'params', 'headers', 'user', '_body')
+    
+    def __init__(self, event: Dict[str, Any], context: Any):
+        self.event = event
+        self.context = context
+        self.method: str = event.get('httpMethod', 'GET')
+        self.params: Dict[str, str] = event.get('queryStringParameters') or {}
+        self.action: str = self.params.get('action', '')
+        self.headers: Dict[str, str] = event.get('headers') or {}
+        self.user: Optional[Dict[str, Any]] = None
+        self._body: Optional[Dict[str, Any]] = None
+    
+    @property
+    def body(self) -> Dict[str, Any]:
+        if self._body is None:
+            raw = self.event.get('body') or '{}'
+            try:
+                with phase('json_parse'):
+                    if self.event.get('isBase64Encoded'):
+                        raw = base64.b64decode(raw)
+                    parsed = orjson.loads(raw) if orjson is not None else json.loads(raw)
+            except (ValueError, TypeError):
+                raise HTTPError(400, 'Invalid JSON body')
+            if not isinstance(parsed, dict):
+                raise HTTPError(400, 'JSON body must be an object')
+            self._body = parsed
+        return self._body
+    
+    def header(self, name: str) -> str:
+        return self.headers.get(name.lower(), '')
+    
+    @property
+    def source_ip(self) -> str:
+        identity = (self.event.get('requestContext') or {}).get('identity') or {}
+        return identity.get('sourceIp', '')
+
+def respond(status_code: int, payload: Any, headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    response_headers = dict(JSON_HEADERS)
+    if headers:
+        response_headers.update(headers)
+    
+    with phase('json_encode'):
+        body = dumps(payload)
+    
+    return {
+        'statusCode': status_code,
+        'headers': response_headers,
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+def error(status_code: int, message: str, **extra: Any) -> Dict[str, Any]:
+    return respond(status_code, dict({'error': message}, **extra))
+
+def negotiate(accept_encoding: str) -> Optional[str]:
+    '''The encoding to use for an Accept-Encoding header value, or None for identity.'''
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(','):
+        name, _, parameters = part.partition(';')
+        weight = 1.0
+        parameter = parameters.strip()
+        if parameter.startswith('q='):
+            try:
+                weight = float(parameter[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip()] = weight
+    
+    best: Optional[str] = None
+    best_weight = 0.0
+    for encoding in ENCODERS:
+        weight = weights.get(encoding, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+def compress(response: Dict[str, Any], accept_encoding: str) -> Dict[str, Any]:
+    '''response with its body compressed for the client when that is worth it.'''
+    global _compressed_bytes
+    headers = response.get('headers') or {}
+    body = response.get('body')
+    if (
+        response.get('isBase64Encoded')
+        or not isinstance(body, str)
+        or 'Content-Encoding' in headers
+        or not headers.get('Content-Type', '').startswith(COMPRESSIBLE_TYPES)
+    ):
+        return response
+    # The thresholds are in bytes; non-ASCII text is longer than its len().
+    data = body.encode('utf-8')
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return response
+    
+    headers = dict(headers, Vary='Accept-Encoding')
+    encoding = negotiate(accept_encoding) if accept_encoding else None
+    if encoding is None:
+        return dict(response, headers=headers)
+    
+    cacheable = 'public' in headers.get('Cache-Control', '') and len(data) <= COMPRESSION_CACHE_MAX_BYTES
+    encoded = None
+    if cacheable:
+        key = (encoding, hashlib.sha256(data).digest())
+        with _compressed_lock:
+            encoded = _compressed.get(key)
+            if encoded is not None:
+                _compressed.move_to_end(key)
+    
+    if encoded is None:
+        with phase('compress', encoding):
+            encoded = base64.b64encode(ENCODERS[encoding](data)).decode()
+        if cacheable and len(encoded) <= COMPRESSION_CACHE_MAX_BYTES:
+            with _compressed_lock:
+                if key not in _compressed:
+                    _compressed[key] = encoded
+                    _compressed_bytes += len(encoded)
+                while _compressed_bytes > COMPRESSION_CACHE_BYTES:
+                    _compressed_bytes -= len(_compressed.popitem(last=False)[1])
+    
+    headers['Content-Encoding'] = encoding
+    return dict(response, headers=headers, body=encoded, isBase64Encoded=True)
+
+class Router:
+    def __init__(
+        self,
+        allow_methods: str,
+        allow_headers: str,
+        authenticate: Optional[Callable[[Request], Dict[str, Any]]] = None,
+        finish: Optional[Callable[[], Any]] = None
+    ):
+        self.routes: Dict[Tuple[str, str], Tuple[Callable[[Request], Dict[str, Any]], bool]] = {}
+        self.authenticate = authenticate
+        # Runs after every routed request, before its response is returned (e.g. last_seen.flush_due).
+        self.finish = finish
+        self.preflight = {
+            'statusCode': 200,
+            'headers': {
+                'Access-Control-Allow-Origin': '*',
+                'Access-Control-Allow-Methods': allow_methods,
+                'Access-Control-Allow-Headers': allow_headers,
+                'Access-Control-Max-Age': '86400'
+            },
+            'body': '',
+            'isBase64Encoded': False
+        }
+    
+    def route(self, method: str, action: str = '', auth: bool = False, idempotent: bool = False) -> Callable:
+        '''
+        Registers a route for (method, action); with auth=True the router's
+        authenticate callable runs first and its result is stored in request.user.
+        With idempotent=True requests carrying an Idempotency-Key header run once
+        per key (see idempotency.py, which the function must ship).
+        '''
+        def decorator(func: Callable[[Request], Dict[str, Any]]) -> Callable[[Request], Dict[str, Any]]:
+            handler = func
+            if idempotent:
+                from idempotency import idempotent as run_once
+                handler = run_once(func)
+            self.routes[(method, action)] = (handler, auth)
+            return func
+        return decorator
+    
+    def dispatch(self, event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+        method = event.get('httpMethod', 'GET')
+        if method == 'OPTIONS':
+            return dict(self.preflight, headers=dict(self.preflight['headers']))
+        
+        action = (event.get('queryStringParameters') or {}).get('action', '')
+        entry = self.routes.get((method, action))
+        if entry is None:
+            return error(404, 'Endpoint not found')
+        
+        func, needs_auth = entry
+        request = Request(event, context)
+        try:
+            if needs_auth:
+                request.user = self.authenticate(request)
+            response = func(request)
+        except HTTPError as http_error:
+            response = error(http_error.status_code, http_error.message, **http_error.extra)
+        if self.finish is not None:
+            self.finish()
+        return compress(response, request.header('accept-encoding'))
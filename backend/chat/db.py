@@ -0,0 +1,351 @@
+'''
+Database connections shared by all functions (each function directory carries
+its own copy because functions are deployed independently).
+
+Connections stay open between invocations: release() rolls back anything left
+open and puts the connection on a small per-DSN idle list instead of closing it.
+
+Read-only actions use read_connection(). With DATABASE_READ_URLS (comma
+separated, or a single DATABASE_READ_URL) it picks a replica by round robin or
+lowest measured latency (DATABASE_READ_SELECTION), skips replicas that are down
+or lag more than REPLICA_MAX_LAG_SECONDS behind, and otherwise falls back to the
+primary in DATABASE_URL.
+
+Read-your-writes: after record_write() the same user's reads on this instance go
+to the primary for READ_YOUR_WRITES_SECONDS, and a client that sends the
+X-Write-LSN it got back as X-Min-LSN is only served by a replica that has
+replayed at least that far.
+
+Hot queries are declared once with statement() and run with execute(): the
+first use on a connection PREPAREs them and later uses only send EXECUTE with
+the parameters, so Postgres skips parsing and planning. Set
+DATABASE_PREPARED_STATEMENTS=false behind a pooler that does not keep session
+state (e.g. PgBouncer in transaction mode).
+
+Sharding: with DATABASE_SHARD_URLS (comma separated, append only) the users
+table and the per-user tables co-located with it (two_factor_codes,
+user_activity_log) are split across those databases. A user's home shard is a
+jump consistent hash of the user id, so shard_connection() needs no lookup, and
+adding a shard moves only the users that now hash to it. DATABASE_URL keeps
+the global tables: user_directory (email -> user id, see directory.py), login
+sessions, reset tokens, chat and idempotency keys. Replicas (DATABASE_READ_URLS)
+serve the database in DATABASE_URL only; other shards are read from their
+primary. fan_out() runs a query on every shard concurrently for admin views.
+Without DATABASE_SHARD_URLS the one shard is DATABASE_URL.
+'''
+import itertools
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable, List, Optional, Sequence, Tuple, TypeVar
+
+import psycopg2
+import psycopg2.extensions
+from metrics import phase, TimedCursor
+
+READ_URLS = [
+    url.strip()
+    for url in (os.environ.get('DATABASE_READ_URLS') or os.environ.get('DATABASE_READ_URL', '')).split(',')
+    if url.strip()
+]
+READ_SELECTION = os.environ.get('DATABASE_READ_SELECTION', 'round_robin')
+POOL_IDLE_SIZE = int(os.environ.get('DATABASE_POOL_IDLE_SIZE', '4'))
+IDLE_PING_SECONDS = float(os.environ.get('DATABASE_IDLE_PING_SECONDS', '30'))
+REPLICA_MAX_LAG_SECONDS = float(os.environ.get('REPLICA_MAX_LAG_SECONDS', '5'))
+REPLICA_CHECK_SECONDS = float(os.environ.get('REPLICA_CHECK_SECONDS', '5'))
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', '10'))
+PREPARED_STATEMENTS = os.environ.get('DATABASE_PREPARED_STATEMENTS', 'true').lower() == 'true'
+SHARD_URLS = [url.strip() for url in os.environ.get('DATABASE_SHARD_URLS', '').split(',') if url.strip()]
+FAN_OUT_WORKERS = int(os.environ.get('DATABASE_FAN_OUT_WORKERS', '8'))
+
+T = TypeVar('T')
+
+class PooledConnection(psycopg2.extensions.connection):
+    '''Remembers its idle list, when it was last used and which statements it has prepared.'''
+    pool_url = ''
+    released_at = 0.0
+    prepared = frozenset()  # replaced by a set in checkout()
+
+class Statement:
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.param_count = 0
+        
+        def number(match: re.Match) -> str:
+            if match.group(0) == '%%':
+                return '%'
+            self.param_count += 1
+            return f'${self.param_count}'
+        self.prepare_sql = f'PREPARE {name} AS {re.sub("%%|%s", number, sql)}'
+        self.execute_sql = f"EXECUTE {name} ({', '.join(['%s'] * self.param_count)})" if self.param_count else f'EXECUTE {name}'
+
+class Replica:
+    def __init__(self, url: str):
+        self.url = url
+        self.healthy = True
+        self.lag_seconds = 0.0
+        self.replay_lsn = 0
+        self.latency_ms: Optional[float] = None
+        self.checked_at = float('-inf')
+
+_idle: Dict[str, List[PooledConnection]] = {}
+_idle_lock = threading.Lock()
+_replicas = [Replica(url) for url in READ_URLS]
+_replica_lock = threading.Lock()
+_round_robin = itertools.count()
+_recent_writes: Dict[int, float] = {}
+_fan_out_pool: Optional[ThreadPoolExecutor] = None
+_fan_out_pid = 0
+_fan_out_lock = threading.Lock()
+STATEMENTS: Dict[str, Statement] = {}
+
+def parse_lsn(lsn: str) -> int:
+    '''"16/B374D848" -> comparable integer; 0 for anything unparsable.'''
+    high, _, low = (lsn or '').partition('/')
+    try:
+        return (int(high, 16) << 32) + int(low, 16)
+    except ValueError:
+        return 0
+
+def checkout(url: str) -> PooledConnection:
+    while True:
+        with _idle_lock:
+            idle = _idle.get(url)
+            conn = idle.pop() if idle else None
+        if conn is None:
+            with phase('db_connect'):
+                conn = psycopg2.connect(url, connection_factory=PooledConnection, cursor_factory=TimedCursor)
+            conn.pool_url = url
+            conn.prepared = set()
+            return conn
+        if conn.closed:
+            continue
+        if time.monotonic() - conn.released_at < IDLE_PING_SECONDS:
+            return conn
+        # Idle long enough for the server or a proxy to have dropped it.
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return conn
+        except psycopg2.Error:
+            conn.close()
+
+def release(conn: PooledConnection):
+    '''Returns conn to its idle list, or closes it when it is broken or the list is full.'''
+    if conn.closed:
+        return
+    try:
+        if conn.status != psycopg2.extensions.STATUS_READY:
+            conn.rollback()
+    except psycopg2.Error:
+        conn.close()
+        return
+    
+    conn.released_at = time.monotonic()
+    with _idle_lock:
+        idle = _idle.setdefault(conn.pool_url, [])
+        if len(idle) < POOL_IDLE_SIZE:
+            idle.append(conn)
+            return
+    conn.close()
+
+def get_db_connection() -> PooledConnection:
+    return checkout(os.environ.get('DATABASE_URL', ''))
+
+def check_replica(replica: Replica):
+    started = time.perf_counter()
+    try:
+        conn = checkout(replica.url)
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT
+                    CASE WHEN pg_is_in_recovery() THEN pg_last_wal_replay_lsn() ELSE pg_current_wal_lsn() END::text,
+                    CASE
+                        WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END
+                """
+            )
+            lsn, lag = cur.fetchone()
+            cur.close()
+        finally:
+            release(conn)
+    except psycopg2.Error as exc:
+        replica.healthy = False
+        print(f'replica check failed: {exc}')
+        return
+    
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    replica.healthy = True
+    replica.replay_lsn = parse_lsn(lsn)
+    replica.lag_seconds = float(lag)
+    # Smoothed so one slow check does not flip the least-latency choice.
+    replica.latency_ms = elapsed_ms if replica.latency_ms is None else replica.latency_ms * 0.7 + elapsed_ms * 0.3
+
+def refresh_replicas():
+    if not _replica_lock.acquire(blocking=False):
+        return
+    try:
+        now = time.monotonic()
+        for replica in _replicas:
+            if now - replica.checked_at >= REPLICA_CHECK_SECONDS:
+                replica.checked_at = now
+                check_replica(replica)
+    finally:
+        _replica_lock.release()
+
+def choose_replica(min_lsn: int) -> Optional[Replica]:
+    if any(time.monotonic() - replica.checked_at >= REPLICA_CHECK_SECONDS for replica in _replicas):
+        refresh_replicas()
+    
+    candidates = [
+        replica for replica in _replicas
+        if replica.healthy and replica.lag_seconds <= REPLICA_MAX_LAG_SECONDS and replica.replay_lsn >= min_lsn
+    ]
+    if not candidates:
+        return None
+    if READ_SELECTION == 'least_latency':
+        return min(candidates, key=lambda replica: replica.latency_ms or 0.0)
+    return candidates[next(_round_robin) % len(candidates)]
+
+def read_connection(user_id: Optional[int] = None, min_lsn: str = '') -> PooledConnection:
+    '''A connection for a read-only action: a fresh enough replica when there is one, else the primary.'''
+    if not _replicas:
+        return get_db_connection()
+    
+    written_at = _recent_writes.get(user_id) if user_id is not None else None
+    if written_at is not None:
+        if time.monotonic() - written_at < READ_YOUR_WRITES_SECONDS:
+            return get_db_connection()
+        _recent_writes.pop(user_id, None)
+    
+    replica = choose_replica(parse_lsn(min_lsn))
+    if replica is None:
+        return get_db_connection()
+    
+    try:
+        return checkout(replica.url)
+    except psycopg2.Error as exc:
+        replica.healthy = False
+        print(f'replica connect failed: {exc}')
+        return get_db_connection()
+
+def record_write(conn: PooledConnection, user_id: Optional[int]) -> Dict[str, str]:
+    '''
+    Call after committing a write made on behalf of user_id. Returns the response
+    headers that let the client ask for reads at least this fresh.
+    '''
+    if not _replicas or conn.pool_url != os.environ.get('DATABASE_URL', ''):
+        return {}
+    if user_id is not None:
+        now = time.monotonic()
+        if len(_recent_writes) > 10000:
+            for stale_user_id in [key for key, at in list(_recent_writes.items()) if now - at >= READ_YOUR_WRITES_SECONDS]:
+                _recent_writes.pop(stale_user_id, None)
+        _recent_writes[user_id] = now
+    
+    cur = conn.cursor()
+    cur.execute("SELECT pg_current_wal_lsn()::text")
+    lsn = cur.fetchone()[0]
+    cur.close()
+    return {'X-Write-LSN': lsn, 'Access-Control-Expose-Headers': 'X-Write-LSN'}
+
+def shard_urls() -> List[str]:
+    return SHARD_URLS or [os.environ.get('DATABASE_URL', '')]
+
+def jump_hash(key: int, buckets: int) -> int:
+    '''Jump consistent hash (Lamping and Veach): going from n to n + 1 buckets moves 1/(n + 1) of the keys, all to the new one.'''
+    key &= 0xFFFFFFFFFFFFFFFF
+    bucket, candidate = -1, 0
+    while candidate < buckets:
+        bucket = candidate
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        candidate = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def shard_for(user_id: Optional[int]) -> int:
+    '''Index of user_id's home shard; events without a user go to shard 0.'''
+    urls = shard_urls()
+    if user_id is None or len(urls) == 1:
+        return 0
+    return jump_hash(int(user_id), len(urls))
+
+def shard_connection(user_id: Optional[int], reuse: Optional[PooledConnection] = None) -> PooledConnection:
+    '''
+    A primary connection to user_id's home shard. When reuse is already connected
+    there (always, without sharding) it is returned itself, so the caller's work
+    stays in one transaction; release the result only if it is not reuse.
+    '''
+    url = shard_urls()[shard_for(user_id)]
+    if reuse is not None and reuse.pool_url == url:
+        return reuse
+    return checkout(url)
+
+def shard_read_connection(user_id: int, min_lsn: str = '') -> PooledConnection:
+    '''A connection for reading user_id's rows: read_connection() when the home shard is DATABASE_URL, else its primary.'''
+    url = shard_urls()[shard_for(user_id)]
+    if url == os.environ.get('DATABASE_URL', ''):
+        return read_connection(user_id, min_lsn)
+    return checkout(url)
+
+def fan_out_pool() -> ThreadPoolExecutor:
+    '''Created on first use in each process (tools/prefork.py forks after import).'''
+    global _fan_out_pool, _fan_out_pid
+    with _fan_out_lock:
+        if _fan_out_pool is None or _fan_out_pid != os.getpid():
+            _fan_out_pool = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix='shard')
+            _fan_out_pid = os.getpid()
+        return _fan_out_pool
+
+def fan_out(func: Callable[[PooledConnection], T], write: bool = False, min_lsn: str = '', reuse: Optional[Tuple[int, PooledConnection]] = None) -> List[T]:
+    '''
+    func(conn) on every shard, concurrently, results in shard order. Reads of
+    DATABASE_URL go through read_connection(); write=True uses primaries. The
+    first shard that fails raises its exception. reuse, a (shard index,
+    connection) pair the caller already holds, e.g. from shard_read_connection(),
+    serves that shard instead of a new checkout; the caller releases it.
+    '''
+    def run(index: int, url: str) -> T:
+        if reuse is not None and reuse[0] == index:
+            return func(reuse[1])
+        if not write and url == os.environ.get('DATABASE_URL', ''):
+            conn = read_connection(min_lsn=min_lsn)
+        else:
+            conn = checkout(url)
+        try:
+            return func(conn)
+        finally:
+            release(conn)
+    
+    urls = shard_urls()
+    if len(urls) == 1:
+        return [run(0, urls[0])]
+    futures = [fan_out_pool().submit(run, index, url) for index, url in enumerate(urls)]
+    return [future.result() for future in futures]
+
+def statement(name: str, sql: str) -> Statement:
+    '''Registers a query (psycopg2 %s placeholders) under a name unique within the function.'''
+    registered = STATEMENTS.get(name)
+    if registered is not None and registered.sql != sql:
+        raise ValueError(f'statement {name} is already registered with different SQL')
+    STATEMENTS[name] = registered or Statement(name, sql)
+    return STATEMENTS[name]
+
+def execute(cur: Any, stmt: Statement, params: Sequence[Any] = ()):
+    if not PREPARED_STATEMENTS:
+        cur.execute(stmt.sql, params)
+        return
+    
+    prepared = cur.connection.prepared
+    if stmt.name not in prepared:
+        # PREPARE is not transactional, so a later rollback keeps the statement.
+        cur.execute(stmt.prepare_sql)
+        prepared.add(stmt.name)
+    cur.execute(stmt.execute_sql, params)
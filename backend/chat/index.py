@@ -1,9 +1,59 @@
-import json
 import os
-from typing import Dict, Any, List
+import time
+import random
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+import httpx
+import openai
 from openai import OpenAI
+from metrics import instrument, phase, timed
+from jwt_keys import decode_jwt
+from db import get_db_connection, read_connection, release, record_write
+from router import Router, Request, HTTPError, respond, error
+import last_seen
+from sessions import is_legacy_token, is_revoked
 
-client = OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('CHAT_UPSTREAM_CONNECT_TIMEOUT', '3'))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('CHAT_UPSTREAM_READ_TIMEOUT', '25'))
+UPSTREAM_MAX_RETRIES = int(os.environ.get('CHAT_UPSTREAM_MAX_RETRIES', '2'))
+UPSTREAM_BACKOFF_BASE = float(os.environ.get('CHAT_UPSTREAM_BACKOFF_BASE', '0.25'))
+UPSTREAM_BACKOFF_CAP = float(os.environ.get('CHAT_UPSTREAM_BACKOFF_CAP', '2'))
+UPSTREAM_MAX_CONCURRENCY = int(os.environ.get('CHAT_UPSTREAM_MAX_CONCURRENCY', '4'))
+UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get('CHAT_UPSTREAM_QUEUE_TIMEOUT', '0'))
+
+# Built once per instance so warm invocations reuse the pooled HTTP connection.
+# Retries are handled by call_openai, the SDK's own retry loop is disabled.
+client = OpenAI(
+    api_key=os.environ.get('OPENAI_API_KEY'),
+    base_url=os.environ.get('OPENAI_BASE_URL') or None,
+    timeout=httpx.Timeout(UPSTREAM_READ_TIMEOUT, connect=UPSTREAM_CONNECT_TIMEOUT),
+    max_retries=0
+)
+upstream_slots = threading.BoundedSemaphore(UPSTREAM_MAX_CONCURRENCY)
+
+RETRYABLE_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError
+)
+
+class UpstreamError(Exception):
+    def __init__(self, status_code: int, message: str):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+CHAT_MODEL = 'gpt-4o-mini'
+TOKEN_BUDGET = int(os.environ.get('CHAT_TOKEN_BUDGET', '6000'))
+MIN_RECENT_MESSAGES = max(1, int(os.environ.get('CHAT_MIN_RECENT_MESSAGES', '2')))
+SUMMARY_ENABLED = os.environ.get('CHAT_SUMMARY_ENABLED', 'false').lower() == 'true'
+SUMMARY_MAX_TOKENS = int(os.environ.get('CHAT_SUMMARY_MAX_TOKENS', '300'))
+SUMMARY_LOW_WATER = 0.75
+MESSAGE_OVERHEAD_TOKENS = 4
+HISTORY_LIMIT = int(os.environ.get('CHAT_HISTORY_LIMIT', '50'))
+# Ids are SERIAL (int4); a larger value would make Postgres raise instead of matching nothing.
+MAX_ID = 2147483647
 
 SYSTEM_PROMPT = """Ты — дружелюбный ИИ-ассистент для создания сайтов. Твоя задача — помогать пользователям воплощать их идеи в веб-сайты.
 
@@ -22,79 +72,412 @@ SYSTEM_PROMPT = """Ты — дружелюбный ИИ-ассистент дл
 
 Не говори, что ты "начинаешь работу" или "создаю код" — просто обсуждай идеи и детали проекта."""
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+SUMMARY_PROMPT = """Сожми диалог пользователя с ассистентом в краткое резюме на русском языке (не больше 8 пунктов).
+Сохрани все договорённости о сайте: тематику, стиль, цвета, разделы, функции, открытые вопросы.
+Если дано предыдущее резюме — дополни его, а не повторяй."""
+
+@timed('jwt_verify')
+def verify_jwt(token: str) -> Optional[Dict[str, Any]]:
+    return decode_jwt(token)
+
+def estimate_tokens(text: str) -> int:
+    # UTF-8 bytes / 4 is exact enough for latin text and slightly overestimates
+    # cyrillic, so the budget errs on the safe side without a tokenizer dependency.
+    return (len(text.encode('utf-8')) + 3) // 4 + MESSAGE_OVERHEAD_TOKENS
+
+SYSTEM_PROMPT_TOKENS = estimate_tokens(SYSTEM_PROMPT)
+
+def trim_history(
+    messages: List[Dict[str, str]],
+    summary: str,
+    budget: int
+) -> Tuple[List[Dict[str, str]], List[Dict[str, str]], int]:
     '''
-    Business: Генерация ответов ИИ-ассистента для создания сайтов
-    Args: event с httpMethod, body (messages: List[{role, content}])
-    Returns: HTTP response с ответом от ИИ
+    Keeps the newest messages that fit into budget next to the system prompt and summary.
+    Returns (kept, dropped, estimated prompt tokens); the newest MIN_RECENT_MESSAGES are always kept.
     '''
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+    used = SYSTEM_PROMPT_TOKENS + (estimate_tokens(summary) if summary else 0)
+    costs = [estimate_tokens(msg['content']) for msg in messages]
+    total = used + sum(costs)
+    
+    if total <= budget:
+        return messages, [], total
+    
+    # With summarization on, trim below the budget so the next few turns fit
+    # without folding the history (and paying for a summary call) every time.
+    target = int(budget * SUMMARY_LOW_WATER) if SUMMARY_ENABLED else budget
+    
+    keep_from = len(messages)
+    for index in range(len(messages) - 1, -1, -1):
+        required = len(messages) - index <= MIN_RECENT_MESSAGES
+        if not required and used + costs[index] > target:
+            break
+        used += costs[index]
+        keep_from = index
+    
+    return messages[keep_from:], messages[:keep_from], used
+
+def call_openai(timings: List[float], **params: Any) -> str:
+    '''
+    Runs one chat completion under the per-instance concurrency cap.
+    Retries timeouts, connection errors, 429 and 5xx with jittered backoff; appends each attempt's latency in ms to timings.
+    '''
+    if not upstream_slots.acquire(timeout=UPSTREAM_QUEUE_TIMEOUT):
+        raise UpstreamError(503, 'Assistant is busy, try again shortly')
+    
+    try:
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                with phase('openai', params.get('model', '')):
+                    completion = client.chat.completions.create(**params)
+            except RETRYABLE_ERRORS as retry_error:
+                timings.append(round((time.perf_counter() - started) * 1000, 1))
+                if attempt >= UPSTREAM_MAX_RETRIES:
+                    if isinstance(retry_error, openai.APITimeoutError):
+                        raise UpstreamError(504, 'Assistant did not respond in time')
+                    raise UpstreamError(502, 'Assistant is unavailable')
+                attempt += 1
+                # Full jitter keeps retries from several instances from arriving in lockstep.
+                time.sleep(random.uniform(0, min(UPSTREAM_BACKOFF_CAP, UPSTREAM_BACKOFF_BASE * 2 ** attempt)))
+                continue
+            except openai.APIError:
+                timings.append(round((time.perf_counter() - started) * 1000, 1))
+                raise UpstreamError(502, 'Assistant request failed')
+            
+            timings.append(round((time.perf_counter() - started) * 1000, 1))
+            break
+    finally:
+        upstream_slots.release()
+    
+    if not completion.choices or not completion.choices[0].message.content:
+        raise UpstreamError(502, 'Assistant returned an empty reply')
     
-    if method != 'POST':
-        return {
-            'statusCode': 405,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Method not allowed'}),
-            'isBase64Encoded': False
+    return completion.choices[0].message.content
+
+def summarize_messages(
+    previous_summary: str,
+    dropped: List[Dict[str, str]],
+    timings: List[float]
+) -> Optional[str]:
+    transcript = '\n'.join(f"{msg['role']}: {msg['content']}" for msg in dropped)
+    if previous_summary:
+        transcript = f"Предыдущее резюме:\n{previous_summary}\n\nНовые сообщения:\n{transcript}"
+    
+    try:
+        return call_openai(
+            timings,
+            model=CHAT_MODEL,
+            messages=[
+                {'role': 'system', 'content': SUMMARY_PROMPT},
+                {'role': 'user', 'content': transcript}
+            ],
+            temperature=0.2,
+            max_tokens=SUMMARY_MAX_TOKENS
+        )
+    except UpstreamError:
+        return None
+
+def generate_reply(history: List[Dict[str, str]], summary: str, summary_role: str = 'system') -> Dict[str, Any]:
+    '''
+    Trims history to the token budget, refreshes the summary when enabled and asks the model.
+    summary_role is the role the summary is sent with: 'system' only for a
+    summary the server stored itself, never for one a client sent back.
+    Returns reply, summary and the trimming details for the response metadata.
+    '''
+    kept, dropped, prompt_tokens = trim_history(history, summary, TOKEN_BUDGET)
+    summarized = False
+    timings: List[float] = []
+    
+    if dropped and SUMMARY_ENABLED:
+        new_summary = summarize_messages(summary, dropped, timings)
+        if new_summary:
+            summary = new_summary
+            prompt_tokens = SYSTEM_PROMPT_TOKENS + estimate_tokens(summary) + sum(
+                estimate_tokens(msg['content']) for msg in kept
+            )
+            summarized = True
+    
+    openai_messages = [{'role': 'system', 'content': SYSTEM_PROMPT}]
+    if summary:
+        openai_messages.append({
+            'role': summary_role,
+            'content': f"Краткое содержание предыдущей части диалога:\n{summary}"
+        })
+    openai_messages.extend(kept)
+    
+    # Each upstream call is already timed as the 'openai' metrics phase.
+    reply = call_openai(
+        timings,
+        model=CHAT_MODEL,
+        messages=openai_messages,
+        temperature=0.8,
+        max_tokens=800
+    )
+    
+    return {
+        'reply': reply,
+        'summary': summary,
+        'summarized': summarized,
+        'dropped_count': len(dropped),
+        'context': {
+            'token_budget': TOKEN_BUDGET,
+            'estimated_prompt_tokens': prompt_tokens,
+            'messages_sent': len(kept),
+            'messages_trimmed': len(dropped),
+            'summarized': summarized,
+            'upstream_calls': len(timings),
+            'upstream_ms': round(sum(timings), 1)
         }
+    }
+
+def parse_id(value: Any, name: str) -> int:
+    '''An id from the query or body; 0 when it is absent, HTTPError(400) when it is not a valid id.'''
+    if value is None or value == '':
+        return 0
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise HTTPError(400, f'{name} must be a number')
+    try:
+        parsed = int(value)
+    except ValueError:
+        raise HTTPError(400, f'{name} must be a number')
+    if not 1 <= parsed <= MAX_ID:
+        raise HTTPError(400, f'{name} is out of range')
+    return parsed
+
+def upstream_error_response(upstream_error: UpstreamError) -> Dict[str, Any]:
+    headers = {'Retry-After': '1'} if upstream_error.status_code == 503 else None
+    return respond(upstream_error.status_code, {'error': upstream_error.message}, headers)
+
+def authenticate(request: Request) -> Dict[str, Any]:
+    auth_header = request.header('X-Auth-Token')
+    
+    if not auth_header:
+        raise HTTPError(401, 'No token provided')
+    
+    payload = verify_jwt(auth_header)
+    if not payload or not ('sid' in payload or is_legacy_token(payload)):
+        raise HTTPError(401, 'Invalid token')
     
-    body_data = json.loads(event.get('body', '{}'))
+    if 'sid' in payload and is_revoked(payload['sid']):
+        raise HTTPError(401, 'Session revoked')
+    
+    last_seen.seen(payload['user_id'])
+    return payload
+
+router = Router('GET, POST, OPTIONS', 'Content-Type, X-User-Id, X-Auth-Token, X-Min-LSN, Idempotency-Key', authenticate, finish=last_seen.flush_due)
+
+@router.route('POST', idempotent=True)
+def chat(request: Request) -> Dict[str, Any]:
+    if 'messages' in request.body:
+        return handle_stateless_chat(request.body)
+    
+    payload = authenticate(request)
+    return handle_session_chat(payload['user_id'], request.body)
+
+@router.route('GET', auth=True)
+def history(request: Request) -> Dict[str, Any]:
+    return handle_session_history(request.user['user_id'], request.params, request.header('x-min-lsn'))
+
+@instrument
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    '''
+    Business: Генерация ответов ИИ-ассистента для создания сайтов
+    Args: event с httpMethod, body (message + session_id? с X-Auth-Token, либо messages: List[{role, content}], summary?, summary_covers?)
+    Returns: HTTP response с ответом от ИИ
+    '''
+    return router.dispatch(event, context)
+
+def handle_stateless_chat(body_data: Dict[str, Any]) -> Dict[str, Any]:
     messages: List[Dict[str, str]] = body_data.get('messages', [])
     
     if not messages:
-        return {
-            'statusCode': 400,
-            'headers': {
-                'Content-Type': 'application/json',
-                'Access-Control-Allow-Origin': '*'
-            },
-            'body': json.dumps({'error': 'Messages are required'}),
-            'isBase64Encoded': False
-        }
+        return error(400, 'Messages are required')
     
-    openai_messages = [{'role': 'system', 'content': SYSTEM_PROMPT}]
+    summary: str = body_data.get('summary') or ''
+    summary_covers = 0
+    if summary:
+        try:
+            summary_covers = int(body_data.get('summary_covers') or 0)
+        except (TypeError, ValueError):
+            raise HTTPError(400, 'summary_covers must be a number')
+        if not 0 <= summary_covers <= len(messages):
+            raise HTTPError(400, 'summary_covers is out of range')
     
-    for msg in messages:
+    history: List[Dict[str, str]] = []
+    positions: List[int] = []
+    for position, msg in enumerate(messages[summary_covers:], start=summary_covers):
         if msg.get('role') in ['user', 'assistant']:
-            openai_messages.append({
+            history.append({
                 'role': msg['role'],
                 'content': msg['content']
             })
+            positions.append(position)
     
-    completion = client.chat.completions.create(
-        model='gpt-4o-mini',
-        messages=openai_messages,
-        temperature=0.8,
-        max_tokens=800
-    )
+    # The client sends the summary back, so it gets no more authority than the
+    # assistant turns it may send anyway.
+    try:
+        result = generate_reply(history, summary, 'assistant')
+    except UpstreamError as upstream_error:
+        return upstream_error_response(upstream_error)
     
-    assistant_reply = completion.choices[0].message.content
+    if result['summarized']:
+        summary_covers = positions[result['dropped_count']]
     
-    return {
-        'statusCode': 200,
-        'headers': {
-            'Content-Type': 'application/json',
-            'Access-Control-Allow-Origin': '*'
-        },
-        'body': json.dumps({
-            'reply': assistant_reply,
-            'model': 'gpt-4o-mini'
-        }),
-        'isBase64Encoded': False
+    response_body: Dict[str, Any] = {
+        'reply': result['reply'],
+        'model': CHAT_MODEL,
+        'context': dict(result['context'], messages_received=len(messages))
     }
+    if result['summary']:
+        response_body['summary'] = result['summary']
+        response_body['summary_covers'] = summary_covers
+    
+    return respond(200, response_body)
+
+def handle_session_chat(user_id: int, body_data: Dict[str, Any]) -> Dict[str, Any]:
+    message = (body_data.get('message') or '').strip()
+    session_id = parse_id(body_data.get('session_id'), 'session_id')
+    
+    if not message:
+        return error(400, 'Message is required')
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    summary = ''
+    summary_message_id = 0
+    history_rows: List[Tuple[int, str, str]] = []
+    
+    if session_id:
+        cur.execute(
+            "SELECT summary, summary_message_id FROM chat_sessions WHERE id = %s AND user_id = %s",
+            (session_id, user_id)
+        )
+        session = cur.fetchone()
+        
+        if not session:
+            cur.close()
+            release(conn)
+            return error(404, 'Session not found')
+        
+        summary = session[0] or ''
+        summary_message_id = session[1] or 0
+        
+        cur.execute(
+            "SELECT id, role, content FROM chat_messages WHERE session_id = %s AND id > %s ORDER BY id DESC LIMIT %s",
+            (session_id, summary_message_id, HISTORY_LIMIT)
+        )
+        history_rows = cur.fetchall()[::-1]
+    
+    # Do not hold a transaction open while waiting for the model.
+    conn.commit()
+    
+    history = [{'role': row[1], 'content': row[2]} for row in history_rows]
+    history.append({'role': 'user', 'content': message})
+    
+    try:
+        result = generate_reply(history, summary)
+    except UpstreamError as upstream_error:
+        cur.close()
+        release(conn)
+        return upstream_error_response(upstream_error)
+    except Exception:
+        cur.close()
+        release(conn)
+        raise
+    
+    if result['summarized']:
+        summary_message_id = history_rows[result['dropped_count'] - 1][0]
+    
+    if not session_id:
+        cur.execute(
+            "INSERT INTO chat_sessions (user_id) VALUES (%s) RETURNING id",
+            (user_id,)
+        )
+        session_id = cur.fetchone()[0]
+    
+    cur.execute(
+        "INSERT INTO chat_messages (session_id, role, content) VALUES (%s, 'user', %s), (%s, 'assistant', %s)",
+        (session_id, message, session_id, result['reply'])
+    )
+    cur.execute(
+        "UPDATE chat_sessions SET summary = %s, summary_message_id = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s",
+        (result['summary'] or None, summary_message_id, session_id)
+    )
+    conn.commit()
+    consistency = record_write(conn, user_id)
+    cur.close()
+    release(conn)
+    
+    return respond(200, {
+        'reply': result['reply'],
+        'model': CHAT_MODEL,
+        'session_id': session_id,
+        'context': dict(result['context'], history_loaded=len(history_rows))
+    }, consistency)
+
+def handle_session_history(user_id: int, params: Dict[str, Any], min_lsn: str) -> Dict[str, Any]:
+    session_id = parse_id(params.get('session_id'), 'session_id')
+    before_id = parse_id(params.get('before_id'), 'before_id')
+    
+    conn = read_connection(user_id, min_lsn)
+    cur = conn.cursor()
+    
+    if not session_id:
+        cur.execute(
+            "SELECT id, created_at, updated_at FROM chat_sessions WHERE user_id = %s ORDER BY updated_at DESC LIMIT 20",
+            (user_id,)
+        )
+        sessions = cur.fetchall()
+        cur.close()
+        release(conn)
+        
+        return respond(200, {
+            'sessions': [
+                {
+                    'id': session[0],
+                    'created_at': session[1].isoformat() if session[1] else None,
+                    'updated_at': session[2].isoformat() if session[2] else None
+                }
+                for session in sessions
+            ]
+        })
+    
+    cur.execute(
+        "SELECT id FROM chat_sessions WHERE id = %s AND user_id = %s",
+        (session_id, user_id)
+    )
+    if not cur.fetchone():
+        cur.close()
+        release(conn)
+        return error(404, 'Session not found')
+    
+    if before_id:
+        cur.execute(
+            "SELECT id, role, content, created_at FROM chat_messages WHERE session_id = %s AND id < %s ORDER BY id DESC LIMIT %s",
+            (session_id, before_id, HISTORY_LIMIT)
+        )
+    else:
+        cur.execute(
+            "SELECT id, role, content, created_at FROM chat_messages WHERE session_id = %s ORDER BY id DESC LIMIT %s",
+            (session_id, HISTORY_LIMIT)
+        )
+    rows = cur.fetchall()[::-1]
+    cur.close()
+    release(conn)
+    
+    return respond(200, {
+        'session_id': session_id,
+        'messages': [
+            {
+                'id': row[0],
+                'role': row[1],
+                'content': row[2],
+                'created_at': row[3].isoformat() if row[3] else None
+            }
+            for row in rows
+        ],
+        'has_more': len(rows) == HISTORY_LIMIT
+    })
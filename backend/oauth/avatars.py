@@ -0,0 +1,223 @@
+'''
+Avatar ingestion shared by the auth and oauth functions (each function
+directory carries its own copy because functions are deployed independently).
+
+ingest() takes the bytes of an uploaded image (or of an OAuth picture fetched
+once with fetch_remote()), renders a square WebP thumbnail for every size in
+AVATAR_SIZES on a small thread pool (Pillow releases the GIL while decoding,
+resizing and encoding) and stores them under a key derived from the SHA-256 of
+the source. The same image uploaded twice is stored once and never re-rendered;
+because a key always names the same bytes, it is served with an immutable,
+one-year Cache-Control. users.avatar_url points at the largest size; the other
+sizes share the key with a different "_<size>" suffix.
+
+Storage is a local directory (AVATAR_DIR, for self-hosting and development) or,
+with AVATAR_S3_BUCKET, any S3-compatible bucket (AVATAR_S3_ENDPOINT, needs
+boto3). AVATAR_BASE_URL is the public prefix of the stored keys: the auth
+function's ?action=avatar&key= for the local directory, the bucket or CDN URL
+for S3.
+
+Only a bucket or an AVATAR_DIR set explicitly (a directory the operator keeps
+and serves at AVATAR_BASE_URL) counts as durable. The /tmp default lives and
+dies with one instance, while AVATAR_BASE_URL sends every reader to whichever
+instance answers, so without durable storage uploads are refused and OAuth
+users keep the provider's picture URL.
+
+Pillow is optional: without it the validated original is stored as is, with no
+thumbnails.
+'''
+import base64
+import hashlib
+import io
+import os
+import re
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+SIZES: List[int] = sorted((int(size) for size in os.environ.get('AVATAR_SIZES', '256,64').split(',')), reverse=True)
+MAX_BYTES = int(os.environ.get('AVATAR_MAX_BYTES', str(5 * 1024 * 1024)))
+MAX_PIXELS = int(os.environ.get('AVATAR_MAX_PIXELS', str(40_000_000)))
+WORKERS = int(os.environ.get('AVATAR_WORKERS', str(min(4, os.cpu_count() or 1))))
+FETCH_TIMEOUT = float(os.environ.get('AVATAR_FETCH_TIMEOUT', '5'))
+BASE_URL = os.environ.get('AVATAR_BASE_URL', 'https://functions.poehali.dev/17f386c1-c7a5-4462-913e-738a1e280193?action=avatar&key=')
+LOCAL_DIR = os.environ.get('AVATAR_DIR', '/tmp/avatars')
+S3_BUCKET = os.environ.get('AVATAR_S3_BUCKET', '')
+S3_ENDPOINT = os.environ.get('AVATAR_S3_ENDPOINT', '')
+DURABLE = bool(S3_BUCKET) or 'AVATAR_DIR' in os.environ
+
+# Part of every key: bump it when the rendering changes so new bytes get new keys.
+PIPELINE_VERSION = b'avatar-v1'
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+KEY_PATTERN = re.compile(r'^[0-9a-f]{32}(_[0-9]+)?\.(webp|jpg|png|gif)$')
+
+CONTENT_TYPES = {'webp': 'image/webp', 'jpg': 'image/jpeg', 'png': 'image/png', 'gif': 'image/gif'}
+
+if Image is not None:
+    Image.MAX_IMAGE_PIXELS = MAX_PIXELS
+
+class LocalStorage:
+    def __init__(self, directory: str):
+        self.directory = directory
+    
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+    
+    def exists(self, key: str) -> bool:
+        return os.path.exists(self.path(key))
+    
+    def put(self, key: str, data: bytes, content_type: str):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(temporary, 'wb') as handle:
+            handle.write(data)
+        os.replace(temporary, path)
+    
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self.path(key), 'rb') as handle:
+                return handle.read()
+        except FileNotFoundError:
+            return None
+
+class S3Storage:
+    def __init__(self, bucket: str, endpoint: str):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError('the boto3 package is required for AVATAR_S3_BUCKET')
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint or None)
+    
+    def exists(self, key: str) -> bool:
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return True
+        except self.client.exceptions.ClientError:
+            return False
+    
+    def put(self, key: str, data: bytes, content_type: str):
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=data, ContentType=content_type, CacheControl=CACHE_CONTROL)
+    
+    def get(self, key: str) -> Optional[bytes]:
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            return None
+
+storage = S3Storage(S3_BUCKET, S3_ENDPOINT) if S3_BUCKET else LocalStorage(LOCAL_DIR)
+
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_pid = 0
+_pool_lock = threading.Lock()
+
+def pool() -> ThreadPoolExecutor:
+    '''The thumbnail pool, created on first use in each process (tools/prefork.py forks after import).'''
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='avatar')
+            _pool_pid = os.getpid()
+        return _pool
+
+def sniff(data: bytes) -> Optional[str]:
+    '''File extension for the raster formats accepted as avatars, otherwise None.'''
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'jpg'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'png'
+    if data[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'webp'
+    return None
+
+def is_hosted(url: str) -> bool:
+    return bool(url) and url.startswith(BASE_URL) and bool(KEY_PATTERN.match(url[len(BASE_URL):]))
+
+def decode_upload(value: str) -> bytes:
+    '''Bytes of a base64 string or data: URL; raises ValueError.'''
+    if value.startswith('data:'):
+        value = value.partition(',')[2]
+    if len(value) > (MAX_BYTES + 2) // 3 * 4 + 4:
+        raise ValueError('Image too large')
+    try:
+        return base64.b64decode(value, validate=True)
+    except ValueError:
+        raise ValueError('Image must be base64 encoded')
+
+def fetch_remote(url: str) -> bytes:
+    '''Downloads an avatar from http(s) with a timeout and the upload size limit; raises ValueError.'''
+    if not url.startswith(('https://', 'http://')):
+        raise ValueError('Unsupported avatar URL')
+    request = urllib.request.Request(url, headers={'Accept': 'image/*'})
+    with urllib.request.urlopen(request, timeout=FETCH_TIMEOUT) as response:
+        data = response.read(MAX_BYTES + 1)
+    if len(data) > MAX_BYTES:
+        raise ValueError('Image too large')
+    return data
+
+def thumbnail(data: bytes, size: int) -> bytes:
+    with Image.open(io.BytesIO(data)) as image:
+        # JPEG can decode at a reduced scale directly, which skips most of the work.
+        image.draft('RGB', (size * 2, size * 2))
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if 'A' in image.getbands() or 'transparency' in image.info else 'RGB')
+        image = ImageOps.fit(image, (size, size), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, 'WEBP', quality=85, method=4)
+        return output.getvalue()
+
+def url_for(key: str) -> str:
+    return BASE_URL + key
+
+def ingest(data: bytes) -> str:
+    '''Stores data as an avatar and returns the URL of the largest size; raises ValueError for invalid images.'''
+    if len(data) > MAX_BYTES:
+        raise ValueError('Image too large')
+    extension = sniff(data)
+    if extension is None:
+        raise ValueError('Unsupported image type')
+    
+    digest = hashlib.sha256(PIPELINE_VERSION + data).hexdigest()[:32]
+    if Image is None:
+        key = f'{digest}.{extension}'
+        if not storage.exists(key):
+            storage.put(key, data, CONTENT_TYPES[extension])
+        return url_for(key)
+    
+    keys = {size: f'{digest}_{size}.webp' for size in SIZES}
+    missing = [size for size in SIZES if not storage.exists(keys[size])]
+    futures = [(size, pool().submit(thumbnail, data, size)) for size in missing]
+    for size, future in futures:
+        try:
+            rendered = future.result()
+        except (OSError, SyntaxError, Image.DecompressionBombError) as exc:
+            # Pillow reports corrupt or truncated files as OSError/SyntaxError.
+            raise ValueError(f'Invalid image: {exc}')
+        storage.put(keys[size], rendered, CONTENT_TYPES['webp'])
+    return url_for(keys[SIZES[0]])
+
+def response(key: str, if_none_match: str) -> Dict[str, Any]:
+    '''HTTP response for a stored key (local storage); 304 when the client already has it.'''
+    headers = {'Access-Control-Allow-Origin': '*', 'Cache-Control': CACHE_CONTROL, 'ETag': f'"{key}"'}
+    if not KEY_PATTERN.match(key):
+        return {'statusCode': 404, 'headers': headers, 'body': ''}
+    if if_none_match == f'"{key}"':
+        return {'statusCode': 304, 'headers': headers, 'body': ''}
+    data = storage.get(key)
+    if data is None:
+        return {'statusCode': 404, 'headers': dict(headers, **{'Cache-Control': 'no-store'}), 'body': ''}
+    return {
+        'statusCode': 200,
+        'headers': dict(headers, **{'Content-Type': CONTENT_TYPES[key.rsplit('.', 1)[1]]}),
+        'body': base64.b64encode(data).decode(),
+        'isBase64Encoded': True
+    }
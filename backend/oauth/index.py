@@ -1,242 +1,247 @@
 '''
-Business: OAuth authentication with Google and GitHub
+Business: OAuth authentication with the providers registered in providers.py (Google, GitHub)
 Args: event - dict with httpMethod, body, queryStringParameters
       context - object with attributes: request_id, function_name
 Returns: HTTP response dict with OAuth URLs or user data
 '''
 import json
-import os
-import psycopg2
-import hashlib
-import hmac
-import base64
 import time
-import urllib.parse
 import urllib.request
 from typing import Dict, Any, Optional
+import psycopg2
+import avatars
+import last_seen
+from activity import log_activity
+from metrics import instrument, phase, timed
+from jwt_keys import encode_jwt
+from db import get_db_connection, shard_connection, fan_out, release, statement, execute
+from directory import claim_or_find, release_email, find_identity, record_identity
+from router import Router, Request, respond, error
+from sessions import ACCESS_TOKEN_TTL, create_session
+from providers import PROVIDERS, Provider, issue_state, verify_state
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url)
+# One round trip for the first sign-in of an identity: link a password account
+# with the same (verified) email, otherwise insert the identity. The provider's
+# picture is not stored here: callback copies it into avatar storage once, see
+# import_avatar(). The unique (oauth_provider, oauth_id) index makes concurrent
+# callbacks for the same identity converge on one row. Runs on the shard of the
+# email's user id; identities already in oauth_identities never get here, so a
+# changed provider email does not create a second user on the new email's shard.
+UPSERT_OAUTH_USER = statement('oauth_upsert_user', """
+    WITH linked AS (
+        UPDATE users SET
+            oauth_provider = %s,
+            oauth_id = %s,
+            first_name = COALESCE(NULLIF(%s, ''), first_name),
+            last_name = COALESCE(NULLIF(%s, ''), last_name),
+            updated_at = CURRENT_TIMESTAMP
+        WHERE email = %s AND oauth_id IS NULL AND %s
+            AND NOT EXISTS (SELECT 1 FROM users WHERE oauth_provider = %s AND oauth_id = %s)
+        RETURNING id, email, first_name, last_name, avatar_url, is_active
+    ), upserted AS (
+        INSERT INTO users (id, email, password_hash, first_name, last_name, avatar_url, oauth_provider, oauth_id)
+        SELECT %s, %s, '', %s, %s, '', %s, %s
+        WHERE NOT EXISTS (SELECT 1 FROM linked)
+        ON CONFLICT (oauth_provider, oauth_id) DO UPDATE SET
+            first_name = COALESCE(NULLIF(EXCLUDED.first_name, ''), users.first_name),
+            last_name = COALESCE(NULLIF(EXCLUDED.last_name, ''), users.last_name),
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING id, email, first_name, last_name, avatar_url, is_active
+    )
+    SELECT * FROM linked UNION ALL SELECT * FROM upserted
+""")
+# A returning identity: refresh the stored name on its user's shard.
+REFRESH_OAUTH_USER = statement('oauth_refresh_user', """
+    UPDATE users SET
+        first_name = COALESCE(NULLIF(%s, ''), first_name),
+        last_name = COALESCE(NULLIF(%s, ''), last_name),
+        updated_at = CURRENT_TIMESTAMP
+    WHERE id = %s AND oauth_provider = %s AND oauth_id = %s
+    RETURNING id, email, first_name, last_name, avatar_url, is_active
+""")
+FIND_IDENTITY_USER = statement('oauth_find_identity_user', "SELECT id FROM users WHERE oauth_provider = %s AND oauth_id = %s")
+SET_AVATAR = statement('oauth_set_avatar', "UPDATE users SET avatar_url = %s, updated_at = CURRENT_TIMESTAMP WHERE id = %s")
 
-def generate_jwt(user_id: int, email: str) -> str:
-    secret = os.environ.get('JWT_SECRET_KEY', 'default_secret_key')
-    
-    header = base64.urlsafe_b64encode(json.dumps({
-        "alg": "HS256",
-        "typ": "JWT"
-    }).encode()).decode().rstrip('=')
-    
-    payload = base64.urlsafe_b64encode(json.dumps({
+@timed('jwt_sign')
+def generate_jwt(user_id: int, email: str, session_id: int) -> str:
+    return encode_jwt({
         "user_id": user_id,
         "email": email,
-        "exp": int(time.time()) + 86400 * 7
-    }).encode()).decode().rstrip('=')
-    
-    signature = base64.urlsafe_b64encode(
-        hmac.new(
-            secret.encode(),
-            f"{header}.{payload}".encode(),
-            hashlib.sha256
-        ).digest()
-    ).decode().rstrip('=')
-    
-    return f"{header}.{payload}.{signature}"
+        "sid": session_id,
+        "exp": int(time.time()) + ACCESS_TOKEN_TTL
+    })
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
+def import_avatar(provider: Provider, picture_url: str) -> str:
+    '''Copies the provider's picture into avatar storage; '' when it cannot be fetched or decoded.'''
+    try:
+        with phase('oauth_http', f'{provider.name} avatar'):
+            data = avatars.fetch_remote(picture_url)
+        return avatars.ingest(data)
+    except (OSError, ValueError) as exc:
+        print(f'{provider.name} avatar import failed: {exc!r}')
+        return ''
+
+def locate_identity(provider: str, oauth_id: str) -> Optional[int]:
+    '''
+    The user of an identity missing from oauth_identities, searched on every
+    shard: users from before the directory, on shards other than DATABASE_URL.
+    Primaries only, so an identity written a moment ago is not missed.
+    '''
+    def find(conn: Any) -> Optional[int]:
+        cur = conn.cursor()
+        execute(cur, FIND_IDENTITY_USER, (provider, oauth_id))
+        row = cur.fetchone()
+        cur.close()
+        return row[0] if row else None
     
-    path = event.get('queryStringParameters', {}).get('action', '')
-    provider = event.get('queryStringParameters', {}).get('provider', '')
+    return next((user_id for user_id in fan_out(find, write=True) if user_id is not None), None)
+
+router = Router('GET, POST, OPTIONS', 'Content-Type, Idempotency-Key', finish=last_seen.flush_due)
+
+@router.route('GET', 'init')
+def init(request: Request) -> Dict[str, Any]:
+    provider = PROVIDERS.get(request.params.get('provider', ''))
+    callback_url = request.params.get('callback_url', '')
     
-    if method == 'GET' and path == 'init':
-        callback_url = event.get('queryStringParameters', {}).get('callback_url', '')
-        
-        if provider == 'google':
-            client_id = os.environ.get('GOOGLE_CLIENT_ID', '')
-            google_auth_url = (
-                f"https://accounts.google.com/o/oauth2/v2/auth?"
-                f"client_id={client_id}&"
-                f"redirect_uri={urllib.parse.quote(callback_url)}&"
-                f"response_type=code&"
-                f"scope=email%20profile&"
-                f"access_type=offline"
-            )
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'auth_url': google_auth_url})
-            }
-        
-        elif provider == 'github':
-            client_id = os.environ.get('GITHUB_CLIENT_ID', '')
-            github_auth_url = (
-                f"https://github.com/login/oauth/authorize?"
-                f"client_id={client_id}&"
-                f"redirect_uri={urllib.parse.quote(callback_url)}&"
-                f"scope=user:email"
-            )
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'auth_url': github_auth_url})
-            }
-        
-        return {
-            'statusCode': 400,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid provider'})
-        }
+    if provider is None:
+        return error(400, 'Invalid provider')
+    if not callback_url:
+        return error(400, 'callback_url required')
     
-    if method == 'POST' and path == 'callback':
-        body_data = json.loads(event.get('body', '{}'))
-        code = body_data.get('code', '')
-        callback_url = body_data.get('callback_url', '')
-        
-        if not code:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Code required'})
-            }
-        
-        if provider == 'google':
-            client_id = os.environ.get('GOOGLE_CLIENT_ID', '')
-            client_secret = os.environ.get('GOOGLE_CLIENT_SECRET', '')
-            
-            token_data = urllib.parse.urlencode({
-                'code': code,
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'redirect_uri': callback_url,
-                'grant_type': 'authorization_code'
-            }).encode()
-            
-            token_req = urllib.request.Request(
-                'https://oauth2.googleapis.com/token',
-                data=token_data,
-                headers={'Content-Type': 'application/x-www-form-urlencoded'}
-            )
-            
-            with urllib.request.urlopen(token_req) as response:
-                token_response = json.loads(response.read().decode())
-                access_token = token_response.get('access_token')
-            
-            user_req = urllib.request.Request(
-                'https://www.googleapis.com/oauth2/v2/userinfo',
-                headers={'Authorization': f'Bearer {access_token}'}
-            )
-            
-            with urllib.request.urlopen(user_req) as response:
-                user_data = json.loads(response.read().decode())
-            
-            oauth_id = user_data.get('id')
-            email = user_data.get('email')
-            first_name = user_data.get('given_name', '')
-            last_name = user_data.get('family_name', '')
-            avatar_url = user_data.get('picture', '')
-            
-        elif provider == 'github':
-            client_id = os.environ.get('GITHUB_CLIENT_ID', '')
-            client_secret = os.environ.get('GITHUB_CLIENT_SECRET', '')
-            
-            token_data = json.dumps({
-                'client_id': client_id,
-                'client_secret': client_secret,
-                'code': code,
-                'redirect_uri': callback_url
-            }).encode()
-            
-            token_req = urllib.request.Request(
-                'https://github.com/login/oauth/access_token',
-                data=token_data,
-                headers={
-                    'Content-Type': 'application/json',
-                    'Accept': 'application/json'
-                }
-            )
-            
-            with urllib.request.urlopen(token_req) as response:
-                token_response = json.loads(response.read().decode())
-                access_token = token_response.get('access_token')
-            
-            user_req = urllib.request.Request(
-                'https://api.github.com/user',
-                headers={
-                    'Authorization': f'Bearer {access_token}',
-                    'Accept': 'application/json'
-                }
-            )
-            
-            with urllib.request.urlopen(user_req) as response:
-                user_data = json.loads(response.read().decode())
-            
-            oauth_id = str(user_data.get('id'))
-            email = user_data.get('email', f"github_{oauth_id}@oauth.local")
-            name_parts = (user_data.get('name') or '').split(' ', 1)
-            first_name = name_parts[0] if name_parts else user_data.get('login', '')
-            last_name = name_parts[1] if len(name_parts) > 1 else ''
-            avatar_url = user_data.get('avatar_url', '')
-        else:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid provider'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "SELECT id, email, first_name, last_name, avatar_url FROM users WHERE oauth_provider = %s AND oauth_id = %s",
-            (provider, oauth_id)
-        )
-        user = cur.fetchone()
+    issued = issue_state(provider.name, callback_url)
+    return respond(200, {
+        'auth_url': provider.authorization_url(callback_url, issued['state'], issued['code_challenge']),
+        'state': issued['state']
+    })
+
+def fetch_json(provider: Provider, what: str, http_request: urllib.request.Request) -> Dict[str, Any]:
+    with phase('oauth_http', f'{provider.name} {what}'), urllib.request.urlopen(http_request) as response:
+        return json.loads(response.read().decode())
+
+@router.route('POST', 'callback', idempotent=True)
+def callback(request: Request) -> Dict[str, Any]:
+    body_data = request.body
+    code = body_data.get('code', '')
+    
+    if not code:
+        return error(400, 'Code required')
+    
+    verified = verify_state(str(body_data.get('state', '')))
+    if verified is None or request.params.get('provider', verified['provider']) != verified['provider']:
+        return error(400, 'Invalid or expired state')
+    
+    provider = PROVIDERS[verified['provider']]
+    token_response = fetch_json(provider, 'token', urllib.request.Request(
+        provider.token_url,
+        data=provider.token_request_body(code, verified['redirect_uri'], verified['code_verifier']),
+        headers={'Content-Type': 'application/x-www-form-urlencoded', 'Accept': 'application/json'}
+    ))
+    access_token = token_response.get('access_token')
+    if not access_token:
+        return error(400, 'Authorization code rejected by provider')
+    
+    profile = provider.profile(fetch_json(provider, 'userinfo', urllib.request.Request(
+        provider.userinfo_url,
+        headers={'Authorization': f'Bearer {access_token}', 'Accept': 'application/json'}
+    )))
+    
+    conn = get_db_connection()
+    cur = conn.cursor()
+    
+    # A returning identity is found by (provider, id), not by the email the
+    # provider reports now, which may have changed and lead to another shard.
+    user = None
+    user_id = find_identity(cur, provider.name, profile['oauth_id'])
+    if user_id is None:
+        user_id = locate_identity(provider.name, profile['oauth_id'])
+    if user_id is not None:
+        user_conn = shard_connection(user_id, conn)
+        user_cur = user_conn.cursor()
+        execute(user_cur, REFRESH_OAUTH_USER, (profile['first_name'], profile['last_name'], user_id, provider.name, profile['oauth_id']))
+        user = user_cur.fetchone()
+        if user is None:
+            # The entry is stale (the identity was detached); sign in as a new identity.
+            user_conn.rollback()
+            user_cur.close()
+            if user_conn is not conn:
+                release(user_conn)
+    
+    directory_id, claimed = None, False
+    if user is None:
+        # A new email gets its id in the directory before the user is written to its shard, as in registration.
+        directory_id, claimed = claim_or_find(cur, profile['email'])
+        conn.commit()
         
-        if user:
-            user_id = user[0]
-        else:
-            cur.execute(
-                "INSERT INTO users (email, password_hash, first_name, last_name, avatar_url, oauth_provider, oauth_id) VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING id",
-                (email, '', first_name, last_name, avatar_url, provider, oauth_id)
-            )
-            user_id = cur.fetchone()[0]
+        user_conn = shard_connection(directory_id, conn)
+        user_cur = user_conn.cursor()
+        try:
+            execute(user_cur, UPSERT_OAUTH_USER, (
+                provider.name, profile['oauth_id'], profile['first_name'], profile['last_name'],
+                profile['email'], profile['email_verified'], provider.name, profile['oauth_id'],
+                directory_id, profile['email'], profile['first_name'], profile['last_name'], provider.name, profile['oauth_id']
+            ))
+            user = user_cur.fetchone()
+        except psycopg2.IntegrityError:
+            # The email belongs to an account that cannot be linked automatically.
+            user = None
+    
+    if user is None or not user[5]:
+        user_conn.rollback()
+        if claimed and (user is None or user[0] != directory_id):
+            release_email(cur, directory_id)
             conn.commit()
-        
+        user_cur.close()
         cur.close()
-        conn.close()
-        
-        token = generate_jwt(user_id, email)
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'token': token,
-                'user': {
-                    'id': user_id,
-                    'email': email,
-                    'first_name': first_name,
-                    'last_name': last_name,
-                    'avatar_url': avatar_url
-                }
-            })
-        }
+        if user_conn is not conn:
+            release(user_conn)
+        release(conn)
+        if user is None:
+            return error(409, 'An account with this email already exists')
+        return error(403, 'Account is disabled')
+    
+    user_id = user[0]
+    log_activity(user_cur, user_id, 'oauth_login', request.source_ip, request.header('user-agent'))
+    user_conn.commit()
+    if claimed and user_id != directory_id:
+        # A returning identity: the claim for its new email is not needed.
+        release_email(cur, directory_id)
+    record_identity(cur, provider.name, profile['oauth_id'], user_id)
+    session_id, refresh_token = create_session(cur, user_id, request.source_ip, request.header('user-agent'))
+    conn.commit()
+    
+    # Only users without a stored avatar (new, or one still hotlinking the
+    # provider) get the picture fetched; afterwards avatar_url is ours. Without
+    # durable avatar storage the provider's URL is kept instead.
+    avatar_url = user[4]
+    if profile['avatar_url'] and not avatars.is_hosted(avatar_url or ''):
+        imported = import_avatar(provider, profile['avatar_url']) if avatars.DURABLE else profile['avatar_url']
+        if imported and imported != avatar_url:
+            avatar_url = imported
+            execute(user_cur, SET_AVATAR, (avatar_url, user_id))
+            user_conn.commit()
     
-    return {
-        'statusCode': 404,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Endpoint not found'})
-    }
\ No newline at end of file
+    user_cur.close()
+    cur.close()
+    if user_conn is not conn:
+        release(user_conn)
+    release(conn)
+    last_seen.login(user_id)
+    
+    token = generate_jwt(user_id, user[1], session_id)
+    
+    return respond(200, {
+        'token': token,
+        'refresh_token': refresh_token,
+        'expires_in': ACCESS_TOKEN_TTL,
+        'user': {
+            'id': user_id,
+            'email': user[1],
+            'first_name': user[2],
+            'last_name': user[3],
+            'avatar_url': avatar_url
+        }
+    })
+
+@instrument
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return router.dispatch(event, context)
@@ -0,0 +1,158 @@
+'''
+OAuth provider registry and stateless, signed authorization state.
+
+Each provider's authorization URL prefix (endpoint, client id, scope and fixed
+parameters) is encoded once at import, so init only appends the per-request
+redirect_uri, state and PKCE challenge. Adding a provider means adding a
+PROVIDERS entry with a function that maps its userinfo document to a profile.
+
+The state is "<payload>.<signature>": the payload (provider, redirect_uri, a
+nonce and an expiry) is signed with HMAC-SHA256 under OAUTH_STATE_SECRET (or
+JWT_SECRET_KEY; one of them is required at import), so callback validates it
+without a database or cache. The PKCE verifier is
+HMAC(secret, nonce) and is never sent to the browser; callback derives it again
+from the verified state.
+'''
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+import urllib.parse
+from typing import Dict, Any, Callable, Optional
+
+STATE_SECRET = (os.environ.get('OAUTH_STATE_SECRET') or os.environ.get('JWT_SECRET_KEY') or '').encode()
+if not STATE_SECRET:
+    # A known key would let anyone forge states and derive their PKCE verifiers.
+    raise RuntimeError('OAUTH_STATE_SECRET or JWT_SECRET_KEY must be set')
+STATE_TTL = int(os.environ.get('OAUTH_STATE_TTL', '600'))
+
+def b64url_encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+def b64url_decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+
+class Provider:
+    def __init__(
+        self,
+        name: str,
+        authorize_url: str,
+        token_url: str,
+        userinfo_url: str,
+        scope: str,
+        profile: Callable[[Dict[str, Any]], Dict[str, Any]],
+        extra_params: Optional[Dict[str, str]] = None
+    ):
+        self.name = name
+        self.token_url = token_url
+        self.userinfo_url = userinfo_url
+        self.profile = profile
+        self.client_id = os.environ.get(f'{name.upper()}_CLIENT_ID', '')
+        self.client_secret = os.environ.get(f'{name.upper()}_CLIENT_SECRET', '')
+        params = {'client_id': self.client_id, 'response_type': 'code', 'scope': scope, 'code_challenge_method': 'S256'}
+        params.update(extra_params or {})
+        self.auth_prefix = f'{authorize_url}?{urllib.parse.urlencode(params, quote_via=urllib.parse.quote)}&'
+    
+    def authorization_url(self, redirect_uri: str, state: str, code_challenge: str) -> str:
+        return self.auth_prefix + urllib.parse.urlencode(
+            {'redirect_uri': redirect_uri, 'state': state, 'code_challenge': code_challenge},
+            quote_via=urllib.parse.quote
+        )
+    
+    def token_request_body(self, code: str, redirect_uri: str, code_verifier: str) -> bytes:
+        return urllib.parse.urlencode({
+            'code': code,
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'redirect_uri': redirect_uri,
+            'grant_type': 'authorization_code',
+            'code_verifier': code_verifier
+        }).encode()
+
+def google_profile(data: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'oauth_id': str(data.get('id')),
+        'email': data.get('email'),
+        'email_verified': bool(data.get('verified_email')),
+        'first_name': data.get('given_name', ''),
+        'last_name': data.get('family_name', ''),
+        'avatar_url': data.get('picture', '')
+    }
+
+def github_profile(data: Dict[str, Any]) -> Dict[str, Any]:
+    oauth_id = str(data.get('id'))
+    name_parts = (data.get('name') or '').split(' ', 1)
+    return {
+        'oauth_id': oauth_id,
+        'email': data.get('email') or f'github_{oauth_id}@oauth.local',
+        # The public profile email is not necessarily verified, so it never links accounts.
+        'email_verified': False,
+        'first_name': name_parts[0] or data.get('login', ''),
+        'last_name': name_parts[1] if len(name_parts) > 1 else '',
+        'avatar_url': data.get('avatar_url', '')
+    }
+
+PROVIDERS: Dict[str, Provider] = {
+    provider.name: provider for provider in [
+        Provider(
+            'google',
+            'https://accounts.google.com/o/oauth2/v2/auth',
+            'https://oauth2.googleapis.com/token',
+            'https://www.googleapis.com/oauth2/v2/userinfo',
+            'email profile',
+            google_profile,
+            {'access_type': 'offline'}
+        ),
+        Provider(
+            'github',
+            'https://github.com/login/oauth/authorize',
+            'https://github.com/login/oauth/access_token',
+            'https://api.github.com/user',
+            'user:email',
+            github_profile
+        ),
+    ]
+}
+
+def sign(data: bytes) -> str:
+    return b64url_encode(hmac.new(STATE_SECRET, data, hashlib.sha256).digest())
+
+def code_verifier(nonce: str) -> str:
+    return sign(b'pkce:' + nonce.encode())
+
+def code_challenge(verifier: str) -> str:
+    return b64url_encode(hashlib.sha256(verifier.encode()).digest())
+
+def issue_state(provider: str, redirect_uri: str) -> Dict[str, str]:
+    '''Returns the signed state and the PKCE code challenge for one authorization request.'''
+    nonce = secrets.token_urlsafe(16)
+    payload = b64url_encode(json.dumps(
+        {'p': provider, 'r': redirect_uri, 'n': nonce, 'exp': int(time.time()) + STATE_TTL},
+        separators=(',', ':')
+    ).encode())
+    return {
+        'state': f'{payload}.{sign(b"state:" + payload.encode())}',
+        'code_challenge': code_challenge(code_verifier(nonce))
+    }
+
+def verify_state(state: str) -> Optional[Dict[str, str]]:
+    '''Returns {provider, redirect_uri, code_verifier} for a valid, unexpired state, otherwise None.'''
+    payload, _, signature = state.partition('.')
+    # compare_digest() only takes ASCII strs, so compare bytes; a state that
+    # does not even encode (lone surrogates from JSON) is simply invalid.
+    try:
+        expected, given = sign(b'state:' + payload.encode()).encode(), signature.encode()
+    except UnicodeEncodeError:
+        return None
+    if not payload or not hmac.compare_digest(expected, given):
+        return None
+    try:
+        data = json.loads(b64url_decode(payload))
+    except ValueError:
+        return None
+    if not isinstance(data, dict) or data.get('exp', 0) < time.time() or data.get('p') not in PROVIDERS:
+        return None
+    return {'provider': data['p'], 'redirect_uri': data.get('r', ''), 'code_verifier': code_verifier(str(data.get('n', '')))}
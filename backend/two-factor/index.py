@@ -4,49 +4,30 @@ Args: event - dict with httpMethod, body, queryStringParameters
       context - object with attributes: request_id, function_name
 Returns: HTTP response dict with 2FA data or verification status
 '''
-import json
-import os
-import psycopg2
-import hashlib
-import hmac
-import base64
-import time
 import secrets
 import string
 from typing import Dict, Any, Optional
 from datetime import datetime, timedelta
+from metrics import instrument, timed
+from activity import log_activity
+from jwt_keys import decode_jwt
+from db import shard_connection, release, record_write, statement, execute
+from router import Router, Request, HTTPError, respond, error
+import reads
+from reads import serve
+import last_seen
+from sessions import is_legacy_token, is_revoked
 
-def get_db_connection():
-    database_url = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(database_url)
+SET_SECRET = statement('tfa_set_secret', "UPDATE users SET two_factor_secret = %s WHERE id = %s")
+FIND_CODE = statement('tfa_find_code', "SELECT id FROM two_factor_codes WHERE user_id = %s AND code = %s AND used = FALSE AND expires_at > NOW()")
+ENABLE_2FA = statement('tfa_enable', "UPDATE users SET two_factor_enabled = TRUE WHERE id = %s")
+USE_CODE = statement('tfa_use_code', "UPDATE two_factor_codes SET used = TRUE WHERE id = %s")
+INSERT_CODE = statement('tfa_insert_code', "INSERT INTO two_factor_codes (user_id, code, expires_at) VALUES (%s, %s, %s)")
+DISABLE_2FA = statement('tfa_disable', "UPDATE users SET two_factor_enabled = FALSE, two_factor_secret = NULL WHERE id = %s")
 
+@timed('jwt_verify')
 def verify_jwt(token: str) -> Optional[Dict[str, Any]]:
-    secret = os.environ.get('JWT_SECRET_KEY', 'default_secret_key')
-    
-    parts = token.split('.')
-    if len(parts) != 3:
-        return None
-    
-    header, payload, signature = parts
-    
-    expected_signature = base64.urlsafe_b64encode(
-        hmac.new(
-            secret.encode(),
-            f"{header}.{payload}".encode(),
-            hashlib.sha256
-        ).digest()
-    ).decode().rstrip('=')
-    
-    if signature != expected_signature:
-        return None
-    
-    padding = '=' * (4 - len(payload) % 4)
-    decoded_payload = json.loads(base64.urlsafe_b64decode(payload + padding))
-    
-    if decoded_payload.get('exp', 0) < time.time():
-        return None
-    
-    return decoded_payload
+    return decode_jwt(token)
 
 def generate_2fa_code() -> str:
     return ''.join(secrets.choice(string.digits) for _ in range(6))
@@ -54,223 +35,136 @@ def generate_2fa_code() -> str:
 def generate_2fa_secret() -> str:
     return secrets.token_urlsafe(32)
 
-def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
-    method: str = event.get('httpMethod', 'GET')
-    
-    if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, DELETE, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-Auth-Token',
-                'Access-Control-Max-Age': '86400'
-            },
-            'body': ''
-        }
-    
-    path = event.get('queryStringParameters', {}).get('action', '')
-    auth_header = event.get('headers', {}).get('x-auth-token', '')
+def authenticate(request: Request) -> Dict[str, Any]:
+    auth_header = request.header('x-auth-token')
     
     if not auth_header:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'No token provided'})
-        }
+        raise HTTPError(401, 'No token provided')
     
     payload = verify_jwt(auth_header)
-    if not payload:
-        return {
-            'statusCode': 401,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Invalid token'})
-        }
+    if not payload or not ('sid' in payload or is_legacy_token(payload)):
+        raise HTTPError(401, 'Invalid token')
     
-    user_id = payload['user_id']
+    if 'sid' in payload and is_revoked(payload['sid']):
+        raise HTTPError(401, 'Session revoked')
     
-    if method == 'POST' and path == 'enable':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        secret = generate_2fa_secret()
-        
-        cur.execute(
-            "UPDATE users SET two_factor_secret = %s WHERE id = %s",
-            (secret, user_id)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'message': '2FA secret generated',
-                'secret': secret
-            })
-        }
+    last_seen.seen(payload['user_id'])
+    return payload
+
+router = Router('GET, POST, PUT, DELETE, OPTIONS', 'Content-Type, X-Auth-Token, X-Min-LSN', authenticate, finish=last_seen.flush_due)
+
+@router.route('POST', 'enable', auth=True)
+def enable(request: Request) -> Dict[str, Any]:
+    conn = shard_connection(request.user['user_id'])
+    cur = conn.cursor()
+    
+    secret = generate_2fa_secret()
+    
+    execute(cur, SET_SECRET, (secret, request.user['user_id']))
+    conn.commit()
+    consistency = record_write(conn, request.user['user_id'])
+    cur.close()
+    release(conn)
+    
+    return respond(200, {
+        'message': '2FA secret generated',
+        'secret': secret
+    }, consistency)
+
+@router.route('POST', 'confirm', auth=True)
+def confirm(request: Request) -> Dict[str, Any]:
+    user_id = request.user['user_id']
+    code = request.body.get('code', '')
     
-    if method == 'POST' and path == 'confirm':
-        body_data = json.loads(event.get('body', '{}'))
-        code = body_data.get('code', '')
-        
-        if not code:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Code required'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "SELECT id FROM two_factor_codes WHERE user_id = %s AND code = %s AND used = FALSE AND expires_at > NOW()",
-            (user_id, code)
-        )
-        code_record = cur.fetchone()
-        
-        if not code_record:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid or expired code'})
-            }
-        
-        cur.execute(
-            "UPDATE users SET two_factor_enabled = TRUE WHERE id = %s",
-            (user_id,)
-        )
-        cur.execute(
-            "UPDATE two_factor_codes SET used = TRUE WHERE id = %s",
-            (code_record[0],)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'message': '2FA enabled successfully'})
-        }
+    if not code:
+        return error(400, 'Code required')
     
-    if method == 'POST' and path == 'generate-code':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        code = generate_2fa_code()
-        expires_at = datetime.now() + timedelta(minutes=10)
-        
-        cur.execute(
-            "INSERT INTO two_factor_codes (user_id, code, expires_at) VALUES (%s, %s, %s)",
-            (user_id, code, expires_at)
-        )
-        conn.commit()
-        cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'code': code,
-                'expires_in_minutes': 10
-            })
-        }
+    conn = shard_connection(request.user['user_id'])
+    cur = conn.cursor()
+    
+    execute(cur, FIND_CODE, (user_id, code))
+    code_record = cur.fetchone()
     
-    if method == 'POST' and path == 'verify':
-        body_data = json.loads(event.get('body', '{}'))
-        code = body_data.get('code', '')
-        
-        if not code:
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Code required'})
-            }
-        
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "SELECT id FROM two_factor_codes WHERE user_id = %s AND code = %s AND used = FALSE AND expires_at > NOW()",
-            (user_id, code)
-        )
-        code_record = cur.fetchone()
-        
-        if not code_record:
-            cur.close()
-            conn.close()
-            return {
-                'statusCode': 400,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'Invalid or expired code', 'verified': False})
-            }
-        
-        cur.execute(
-            "UPDATE two_factor_codes SET used = TRUE WHERE id = %s",
-            (code_record[0],)
-        )
+    if not code_record:
+        log_activity(cur, user_id, '2fa_failed', request.source_ip, request.header('user-agent'))
         conn.commit()
         cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'verified': True, 'message': 'Code verified'})
-        }
+        release(conn)
+        return error(400, 'Invalid or expired code')
+    
+    execute(cur, ENABLE_2FA, (user_id,))
+    execute(cur, USE_CODE, (code_record[0],))
+    conn.commit()
+    consistency = record_write(conn, user_id)
+    cur.close()
+    release(conn)
+    
+    return respond(200, {'message': '2FA enabled successfully'}, consistency)
+
+@router.route('POST', 'generate-code', auth=True)
+def generate_code(request: Request) -> Dict[str, Any]:
+    conn = shard_connection(request.user['user_id'])
+    cur = conn.cursor()
+    
+    code = generate_2fa_code()
+    expires_at = datetime.now() + timedelta(minutes=10)
+    
+    execute(cur, INSERT_CODE, (request.user['user_id'], code, expires_at))
+    conn.commit()
+    cur.close()
+    release(conn)
+    
+    return respond(200, {
+        'code': code,
+        'expires_in_minutes': 10
+    })
+
+@router.route('POST', 'verify', auth=True)
+def verify(request: Request) -> Dict[str, Any]:
+    user_id = request.user['user_id']
+    code = request.body.get('code', '')
     
-    if method == 'POST' and path == 'disable':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "UPDATE users SET two_factor_enabled = FALSE, two_factor_secret = NULL WHERE id = %s",
-            (user_id,)
-        )
+    if not code:
+        return error(400, 'Code required')
+    
+    conn = shard_connection(request.user['user_id'])
+    cur = conn.cursor()
+    
+    execute(cur, FIND_CODE, (user_id, code))
+    code_record = cur.fetchone()
+    
+    if not code_record:
+        log_activity(cur, user_id, '2fa_failed', request.source_ip, request.header('user-agent'))
         conn.commit()
         cur.close()
-        conn.close()
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'message': '2FA disabled successfully'})
-        }
+        release(conn)
+        return error(400, 'Invalid or expired code', verified=False)
     
-    if method == 'GET' and path == 'status':
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        cur.execute(
-            "SELECT two_factor_enabled FROM users WHERE id = %s",
-            (user_id,)
-        )
-        user = cur.fetchone()
-        cur.close()
-        conn.close()
-        
-        if not user:
-            return {
-                'statusCode': 404,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'error': 'User not found'})
-            }
-        
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'two_factor_enabled': user[0]})
-        }
+    execute(cur, USE_CODE, (code_record[0],))
+    log_activity(cur, user_id, '2fa_verified', request.source_ip, request.header('user-agent'))
+    conn.commit()
+    cur.close()
+    release(conn)
     
-    return {
-        'statusCode': 404,
-        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-        'body': json.dumps({'error': 'Endpoint not found'})
-    }
\ No newline at end of file
+    return respond(200, {'verified': True, 'message': 'Code verified'})
+
+@router.route('POST', 'disable', auth=True)
+def disable(request: Request) -> Dict[str, Any]:
+    conn = shard_connection(request.user['user_id'])
+    cur = conn.cursor()
+    
+    execute(cur, DISABLE_2FA, (request.user['user_id'],))
+    conn.commit()
+    consistency = record_write(conn, request.user['user_id'])
+    cur.close()
+    release(conn)
+    
+    return respond(200, {'message': '2FA disabled successfully'}, consistency)
+
+@router.route('GET', 'status', auth=True)
+def status(request: Request) -> Dict[str, Any]:
+    return serve(reads.two_factor_status, request)
+
+@instrument
+def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
+    return router.dispatch(event, context)
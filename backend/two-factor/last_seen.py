@@ -0,0 +1,147 @@
+'''
+Write-coalesced last_login_at / last_seen_at tracking shared by the auth,
+oauth, two-factor, admin, batch and chat functions (each function directory
+carries its own copy because functions are deployed independently).
+
+seen() is called for every authenticated request and login() for every
+successful sign-in. Neither touches the database: they note the time in an
+in-process buffer, and seen() skips a user already noted within
+LAST_SEEN_INTERVAL_SECONDS, so an active user costs at most one write per
+interval and instance instead of one per request. The router calls flush_due()
+at the end of every request, before the response is returned: once
+LAST_SEEN_FLUSH_SECONDS have passed since the last flush (or the buffer holds
+LAST_SEEN_BATCH users) that request writes the buffer with one UPDATE ... FROM
+(VALUES ...) per shard, in id order so that instances flushing at the same time
+lock rows in the same order. The connection comes off the idle list, so it is
+usually the one the request itself just released. GREATEST() keeps a late
+flush from moving a timestamp back.
+
+There is no background thread, which a frozen instance would stop mid-flush:
+the buffer is only written inside a request. The columns are therefore up to
+one interval plus one flush interval behind. An instance frozen for good or
+killed loses what it buffered since its last flush (a normal exit flushes), at
+most LAST_SEEN_FLUSH_SECONDS of requests, which is fine for activity reporting
+and stale-account cleanup but not for security decisions. A failed flush puts
+its rows back for the next one.
+'''
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import psycopg2
+import psycopg2.extras
+from db import shard_connection, shard_for, release
+
+INTERVAL_SECONDS = float(os.environ.get('LAST_SEEN_INTERVAL_SECONDS', '300'))
+FLUSH_SECONDS = float(os.environ.get('LAST_SEEN_FLUSH_SECONDS', '10'))
+BATCH = int(os.environ.get('LAST_SEEN_BATCH', '500'))
+MAX_PENDING = BATCH * 20
+
+# The VALUES list changes length with the batch, so this one is not a prepared statement().
+FLUSH_SQL = """
+    UPDATE users SET
+        last_seen_at = GREATEST(users.last_seen_at, v.seen_at),
+        last_login_at = GREATEST(users.last_login_at, v.login_at)
+    FROM (VALUES %s) AS v(id, seen_at, login_at)
+    WHERE users.id = v.id
+"""
+VALUES_TEMPLATE = '(%s, %s::timestamp, %s::timestamp)'
+
+# user_id -> [seen_at, login_at or None]
+_pending: Dict[int, List[Optional[datetime]]] = {}
+# user_id -> monotonic time seen() last buffered it
+_noted: Dict[int, float] = {}
+_lock = threading.Lock()
+# The first request of an instance flushes right away.
+_last_flush = float('-inf')
+
+def seen(user_id: int):
+    '''Notes an authenticated request; at most once per user per LAST_SEEN_INTERVAL_SECONDS.'''
+    now = time.monotonic()
+    noted = _noted.get(user_id)
+    if noted is not None and now - noted < INTERVAL_SECONDS:
+        return
+    _note(user_id, now, False)
+
+def login(user_id: int):
+    '''Notes a successful login, which also counts as being seen.'''
+    _note(user_id, time.monotonic(), True)
+
+def _note(user_id: int, now: float, is_login: bool):
+    timestamp = datetime.now()
+    with _lock:
+        _noted[user_id] = now
+        entry = _pending.get(user_id)
+        if entry is None:
+            if len(_pending) >= MAX_PENDING:
+                # The database has been unreachable for a while; dropping is better than growing without bound.
+                return
+            _pending[user_id] = [timestamp, timestamp if is_login else None]
+        else:
+            entry[0] = timestamp
+            if is_login:
+                entry[1] = timestamp
+
+def _take() -> Dict[int, List[Optional[datetime]]]:
+    global _pending
+    with _lock:
+        taken, _pending = _pending, {}
+        # Forget users not seen for an interval; seen() lets them through again anyway.
+        cutoff = time.monotonic() - INTERVAL_SECONDS
+        for user_id in [user_id for user_id, noted in _noted.items() if noted < cutoff]:
+            del _noted[user_id]
+    return taken
+
+def _put_back(rows: Dict[int, List[Optional[datetime]]]):
+    with _lock:
+        for user_id, (seen_at, login_at) in rows.items():
+            entry = _pending.get(user_id)
+            if entry is None:
+                _pending[user_id] = [seen_at, login_at]
+            elif login_at is not None and (entry[1] is None or entry[1] < login_at):
+                entry[1] = login_at
+
+def flush() -> int:
+    '''Writes the buffered timestamps now; returns the number of users updated.'''
+    taken = _take()
+    by_shard: Dict[int, List[Tuple[int, Optional[datetime], Optional[datetime]]]] = {}
+    for user_id in sorted(taken):
+        seen_at, login_at = taken[user_id]
+        by_shard.setdefault(shard_for(user_id), []).append((user_id, seen_at, login_at))
+    
+    written = 0
+    for rows in by_shard.values():
+        try:
+            conn = shard_connection(rows[0][0])
+        except psycopg2.Error as exc:
+            print(f'last_seen flush failed: {exc}')
+            _put_back({row[0]: [row[1], row[2]] for row in rows})
+            continue
+        cur = conn.cursor()
+        try:
+            psycopg2.extras.execute_values(cur, FLUSH_SQL, rows, template=VALUES_TEMPLATE, page_size=BATCH)
+            conn.commit()
+            written += len(rows)
+        except psycopg2.Error as exc:
+            conn.rollback()
+            print(f'last_seen flush failed: {exc}')
+            _put_back({row[0]: [row[1], row[2]] for row in rows})
+        finally:
+            cur.close()
+            release(conn)
+    return written
+
+def flush_due() -> int:
+    '''Flushes when LAST_SEEN_FLUSH_SECONDS have passed since the last flush or LAST_SEEN_BATCH users are buffered.'''
+    global _last_flush
+    with _lock:
+        now = time.monotonic()
+        if not _pending or (now - _last_flush < FLUSH_SECONDS and len(_pending) < BATCH):
+            return 0
+        _last_flush = now
+    return flush()
+
+atexit.register(flush)
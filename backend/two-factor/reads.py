@@ -0,0 +1,316 @@
+'''
+Read-only GET actions shared by the auth, two-factor and admin functions and
+the batch function (each function directory carries its own copy because
+functions are deployed independently).
+
+A reader takes a Reads - the caller, one connection to the caller's shard and
+X-Min-LSN - and the action's parameters, and returns the response body or
+raises HTTPError. The functions answer their own GET actions with serve(); the
+batch function runs several readers on one Reads, so a batch authenticates once
+and holds one connection to the caller's shard, which the admin readers'
+fan_out() also uses for that shard.
+'''
+import heapq
+import itertools
+from datetime import datetime, timedelta
+from typing import Dict, Any, Callable, List, Optional, Tuple
+from activity import ACTIONS
+from db import shard_for, shard_read_connection, shard_urls, fan_out, release, statement, execute, Statement, PooledConnection
+from router import Request, HTTPError, respond
+
+SELECT_ROLE = statement('admin_select_role', "SELECT role FROM users WHERE id = %s")
+SELECT_PROFILE = statement('auth_select_profile', "SELECT id, email, first_name, last_name, avatar_url, created_at FROM users WHERE id = %s")
+SELECT_2FA_STATUS = statement('tfa_select_status', "SELECT two_factor_enabled FROM users WHERE id = %s")
+LIST_USERS = statement('admin_list_users', "SELECT id, email, first_name, last_name, role, is_active, two_factor_enabled, created_at, last_login_at, last_seen_at FROM users ORDER BY created_at DESC LIMIT %s OFFSET %s")
+COUNT_USERS = statement('admin_count_users', "SELECT COUNT(*) FROM users")
+# Users not seen since a cutoff; those never seen count from their creation.
+LIST_INACTIVE_USERS = statement('admin_list_inactive_users', "SELECT id, email, first_name, last_name, role, is_active, two_factor_enabled, created_at, last_login_at, last_seen_at FROM users WHERE COALESCE(last_seen_at, created_at) < %s ORDER BY created_at DESC LIMIT %s OFFSET %s")
+COUNT_INACTIVE_USERS = statement('admin_count_inactive_users', "SELECT COUNT(*) FROM users WHERE COALESCE(last_seen_at, created_at) < %s")
+LIST_ACTIVITY = statement('admin_list_activity', "SELECT al.id, al.user_id, u.email, al.action, al.ip_address, al.created_at FROM user_activity_log al LEFT JOIN users u ON al.user_id = u.id ORDER BY al.created_at DESC LIMIT %s OFFSET %s")
+COUNT_ACTIVITY = statement('admin_count_activity', "SELECT COUNT(*) FROM user_activity_log")
+COUNT_ADMINS = statement('admin_count_admins', "SELECT COUNT(*) FROM users WHERE role = 'admin'")
+COUNT_TWO_FACTOR = statement('admin_count_two_factor', "SELECT COUNT(*) FROM users WHERE two_factor_enabled = TRUE")
+COUNT_ACTIVE = statement('admin_count_active', "SELECT COUNT(*) FROM users WHERE is_active = TRUE")
+TIMESERIES = {
+    'hour': statement('admin_timeseries_hourly', "SELECT action, bucket, events FROM activity_rollup_hourly WHERE action = ANY(%s) AND bucket >= %s AND bucket < %s"),
+    'day': statement('admin_timeseries_daily', "SELECT action, bucket, events FROM activity_rollup_daily WHERE action = ANY(%s) AND bucket >= %s AND bucket < %s"),
+}
+SELECT_WATERMARK = statement('admin_rollup_watermark', "SELECT last_created_at FROM activity_rollup_state WHERE id = TRUE")
+
+# Deepest page of the users and activity-log lists. Offsets are read and thrown
+# away, by every shard when sharded, so deep pages cost a scan of everything before them.
+MAX_PAGE = 200
+
+# granularity -> (bucket width, default range, longest range served)
+GRANULARITIES = {
+    'hour': (timedelta(hours=1), timedelta(days=1), timedelta(days=93)),
+    'day': (timedelta(days=1), timedelta(days=30), timedelta(days=3660)),
+}
+
+class Reads:
+    '''The caller's user id, a read connection to their shard and X-Min-LSN, shared by the readers of one request.'''
+    def __init__(self, user_id: int, conn: PooledConnection, min_lsn: str = ''):
+        self.user_id = user_id
+        self.conn = conn
+        self.min_lsn = min_lsn
+        self._role: Optional[str] = None
+    
+    @property
+    def role(self) -> str:
+        '''The caller's role, looked up once.'''
+        if self._role is None:
+            cur = self.conn.cursor()
+            execute(cur, SELECT_ROLE, (self.user_id,))
+            row = cur.fetchone()
+            cur.close()
+            self._role = row[0] if row else ''
+        return self._role
+    
+    def fan_out(self, func: Callable[[PooledConnection], Any]) -> List[Any]:
+        '''db.fan_out() for a read, with this connection serving the caller's shard.'''
+        return fan_out(func, min_lsn=self.min_lsn, reuse=(shard_for(self.user_id), self.conn))
+
+# (function, action) -> (reader, admin only)
+READERS: Dict[Tuple[str, str], Tuple[Callable[[Reads, Dict[str, Any]], Any], bool]] = {}
+
+def reader(function: str, action: str, admin: bool = False) -> Callable:
+    def decorator(func: Callable[[Reads, Dict[str, Any]], Any]) -> Callable[[Reads, Dict[str, Any]], Any]:
+        READERS[(function, action)] = (func, admin)
+        return func
+    return decorator
+
+def serve(func: Callable[[Reads, Dict[str, Any]], Any], request: Request) -> Dict[str, Any]:
+    '''Answers a function's own GET action with a reader; the function's authenticate has checked the caller.'''
+    user_id = request.user['user_id']
+    conn = shard_read_connection(user_id, request.header('x-min-lsn'))
+    try:
+        body = func(Reads(user_id, conn, request.header('x-min-lsn')), request.params)
+    finally:
+        release(conn)
+    return respond(200, body)
+
+def merged_page(reads: Reads, list_stmt: Statement, count_stmt: Statement, created_at: int, limit: int, offset: int, params: Tuple[Any, ...] = ()) -> Tuple[List[Tuple[Any, ...]], int]:
+    '''
+    One page of rows ordered by created_at (the row's column at that index)
+    newest first across all shards, and the total count. params come before
+    the statements' limit and offset. Each shard returns its
+    first offset + limit rows, which hold every row of the page however the
+    page is spread over the shards, and the merge keeps offset..offset + limit.
+    '''
+    sharded = len(shard_urls()) > 1
+    
+    def read(conn: Any) -> Tuple[List[Tuple[Any, ...]], int]:
+        cur = conn.cursor()
+        execute(cur, list_stmt, params + ((offset + limit, 0) if sharded else (limit, offset)))
+        rows = cur.fetchall()
+        execute(cur, count_stmt, params)
+        total_count = cur.fetchone()[0]
+        cur.close()
+        return rows, total_count
+    
+    pages = reads.fan_out(read)
+    if not sharded:
+        return pages[0]
+    merged = heapq.merge(*(rows for rows, _ in pages), key=lambda row: row[created_at] or datetime.min, reverse=True)
+    return list(itertools.islice(merged, offset, offset + limit)), sum(total_count for _, total_count in pages)
+
+def page_number(params: Dict[str, Any]) -> int:
+    '''The ?page parameter: below 1 counts as 1, past MAX_PAGE or not a number is a 400.'''
+    try:
+        page = max(1, int(params.get('page') or 1))
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'page must be a number')
+    if page > MAX_PAGE:
+        raise HTTPError(400, f'page must be at most {MAX_PAGE}')
+    return page
+
+def page_count(total_count: int, limit: int) -> int:
+    return min((total_count + limit - 1) // limit, MAX_PAGE)
+
+def inactive_since(value: Any) -> datetime:
+    '''The cutoff for an inactive_days / days parameter.'''
+    try:
+        days = int(value)
+    except (TypeError, ValueError):
+        raise HTTPError(400, 'days must be a number')
+    if not 1 <= days <= 36500:
+        raise HTTPError(400, 'days must be between 1 and 36500')
+    return datetime.now() - timedelta(days=days)
+
+def bucket_start(moment: datetime, granularity: str) -> datetime:
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+@reader('auth', 'profile')
+def profile(reads: Reads, params: Dict[str, Any]) -> Dict[str, Any]:
+    cur = reads.conn.cursor()
+    execute(cur, SELECT_PROFILE, (reads.user_id,))
+    user = cur.fetchone()
+    cur.close()
+    
+    if not user:
+        raise HTTPError(404, 'User not found')
+    
+    return {
+        'user': {
+            'id': user[0],
+            'email': user[1],
+            'first_name': user[2],
+            'last_name': user[3],
+            'avatar_url': user[4],
+            'created_at': user[5].isoformat() if user[5] else None
+        }
+    }
+
+@reader('two-factor', 'status')
+def two_factor_status(reads: Reads, params: Dict[str, Any]) -> Dict[str, Any]:
+    cur = reads.conn.cursor()
+    execute(cur, SELECT_2FA_STATUS, (reads.user_id,))
+    user = cur.fetchone()
+    cur.close()
+    
+    if not user:
+        raise HTTPError(404, 'User not found')
+    
+    return {'two_factor_enabled': user[0]}
+
+@reader('admin', 'users', admin=True)
+def users(reads: Reads, params: Dict[str, Any]) -> Dict[str, Any]:
+    page = page_number(params)
+    limit = 20
+    offset = (page - 1) * limit
+    
+    # ?inactive_days=N lists only the users not seen for N days.
+    if params.get('inactive_days'):
+        cutoff = inactive_since(params['inactive_days'])
+        rows, total_count = merged_page(reads, LIST_INACTIVE_USERS, COUNT_INACTIVE_USERS, 7, limit, offset, (cutoff,))
+    else:
+        rows, total_count = merged_page(reads, LIST_USERS, COUNT_USERS, 7, limit, offset)
+    
+    users_list = []
+    for user in rows:
+        users_list.append({
+            'id': user[0],
+            'email': user[1],
+            'first_name': user[2],
+            'last_name': user[3],
+            'role': user[4],
+            'is_active': user[5],
+            'two_factor_enabled': user[6],
+            'created_at': user[7].isoformat() if user[7] else None,
+            'last_login_at': user[8].isoformat() if user[8] else None,
+            'last_seen_at': user[9].isoformat() if user[9] else None
+        })
+    
+    return {
+        'users': users_list,
+        'total': total_count,
+        'page': page,
+        'pages': page_count(total_count, limit)
+    }
+
+@reader('admin', 'activity-log', admin=True)
+def activity_log(reads: Reads, params: Dict[str, Any]) -> Dict[str, Any]:
+    page = page_number(params)
+    limit = 50
+    offset = (page - 1) * limit
+    
+    # Log rows sit on their user's shard, so the email join stays local.
+    logs, total_count = merged_page(reads, LIST_ACTIVITY, COUNT_ACTIVITY, 5, limit, offset)
+    
+    logs_list = []
+    for log in logs:
+        logs_list.append({
+            'id': log[0],
+            'user_id': log[1],
+            'email': log[2],
+            'action': log[3],
+            'ip_address': log[4],
+            'created_at': log[5].isoformat() if log[5] else None
+        })
+    
+    return {
+        'logs': logs_list,
+        'total': total_count,
+        'page': page,
+        'pages': page_count(total_count, limit)
+    }
+
+@reader('admin', 'stats', admin=True)
+def stats(reads: Reads, params: Dict[str, Any]) -> Dict[str, Any]:
+    def count(conn: Any) -> List[int]:
+        cur = conn.cursor()
+        counts = []
+        for stmt in (COUNT_USERS, COUNT_ADMINS, COUNT_TWO_FACTOR, COUNT_ACTIVE):
+            execute(cur, stmt)
+            counts.append(cur.fetchone()[0])
+        cur.close()
+        return counts
+    
+    total_users, admin_count, two_factor_count, active_users = (sum(column) for column in zip(*reads.fan_out(count)))
+    
+    return {
+        'total_users': total_users,
+        'admin_count': admin_count,
+        'two_factor_enabled_count': two_factor_count,
+        'active_users': active_users
+    }
+
+@reader('admin', 'timeseries', admin=True)
+def timeseries(reads: Reads, params: Dict[str, Any]) -> Dict[str, Any]:
+    granularity = params.get('granularity', 'hour')
+    if granularity not in GRANULARITIES:
+        raise HTTPError(400, 'granularity must be hour or day')
+    width, default_range, max_range = GRANULARITIES[granularity]
+    
+    actions = [action for action in params.get('events', ','.join(ACTIONS)).split(',') if action]
+    if not actions or any(action not in ACTIONS for action in actions):
+        raise HTTPError(400, f"events must be a comma separated subset of {', '.join(ACTIONS)}")
+    
+    try:
+        end = datetime.fromisoformat(params['to']) if params.get('to') else datetime.now()
+        start = datetime.fromisoformat(params['from']) if params.get('from') else end - default_range
+    except ValueError:
+        raise HTTPError(400, 'from and to must be ISO 8601 timestamps')
+    
+    # Whole buckets: the one containing start through the one containing end.
+    start = bucket_start(start.replace(tzinfo=None), granularity)
+    end = bucket_start(end.replace(tzinfo=None), granularity) + width
+    if start >= end or end - start > max_range:
+        raise HTTPError(400, f'Range must be positive and at most {max_range.days} days')
+    
+    def read(conn: Any) -> Tuple[List[Tuple[Any, ...]], Optional[datetime]]:
+        cur = conn.cursor()
+        execute(cur, TIMESERIES[granularity], (actions, start, end))
+        rows = cur.fetchall()
+        execute(cur, SELECT_WATERMARK)
+        watermark = cur.fetchone()
+        cur.close()
+        return rows, watermark[0] if watermark else None
+    
+    shards = reads.fan_out(read)
+    
+    # Each shard rolls up its own log; the series is their sum and is complete up to the least advanced shard.
+    counts: Dict[Tuple[str, datetime], int] = {}
+    for rows, _ in shards:
+        for row in rows:
+            # Daily buckets come back as dates.
+            key = (row[0], row[1] if isinstance(row[1], datetime) else datetime(row[1].year, row[1].month, row[1].day))
+            counts[key] = counts.get(key, 0) + row[2]
+    watermarks = [shard_watermark for _, shard_watermark in shards]
+    aggregated_through = None if None in watermarks else min(watermarks)
+    buckets = []
+    moment = start
+    while moment < end:
+        buckets.append(moment)
+        moment += width
+    
+    return {
+        'granularity': granularity,
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'buckets': [bucket.isoformat() for bucket in buckets],
+        'series': {action: [counts.get((action, bucket), 0) for bucket in buckets] for action in actions},
+        'aggregated_through': aggregated_through.isoformat() if aggregated_through else None
+    }
@@ -0,0 +1,18 @@
+-- Create login sessions table; access tokens carry the session id, refresh tokens rotate the stored hash
+CREATE TABLE IF NOT EXISTS auth_sessions (
+    id SERIAL PRIMARY KEY,
+    user_id INTEGER REFERENCES users(id) NOT NULL,
+    refresh_token_hash VARCHAR(64) NOT NULL,
+    previous_token_hash VARCHAR(64),
+    ip_address VARCHAR(45),
+    user_agent TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    refreshed_at TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    revoked_at TIMESTAMP,
+    revoked_reason VARCHAR(50)
+);
+
+-- Create indexes for revoking a user's sessions and for reloading recent revocations
+CREATE INDEX IF NOT EXISTS idx_auth_sessions_user_id ON auth_sessions(user_id) WHERE revoked_at IS NULL;
+CREATE INDEX IF NOT EXISTS idx_auth_sessions_revoked_at ON auth_sessions(revoked_at) WHERE revoked_at IS NOT NULL;
@@ -0,0 +1,13 @@
+-- Drop indexes that duplicate the UNIQUE constraints on users.email and password_reset_tokens.token
+DROP INDEX IF EXISTS idx_users_email;
+DROP INDEX IF EXISTS idx_password_reset_tokens_token;
+
+-- Create ordering index for the admin user list (newest first)
+CREATE INDEX IF NOT EXISTS idx_users_created_at ON users(created_at DESC);
+
+-- Create covering index for the admin activity log so the page is read from the index alone
+CREATE INDEX IF NOT EXISTS idx_user_activity_log_created_at ON user_activity_log(created_at DESC) INCLUDE (id, user_id, action, ip_address);
+
+-- Replace the OAuth lookup index with one that also covers the returned profile columns
+CREATE INDEX IF NOT EXISTS idx_users_oauth_profile ON users(oauth_provider, oauth_id) INCLUDE (id, email, first_name, last_name, avatar_url);
+DROP INDEX IF EXISTS idx_users_oauth;
@@ -0,0 +1,14 @@
+-- Detach duplicate OAuth identities left by concurrent callbacks, keeping the oldest account
+UPDATE users SET oauth_provider = NULL, oauth_id = NULL
+WHERE id IN (
+    SELECT id FROM (
+        SELECT id, ROW_NUMBER() OVER (PARTITION BY oauth_provider, oauth_id ORDER BY id) AS position
+        FROM users
+        WHERE oauth_provider IS NOT NULL AND oauth_id IS NOT NULL
+    ) ranked
+    WHERE position > 1
+);
+
+-- Create unique OAuth identity index (conflict target of the callback upsert), still covering the profile columns
+CREATE UNIQUE INDEX IF NOT EXISTS idx_users_oauth_identity ON users(oauth_provider, oauth_id) INCLUDE (id, email, first_name, last_name, avatar_url);
+DROP INDEX IF EXISTS idx_users_oauth_profile;
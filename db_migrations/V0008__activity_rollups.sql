@@ -0,0 +1,24 @@
+-- Create hourly and daily activity counts per action, maintained from user_activity_log by the rollup job
+CREATE TABLE IF NOT EXISTS activity_rollup_hourly (
+    action VARCHAR(100) NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+    events BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (action, bucket)
+);
+
+CREATE TABLE IF NOT EXISTS activity_rollup_daily (
+    action VARCHAR(100) NOT NULL,
+    bucket DATE NOT NULL,
+    events BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (action, bucket)
+);
+
+-- Create the rollup watermark: the last user_activity_log id already counted
+CREATE TABLE IF NOT EXISTS activity_rollup_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    last_id INTEGER NOT NULL DEFAULT 0,
+    last_created_at TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+INSERT INTO activity_rollup_state (id, last_id) VALUES (TRUE, 0) ON CONFLICT (id) DO NOTHING;
@@ -0,0 +1,12 @@
+-- Create the Idempotency-Key store: one row per (function, key) hash with the stored response
+CREATE TABLE IF NOT EXISTS idempotency_keys (
+    key VARCHAR(64) PRIMARY KEY,
+    fingerprint VARCHAR(64) NOT NULL,
+    response JSONB,
+    locked_until TIMESTAMP,
+    expires_at TIMESTAMP NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Create index for purging expired keys
+CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys(expires_at);
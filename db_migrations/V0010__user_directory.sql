@@ -0,0 +1,27 @@
+-- Create the user directory: the global id of every email and the shard its user lives on
+CREATE TABLE IF NOT EXISTS user_directory (
+    id SERIAL PRIMARY KEY,
+    email VARCHAR(255) UNIQUE NOT NULL,
+    shard INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Register the existing users, which all live in this database, and hand out ids after theirs
+INSERT INTO user_directory (id, email, shard, created_at)
+SELECT id, email, 0, created_at FROM users
+ON CONFLICT DO NOTHING;
+
+SELECT setval(pg_get_serial_sequence('user_directory', 'id'), GREATEST((SELECT MAX(id) FROM user_directory), (SELECT last_value FROM users_id_seq)));
+
+-- Point the global tables at the directory: with shards the users row can live in another database
+ALTER TABLE auth_sessions DROP CONSTRAINT IF EXISTS auth_sessions_user_id_fkey;
+ALTER TABLE auth_sessions ADD CONSTRAINT auth_sessions_user_id_fkey FOREIGN KEY (user_id) REFERENCES user_directory(id) NOT VALID;
+ALTER TABLE auth_sessions VALIDATE CONSTRAINT auth_sessions_user_id_fkey;
+
+ALTER TABLE password_reset_tokens DROP CONSTRAINT IF EXISTS password_reset_tokens_user_id_fkey;
+ALTER TABLE password_reset_tokens ADD CONSTRAINT password_reset_tokens_user_id_fkey FOREIGN KEY (user_id) REFERENCES user_directory(id) NOT VALID;
+ALTER TABLE password_reset_tokens VALIDATE CONSTRAINT password_reset_tokens_user_id_fkey;
+
+ALTER TABLE chat_sessions DROP CONSTRAINT IF EXISTS chat_sessions_user_id_fkey;
+ALTER TABLE chat_sessions ADD CONSTRAINT chat_sessions_user_id_fkey FOREIGN KEY (user_id) REFERENCES user_directory(id) NOT VALID;
+ALTER TABLE chat_sessions VALIDATE CONSTRAINT chat_sessions_user_id_fkey;
@@ -0,0 +1,17 @@
+-- Add last login / last seen timestamps, written in batches by backend/*/last_seen.py
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_login_at TIMESTAMP;
+ALTER TABLE users ADD COLUMN IF NOT EXISTS last_seen_at TIMESTAMP;
+
+-- Backfill the last login from the activity log
+-- migrate:batch key=id size=5000 sleep=0.05
+UPDATE users SET last_login_at = (
+    SELECT MAX(created_at) FROM user_activity_log
+    WHERE user_activity_log.user_id = users.id AND action IN ('login', 'oauth_login', 'register')
+)
+WHERE last_login_at IS NULL;
+
+-- migrate:batch key=id size=5000 sleep=0.05
+UPDATE users SET last_seen_at = last_login_at WHERE last_seen_at IS NULL AND last_login_at IS NOT NULL;
+
+-- Create index for stale-account cleanup: users not seen since a cutoff (creation time for those never seen)
+CREATE INDEX IF NOT EXISTS idx_users_last_active ON users((COALESCE(last_seen_at, created_at)));
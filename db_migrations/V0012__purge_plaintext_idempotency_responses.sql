@@ -0,0 +1,2 @@
+-- Drop responses stored before they were sealed: they hold live access and refresh tokens in plaintext
+DELETE FROM idempotency_keys WHERE response IS NOT NULL;
@@ -0,0 +1,25 @@
+-- Stop if several accounts share one OAuth identity, which idx_users_oauth_identity should rule out
+-- but does not while the index is missing or INVALID (a failed concurrent build of V0007).
+-- Each line of the error DETAIL is one identity and its accounts; merge or detach them by hand
+-- (the accounts may each hold sessions, chats and activity), then rebuild the index and migrate again.
+-- Databases that applied V0007 before this check have already had such duplicates detached by it.
+DO $$
+DECLARE
+    conflicts TEXT;
+BEGIN
+    SELECT string_agg(format('%s/%s: users %s', oauth_provider, oauth_id, ids), E'\n' ORDER BY oauth_provider, oauth_id)
+    INTO conflicts
+    FROM (
+        SELECT oauth_provider, oauth_id, string_agg(id::text, ', ' ORDER BY id) AS ids
+        FROM users
+        WHERE oauth_provider IS NOT NULL AND oauth_id IS NOT NULL
+        GROUP BY oauth_provider, oauth_id
+        HAVING COUNT(*) > 1
+    ) duplicates;
+
+    IF conflicts IS NOT NULL THEN
+        RAISE EXCEPTION 'duplicate OAuth identities, resolve them and rebuild idx_users_oauth_identity'
+            USING DETAIL = conflicts;
+    END IF;
+END
+$$;
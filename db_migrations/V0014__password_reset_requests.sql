@@ -0,0 +1,14 @@
+-- Create the queue of password reset requests: reset-password-request only inserts a row and the
+-- delivery thread or tools/send_reset_emails.py sends the email; the rows also rate-limit requests
+CREATE TABLE IF NOT EXISTS password_reset_requests (
+    id SERIAL PRIMARY KEY,
+    email VARCHAR(255) NOT NULL,
+    ip_address VARCHAR(45),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    sent_at TIMESTAMP
+);
+
+-- Create indexes for the per-address and per-IP request counts and for claiming unsent requests
+CREATE INDEX IF NOT EXISTS idx_password_reset_requests_email ON password_reset_requests(lower(email), created_at);
+CREATE INDEX IF NOT EXISTS idx_password_reset_requests_ip ON password_reset_requests(ip_address, created_at);
+CREATE INDEX IF NOT EXISTS idx_password_reset_requests_pending ON password_reset_requests(id) WHERE sent_at IS NULL;
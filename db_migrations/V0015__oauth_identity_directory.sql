@@ -0,0 +1,16 @@
+-- Create the OAuth identity directory: the global user id of every provider identity, so a returning
+-- identity is found whatever email the provider reports now and whichever shard its user lives on
+CREATE TABLE IF NOT EXISTS oauth_identities (
+    oauth_provider VARCHAR(50) NOT NULL,
+    oauth_id VARCHAR(255) NOT NULL,
+    user_id INTEGER REFERENCES user_directory(id) NOT NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (oauth_provider, oauth_id)
+);
+
+-- Register the identities of the users in this database; identities on other shards are found by the
+-- callback's fan-out lookup on first sign-in and registered then
+INSERT INTO oauth_identities (oauth_provider, oauth_id, user_id)
+SELECT oauth_provider, oauth_id, id FROM users
+WHERE oauth_provider IS NOT NULL AND oauth_id IS NOT NULL AND id IN (SELECT id FROM user_directory)
+ON CONFLICT DO NOTHING;
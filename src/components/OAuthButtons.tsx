@@ -1,7 +1,7 @@
 import { useState } from 'react';
 import NeomorphButton from './NeomorphButton';
 import Icon from '@/components/ui/icon';
-import { oauthAPI } from '@/lib/oauth';
+import { oauthAPI, OAuthProvider } from '@/lib/oauth';
 
 interface OAuthButtonsProps {
   onSuccess: (token: string, user: any) => void;
@@ -11,7 +11,7 @@ interface OAuthButtonsProps {
 export default function OAuthButtons({ onSuccess, onError }: OAuthButtonsProps) {
   const [loading, setLoading] = useState(false);
 
-  const handleOAuth = async (provider: 'google' | 'github') => {
+  const handleOAuth = async (provider: OAuthProvider) => {
     setLoading(true);
     try {
       const callbackUrl = `${window.location.origin}/auth/callback`;
@@ -1,3 +1,5 @@
+import { consistencyHeaders, rememberWrite } from './consistency';
+
 const ADMIN_API_URL = 'https://functions.poehali.dev/de0fba6f-e587-458d-a220-b88fd6e72298';
 
 export interface AdminUser {
@@ -9,6 +11,8 @@ export interface AdminUser {
   is_active: boolean;
   two_factor_enabled: boolean;
   created_at?: string;
+  last_login_at?: string | null;
+  last_seen_at?: string | null;
 }
 
 export interface AdminStats {
@@ -27,11 +31,21 @@ export interface ActivityLog {
   created_at: string;
 }
 
+export interface ActivityTimeseries {
+  granularity: 'hour' | 'day';
+  from: string;
+  to: string;
+  buckets: string[];
+  series: Record<string, number[]>;
+  aggregated_through: string | null;
+}
+
 class AdminAPI {
   private getHeaders(token: string): HeadersInit {
     return {
       'Content-Type': 'application/json',
       'X-Auth-Token': token,
+      ...consistencyHeaders(),
     };
   }
 
@@ -57,6 +71,8 @@ class AdminAPI {
       body: JSON.stringify({ user_id: userId, role }),
     });
 
+    rememberWrite(response);
+
     const data = await response.json();
 
     if (!response.ok) {
@@ -71,6 +87,8 @@ class AdminAPI {
       body: JSON.stringify({ user_id: userId, is_active: isActive }),
     });
 
+    rememberWrite(response);
+
     const data = await response.json();
 
     if (!response.ok) {
@@ -93,6 +111,26 @@ class AdminAPI {
     return data;
   }
 
+  async getTimeseries(
+    token: string,
+    granularity: 'hour' | 'day',
+    events: string[]
+  ): Promise<ActivityTimeseries> {
+    const params = new URLSearchParams({ action: 'timeseries', granularity, events: events.join(',') });
+    const response = await fetch(`${ADMIN_API_URL}?${params}`, {
+      method: 'GET',
+      headers: this.getHeaders(token),
+    });
+
+    const data = await response.json();
+
+    if (!response.ok) {
+      throw new Error(data.error || 'Failed to fetch activity timeseries');
+    }
+
+    return data;
+  }
+
   async getStats(token: string): Promise<AdminStats> {
     const response = await fetch(`${ADMIN_API_URL}?action=stats`, {
       method: 'GET',
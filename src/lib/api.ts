@@ -1,3 +1,5 @@
+import { consistencyHeaders, rememberWrite } from './consistency';
+
 const API_URL = 'https://functions.poehali.dev/17f386c1-c7a5-4462-913e-738a1e280193';
 
 export interface User {
@@ -11,17 +13,26 @@ export interface User {
 
 export interface AuthResponse {
   token: string;
+  refresh_token: string;
+  expires_in: number;
   user: User;
 }
 
+export interface TokenPair {
+  token: string;
+  refresh_token: string;
+  expires_in: number;
+}
+
 export interface ErrorResponse {
   error: string;
 }
 
 class AuthAPI {
   private getHeaders(token?: string): HeadersInit {
-    const headers: HeadersInit = {
+    const headers: Record<string, string> = {
       'Content-Type': 'application/json',
+      ...consistencyHeaders(),
     };
     
     if (token) {
@@ -73,6 +84,29 @@ class AuthAPI {
     return data;
   }
 
+  async refresh(refreshToken: string): Promise<TokenPair> {
+    const response = await fetch(`${API_URL}?action=refresh`, {
+      method: 'POST',
+      headers: this.getHeaders(),
+      body: JSON.stringify({ refresh_token: refreshToken }),
+    });
+
+    const data = await response.json();
+
+    if (!response.ok) {
+      throw new Error(data.error || 'Session expired');
+    }
+
+    return data;
+  }
+
+  async logout(token: string): Promise<void> {
+    await fetch(`${API_URL}?action=logout`, {
+      method: 'POST',
+      headers: this.getHeaders(token),
+    });
+  }
+
   async getProfile(token: string): Promise<User> {
     const response = await fetch(`${API_URL}?action=profile`, {
       method: 'GET',
@@ -91,8 +125,7 @@ class AuthAPI {
   async updateProfile(
     token: string,
     firstName: string,
-    lastName: string,
-    avatarUrl: string
+    lastName: string
   ): Promise<User> {
     const response = await fetch(`${API_URL}?action=profile`, {
       method: 'PUT',
@@ -100,10 +133,11 @@ class AuthAPI {
       body: JSON.stringify({
         first_name: firstName,
         last_name: lastName,
-        avatar_url: avatarUrl,
       }),
     });
 
+    rememberWrite(response);
+
     const data = await response.json();
 
     if (!response.ok) {
@@ -113,7 +147,25 @@ class AuthAPI {
     return data.user;
   }
 
-  async requestPasswordReset(email: string): Promise<{ message: string; reset_token?: string }> {
+  async uploadAvatar(token: string, image: string): Promise<User> {
+    const response = await fetch(`${API_URL}?action=avatar`, {
+      method: 'POST',
+      headers: this.getHeaders(token),
+      body: JSON.stringify({ image }),
+    });
+
+    rememberWrite(response);
+
+    const data = await response.json();
+
+    if (!response.ok) {
+      throw new Error(data.error || 'Failed to upload avatar');
+    }
+
+    return data.user;
+  }
+
+  async requestPasswordReset(email: string): Promise<{ message: string }> {
     const response = await fetch(`${API_URL}?action=reset-password-request`, {
       method: 'POST',
       headers: this.getHeaders(),
@@ -1,11 +1,18 @@
-import { User } from './api';
+import { authAPI, User } from './api';
 
 const TOKEN_KEY = 'auth_token';
+const REFRESH_TOKEN_KEY = 'auth_refresh_token';
 const USER_KEY = 'auth_user';
+const REFRESH_MARGIN_SECONDS = 60;
 
-export function saveAuth(token: string, user: User): void {
+let pendingRefresh: Promise<string | null> | null = null;
+
+export function saveAuth(token: string, user: User, refreshToken?: string): void {
   localStorage.setItem(TOKEN_KEY, token);
   localStorage.setItem(USER_KEY, JSON.stringify(user));
+  if (refreshToken) {
+    localStorage.setItem(REFRESH_TOKEN_KEY, refreshToken);
+  }
 }
 
 export function getToken(): string | null {
@@ -19,9 +26,66 @@ export function getUser(): User | null {
 
 export function clearAuth(): void {
   localStorage.removeItem(TOKEN_KEY);
+  localStorage.removeItem(REFRESH_TOKEN_KEY);
   localStorage.removeItem(USER_KEY);
 }
 
 export function isAuthenticated(): boolean {
   return !!getToken();
+}
+
+function tokenExpiresAt(token: string): number {
+  try {
+    const payload = JSON.parse(atob(token.split('.')[1].replace(/-/g, '+').replace(/_/g, '/')));
+    return payload.exp || 0;
+  } catch {
+    return 0;
+  }
+}
+
+// Returns an access token that is valid for at least another minute, rotating the
+// refresh token when needed. Concurrent callers share one refresh request, because
+// presenting an already rotated refresh token revokes the session.
+export async function getValidToken(): Promise<string | null> {
+  const token = getToken();
+  if (!token) {
+    return null;
+  }
+
+  if (tokenExpiresAt(token) - Date.now() / 1000 > REFRESH_MARGIN_SECONDS) {
+    return token;
+  }
+
+  const refreshToken = localStorage.getItem(REFRESH_TOKEN_KEY);
+  if (!refreshToken) {
+    clearAuth();
+    return null;
+  }
+
+  if (!pendingRefresh) {
+    pendingRefresh = authAPI
+      .refresh(refreshToken)
+      .then((tokens) => {
+        localStorage.setItem(TOKEN_KEY, tokens.token);
+        localStorage.setItem(REFRESH_TOKEN_KEY, tokens.refresh_token);
+        return tokens.token;
+      })
+      .catch(() => {
+        clearAuth();
+        return null;
+      })
+      .finally(() => {
+        pendingRefresh = null;
+      });
+  }
+
+  return pendingRefresh;
+}
+
+export async function logout(): Promise<void> {
+  const token = getToken();
+  clearAuth();
+  if (token) {
+    await authAPI.logout(token).catch(() => undefined);
+  }
 }
\ No newline at end of file
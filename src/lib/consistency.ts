@@ -0,0 +1,15 @@
+const MIN_LSN_KEY = 'db_min_lsn';
+
+// Writes answer with X-Write-LSN when the backend reads from replicas; sending it
+// back as X-Min-LSN keeps later reads from a replica that has not caught up yet.
+export function consistencyHeaders(): Record<string, string> {
+  const lsn = sessionStorage.getItem(MIN_LSN_KEY);
+  return lsn ? { 'X-Min-LSN': lsn } : {};
+}
+
+export function rememberWrite(response: Response): void {
+  const lsn = response.headers.get('X-Write-LSN');
+  if (lsn) {
+    sessionStorage.setItem(MIN_LSN_KEY, lsn);
+  }
+}
\ No newline at end of file
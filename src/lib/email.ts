@@ -3,8 +3,6 @@ const EMAIL_API_URL = 'https://functions.poehali.dev/9e72ce3d-fa65-46d8-9ee4-ae5
 interface EmailData {
   name?: string;
   app_url?: string;
-  reset_token?: string;
-  reset_url?: string;
 }
 
 class EmailAPI {
@@ -12,18 +10,6 @@ class EmailAPI {
     await this.sendEmail('welcome', toEmail, { name, app_url: appUrl });
   }
 
-  async sendPasswordResetEmail(
-    toEmail: string,
-    resetToken: string,
-    resetUrl: string
-  ): Promise<void> {
-    await this.sendEmail('password_reset', toEmail, { reset_token: resetToken, reset_url: resetUrl });
-  }
-
-  async sendPasswordChangedEmail(toEmail: string): Promise<void> {
-    await this.sendEmail('password_changed', toEmail, {});
-  }
-
   private async sendEmail(type: string, toEmail: string, data: EmailData): Promise<void> {
     const response = await fetch(EMAIL_API_URL, {
       method: 'POST',
@@ -1,11 +1,18 @@
 const OAUTH_API_URL = 'https://functions.poehali.dev/8e1396a8-a2d8-438c-a755-9345c4d8b0ca';
 
+export type OAuthProvider = 'google' | 'github';
+
+const OAUTH_STATE_KEY = 'oauth_state';
+
 export interface OAuthInitResponse {
   auth_url: string;
+  state: string;
 }
 
 export interface OAuthCallbackResponse {
   token: string;
+  refresh_token: string;
+  expires_in: number;
   user: {
     id: number;
     email: string;
@@ -16,7 +23,7 @@ export interface OAuthCallbackResponse {
 }
 
 class OAuthAPI {
-  async initOAuth(provider: 'google' | 'github', callbackUrl: string): Promise<OAuthInitResponse> {
+  async initOAuth(provider: OAuthProvider, callbackUrl: string): Promise<OAuthInitResponse> {
     const response = await fetch(
       `${OAUTH_API_URL}?action=init&provider=${provider}&callback_url=${encodeURIComponent(callbackUrl)}`,
       {
@@ -33,20 +40,24 @@ class OAuthAPI {
       throw new Error(data.error || 'OAuth init failed');
     }
 
+    // The callback must come back to this browser with the same state.
+    sessionStorage.setItem(OAUTH_STATE_KEY, data.state);
     return data;
   }
 
-  async handleOAuthCallback(
-    provider: 'google' | 'github',
-    code: string,
-    callbackUrl: string
-  ): Promise<OAuthCallbackResponse> {
-    const response = await fetch(`${OAUTH_API_URL}?action=callback&provider=${provider}`, {
+  async handleOAuthCallback(code: string, state: string): Promise<OAuthCallbackResponse> {
+    const expectedState = sessionStorage.getItem(OAUTH_STATE_KEY);
+    sessionStorage.removeItem(OAUTH_STATE_KEY);
+    if (!expectedState || expectedState !== state) {
+      throw new Error('OAuth state mismatch');
+    }
+
+    const response = await fetch(`${OAUTH_API_URL}?action=callback`, {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
       },
-      body: JSON.stringify({ code, callback_url: callbackUrl }),
+      body: JSON.stringify({ code, state }),
     });
 
     const data = await response.json();
@@ -1,3 +1,5 @@
+import { consistencyHeaders, rememberWrite } from './consistency';
+
 const TWO_FACTOR_API_URL = 'https://functions.poehali.dev/e0b23d6a-ea22-444f-b339-b9bb37071cb3';
 
 class TwoFactorAPI {
@@ -5,6 +7,7 @@ class TwoFactorAPI {
     return {
       'Content-Type': 'application/json',
       'X-Auth-Token': token,
+      ...consistencyHeaders(),
     };
   }
 
@@ -29,6 +32,8 @@ class TwoFactorAPI {
       headers: this.getHeaders(token),
     });
 
+    rememberWrite(response);
+
     const data = await response.json();
 
     if (!response.ok) {
@@ -60,6 +65,8 @@ class TwoFactorAPI {
       body: JSON.stringify({ code }),
     });
 
+    rememberWrite(response);
+
     const data = await response.json();
 
     if (!response.ok) {
@@ -89,6 +96,8 @@ class TwoFactorAPI {
       headers: this.getHeaders(token),
     });
 
+    rememberWrite(response);
+
     const data = await response.json();
 
     if (!response.ok) {
@@ -2,14 +2,21 @@ import { useState, useEffect } from 'react';
 import { useNavigate } from 'react-router-dom';
 import AuthLayout from '@/components/AuthLayout';
 import NeomorphButton from '@/components/NeomorphButton';
-import { adminAPI, AdminUser, AdminStats } from '@/lib/admin';
-import { getToken, getUser } from '@/lib/auth';
+import { adminAPI, AdminUser, AdminStats, ActivityTimeseries } from '@/lib/admin';
+import { getToken, getValidToken, getUser } from '@/lib/auth';
 import Icon from '@/components/ui/icon';
 
+const ACTIVITY_EVENTS = [
+  { action: 'login', label: 'Входы', color: 'bg-[#667EEA]' },
+  { action: 'login_failed', label: 'Неудачные входы', color: 'bg-[#F6AD55]' },
+  { action: '2fa_failed', label: 'Ошибки 2FA', color: 'bg-[#FC8181]' },
+];
+
 export default function AdminPanel() {
   const navigate = useNavigate();
   const [users, setUsers] = useState<AdminUser[]>([]);
   const [stats, setStats] = useState<AdminStats | null>(null);
+  const [activity, setActivity] = useState<ActivityTimeseries | null>(null);
   const [page, setPage] = useState(1);
   const [totalPages, setTotalPages] = useState(1);
   const [loading, setLoading] = useState(true);
@@ -29,19 +36,24 @@ export default function AdminPanel() {
   }, [page, navigate]);
 
   const loadData = async () => {
-    const token = getToken();
-    if (!token) return;
+    const token = await getValidToken();
+    if (!token) {
+      navigate('/login');
+      return;
+    }
 
     setLoading(true);
     setError('');
 
     try {
-      const [statsData, usersData] = await Promise.all([
+      const [statsData, usersData, activityData] = await Promise.all([
         adminAPI.getStats(token),
-        adminAPI.getUsers(token, page)
+        adminAPI.getUsers(token, page),
+        adminAPI.getTimeseries(token, 'day', ACTIVITY_EVENTS.map((event) => event.action))
       ]);
 
       setStats(statsData);
+      setActivity(activityData);
       setUsers(usersData.users);
       setTotalPages(usersData.pages);
     } catch (err) {
@@ -55,8 +67,11 @@ export default function AdminPanel() {
   };
 
   const handleRoleChange = async (userId: number, newRole: string) => {
-    const token = getToken();
-    if (!token) return;
+    const token = await getValidToken();
+    if (!token) {
+      navigate('/login');
+      return;
+    }
 
     try {
       await adminAPI.updateUserRole(token, userId, newRole);
@@ -67,8 +82,11 @@ export default function AdminPanel() {
   };
 
   const handleStatusChange = async (userId: number, isActive: boolean) => {
-    const token = getToken();
-    if (!token) return;
+    const token = await getValidToken();
+    if (!token) {
+      navigate('/login');
+      return;
+    }
 
     try {
       await adminAPI.updateUserStatus(token, userId, isActive);
@@ -160,6 +178,34 @@ export default function AdminPanel() {
           </div>
         )}
 
+        {tab === 'stats' && activity && (
+          <div className="bg-[#E0E5EC] rounded-3xl p-6 shadow-neomorph mt-6 space-y-6">
+            <p className="text-sm text-[#718096]">Активность за 30 дней</p>
+            {ACTIVITY_EVENTS.map(({ action, label, color }) => {
+              const values = activity.series[action] || [];
+              const max = Math.max(1, ...values);
+              return (
+                <div key={action}>
+                  <div className="flex items-center justify-between text-sm text-[#4A5568] mb-2">
+                    <span>{label}</span>
+                    <span className="font-bold">{values.reduce((sum, value) => sum + value, 0)}</span>
+                  </div>
+                  <div className="flex items-end gap-1 h-16">
+                    {values.map((value, index) => (
+                      <div
+                        key={activity.buckets[index]}
+                        title={`${activity.buckets[index].slice(0, 10)}: ${value}`}
+                        className={`flex-1 rounded-t ${color}`}
+                        style={{ height: `${(value / max) * 100}%` }}
+                      />
+                    ))}
+                  </div>
+                </div>
+              );
+            })}
+          </div>
+        )}
+
         {tab === 'users' && (
           <div className="bg-[#E0E5EC] rounded-3xl p-6 shadow-neomorph">
             <div className="space-y-4">
@@ -180,6 +226,11 @@ export default function AdminPanel() {
                         {user.first_name} {user.last_name}
                       </p>
                     )}
+                    <p className="text-xs text-[#A0AEC0]">
+                      {user.last_seen_at
+                        ? `Был в сети ${new Date(user.last_seen_at).toLocaleString('ru-RU')}`
+                        : 'Ещё не заходил'}
+                    </p>
                   </div>
 
                   <div className="flex items-center gap-2">
@@ -22,7 +22,7 @@ export default function Login() {
 
     try {
       const response = await authAPI.login(email, password);
-      saveAuth(response.token, response.user);
+      saveAuth(response.token, response.user, response.refresh_token);
       sessionStorage.setItem('just_logged_in', 'true');
       navigate('/');
     } catch (err) {
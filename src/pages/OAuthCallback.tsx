@@ -13,18 +13,17 @@ export default function OAuthCallback() {
   useEffect(() => {
     const handleCallback = async () => {
       const code = searchParams.get('code');
-      const provider = searchParams.get('provider') as 'google' | 'github';
+      const state = searchParams.get('state');
 
-      if (!code || !provider) {
+      if (!code || !state) {
         setError('Неверные параметры OAuth');
         return;
       }
 
       try {
-        const callbackUrl = `${window.location.origin}/auth/callback`;
-        const response = await oauthAPI.handleOAuthCallback(provider, code, callbackUrl);
+        const response = await oauthAPI.handleOAuthCallback(code, state);
         
-        saveAuth(response.token, response.user);
+        saveAuth(response.token, response.user, response.refresh_token);
         
         try {
           await emailAPI.sendWelcomeEmail(
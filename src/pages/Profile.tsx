@@ -4,7 +4,7 @@ import AuthLayout from '@/components/AuthLayout';
 import NeomorphInput from '@/components/NeomorphInput';
 import NeomorphButton from '@/components/NeomorphButton';
 import { authAPI, User } from '@/lib/api';
-import { getToken, clearAuth, getUser as getCachedUser, saveAuth } from '@/lib/auth';
+import { getToken, getValidToken, clearAuth, logout, getUser as getCachedUser, saveAuth } from '@/lib/auth';
 import Icon from '@/components/ui/icon';
 
 export default function Profile() {
@@ -26,7 +26,11 @@ export default function Profile() {
 
     const loadProfile = async () => {
       try {
-        const profileData = await authAPI.getProfile(token);
+        const validToken = await getValidToken();
+        if (!validToken) {
+          throw new Error('Session expired');
+        }
+        const profileData = await authAPI.getProfile(validToken);
         setUser(profileData);
         setFirstName(profileData.first_name || '');
         setLastName(profileData.last_name || '');
@@ -47,11 +51,14 @@ export default function Profile() {
     setSuccess('');
     setLoading(true);
 
-    const token = getToken();
-    if (!token) return;
+    const token = await getValidToken();
+    if (!token) {
+      navigate('/login');
+      return;
+    }
 
     try {
-      const updatedUser = await authAPI.updateProfile(token, firstName, lastName, avatarUrl);
+      const updatedUser = await authAPI.updateProfile(token, firstName, lastName);
       setUser(updatedUser);
       saveAuth(token, updatedUser);
       setSuccess('Профиль успешно обновлен!');
@@ -62,8 +69,44 @@ export default function Profile() {
     }
   };
 
-  const handleLogout = () => {
-    clearAuth();
+  const handleAvatarChange = async (e: React.ChangeEvent<HTMLInputElement>) => {
+    const file = e.target.files?.[0];
+    e.target.value = '';
+    if (!file) {
+      return;
+    }
+
+    setError('');
+    setSuccess('');
+    setLoading(true);
+
+    const token = await getValidToken();
+    if (!token) {
+      navigate('/login');
+      return;
+    }
+
+    try {
+      const image = await new Promise<string>((resolve, reject) => {
+        const reader = new FileReader();
+        reader.onload = () => resolve(reader.result as string);
+        reader.onerror = () => reject(new Error('Не удалось прочитать файл'));
+        reader.readAsDataURL(file);
+      });
+      const updatedUser = await authAPI.uploadAvatar(token, image);
+      setUser(updatedUser);
+      setAvatarUrl(updatedUser.avatar_url || '');
+      saveAuth(token, updatedUser);
+      setSuccess('Аватар обновлен!');
+    } catch (err) {
+      setError(err instanceof Error ? err.message : 'Ошибка загрузки аватара');
+    } finally {
+      setLoading(false);
+    }
+  };
+
+  const handleLogout = async () => {
+    await logout();
     navigate('/login');
   };
 
@@ -81,13 +124,20 @@ export default function Profile() {
       subtitle={`Добро пожаловать, ${user.first_name || user.email}!`}
     >
       <div className="mb-6 flex items-center justify-center">
-        <div className="w-24 h-24 rounded-full bg-[#E0E5EC] shadow-neomorph flex items-center justify-center">
+        <label className="w-24 h-24 rounded-full bg-[#E0E5EC] shadow-neomorph flex items-center justify-center cursor-pointer" title="Загрузить аватар">
           {avatarUrl ? (
             <img src={avatarUrl} alt="Avatar" className="w-full h-full rounded-full object-cover" />
           ) : (
             <Icon name="User" size={48} className="text-[#A3B1C6]" />
           )}
-        </div>
+          <input
+            type="file"
+            accept="image/jpeg,image/png,image/gif,image/webp"
+            className="hidden"
+            disabled={loading}
+            onChange={handleAvatarChange}
+          />
+        </label>
       </div>
 
       <form onSubmit={handleSubmit} className="space-y-4">
@@ -117,15 +167,6 @@ export default function Profile() {
           icon="Mail"
         />
 
-        <NeomorphInput
-          type="url"
-          label="Ссылка на аватар"
-          placeholder="https://example.com/avatar.jpg"
-          icon="Image"
-          value={avatarUrl}
-          onChange={(e) => setAvatarUrl(e.target.value)}
-        />
-
         {error && (
           <div className="bg-red-100 text-red-700 px-4 py-3 rounded-2xl text-sm">
             {error}
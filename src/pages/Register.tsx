@@ -6,7 +6,6 @@ import NeomorphButton from '@/components/NeomorphButton';
 import OAuthButtons from '@/components/OAuthButtons';
 import { authAPI } from '@/lib/api';
 import { saveAuth } from '@/lib/auth';
-import { emailAPI } from '@/lib/email';
 import Icon from '@/components/ui/icon';
 
 export default function Register() {
@@ -37,13 +36,7 @@ export default function Register() {
 
     try {
       const response = await authAPI.register(email, password, firstName, lastName);
-      saveAuth(response.token, response.user);
-      
-      try {
-        await emailAPI.sendWelcomeEmail(email, firstName || 'друг', window.location.origin);
-      } catch (emailErr) {
-        console.warn('Failed to send welcome email:', emailErr);
-      }
+      saveAuth(response.token, response.user, response.refresh_token);
       
       sessionStorage.setItem('just_logged_in', 'true');
       navigate('/');
@@ -4,7 +4,6 @@ import AuthLayout from '@/components/AuthLayout';
 import NeomorphInput from '@/components/NeomorphInput';
 import NeomorphButton from '@/components/NeomorphButton';
 import { authAPI } from '@/lib/api';
-import { emailAPI } from '@/lib/email';
 import Icon from '@/components/ui/icon';
 
 export default function ResetPassword() {
@@ -18,7 +17,6 @@ export default function ResetPassword() {
   const [error, setError] = useState('');
   const [success, setSuccess] = useState('');
   const [loading, setLoading] = useState(false);
-  const [resetTokenDisplay, setResetTokenDisplay] = useState('');
 
   const handleRequestReset = async (e: React.FormEvent) => {
     e.preventDefault();
@@ -27,21 +25,8 @@ export default function ResetPassword() {
     setLoading(true);
 
     try {
-      const response = await authAPI.requestPasswordReset(email);
-      setSuccess('Ссылка для сброса пароля отправлена на email!');
-      if (response.reset_token) {
-        setResetTokenDisplay(response.reset_token);
-        
-        try {
-          await emailAPI.sendPasswordResetEmail(
-            email,
-            response.reset_token,
-            `${window.location.origin}/reset-password`
-          );
-        } catch (emailErr) {
-          console.warn('Failed to send reset email:', emailErr);
-        }
-      }
+      await authAPI.requestPasswordReset(email);
+      setSuccess('Если аккаунт с таким email существует, мы отправили на него ссылку для сброса пароля.');
     } catch (err) {
       setError(err instanceof Error ? err.message : 'Ошибка отправки');
     } finally {
@@ -75,12 +60,6 @@ export default function ResetPassword() {
       await authAPI.resetPassword(resetToken, newPassword);
       setSuccess('Пароль успешно изменен!');
       
-      try {
-        await emailAPI.sendPasswordChangedEmail(email);
-      } catch (emailErr) {
-        console.warn('Failed to send password changed email:', emailErr);
-      }
-      
       setTimeout(() => navigate('/login'), 2000);
     } catch (err) {
       setError(err instanceof Error ? err.message : 'Ошибка сброса пароля');
@@ -115,20 +94,6 @@ export default function ResetPassword() {
           {success && (
             <div className="bg-green-100 text-green-700 px-4 py-3 rounded-2xl text-sm">
               {success}
-              {resetTokenDisplay && (
-                <div className="mt-2 p-2 bg-white rounded-lg">
-                  <p className="text-xs font-mono break-all">
-                    Токен для теста: {resetTokenDisplay}
-                  </p>
-                  <button
-                    type="button"
-                    onClick={() => navigate(`/reset-password?token=${resetTokenDisplay}`)}
-                    className="text-blue-600 underline text-xs mt-1"
-                  >
-                    Использовать токен
-                  </button>
-                </div>
-              )}
             </div>
           )}
 
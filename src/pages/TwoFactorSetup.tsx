@@ -4,7 +4,7 @@ import AuthLayout from '@/components/AuthLayout';
 import NeomorphInput from '@/components/NeomorphInput';
 import NeomorphButton from '@/components/NeomorphButton';
 import { twoFactorAPI } from '@/lib/twoFactor';
-import { getToken } from '@/lib/auth';
+import { getToken, getValidToken } from '@/lib/auth';
 import Icon from '@/components/ui/icon';
 
 export default function TwoFactorSetup() {
@@ -27,7 +27,12 @@ export default function TwoFactorSetup() {
 
     const checkStatus = async () => {
       try {
-        const status = await twoFactorAPI.getStatus(token);
+        const validToken = await getValidToken();
+        if (!validToken) {
+          navigate('/login');
+          return;
+        }
+        const status = await twoFactorAPI.getStatus(validToken);
         setEnabled(status.two_factor_enabled);
       } catch (err) {
         console.error('Failed to check 2FA status:', err);
@@ -38,8 +43,11 @@ export default function TwoFactorSetup() {
   }, [navigate]);
 
   const handleEnable = async () => {
-    const token = getToken();
-    if (!token) return;
+    const token = await getValidToken();
+    if (!token) {
+      navigate('/login');
+      return;
+    }
 
     setLoading(true);
     setError('');
@@ -62,8 +70,11 @@ export default function TwoFactorSetup() {
 
   const handleVerify = async (e: React.FormEvent) => {
     e.preventDefault();
-    const token = getToken();
-    if (!token) return;
+    const token = await getValidToken();
+    if (!token) {
+      navigate('/login');
+      return;
+    }
 
     setLoading(true);
     setError('');
@@ -80,8 +91,11 @@ export default function TwoFactorSetup() {
   };
 
   const handleDisable = async () => {
-    const token = getToken();
-    if (!token) return;
+    const token = await getValidToken();
+    if (!token) {
+      navigate('/login');
+      return;
+    }
 
     if (!confirm('Вы уверены, что хотите отключить двухфакторную аутентификацию?')) {
       return;
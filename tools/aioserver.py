@@ -0,0 +1,198 @@
+'''
+asyncio front end for self-hosting the backend functions.
+
+  python tools/aioserver.py [--port 8000] [--threads 32]
+  python tools/devserver.py load --server asyncio      # compare with --server threaded
+
+One event loop accepts connections, parses HTTP/1.1 with keep-alive and builds
+the same event dict as the platform (see functions.build_event); the function's
+handler then runs in a fixed pool of --threads threads. An idle keep-alive
+connection or a slow client costs a coroutine instead of a thread, and a burst
+of requests queues for the pool instead of starting one thread per connection
+as the threaded devserver does.
+
+The handlers themselves stay synchronous: they are the code the platform
+deploys, and their waits (Postgres through psycopg2, SMTP, OAuth and OpenAI
+over urllib) release the GIL, so --threads of them wait concurrently. Their CPU
+work (password hash, JWT signing, JSON) runs in the same threads, off the event
+loop.
+'''
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from typing import Dict, Any, Optional, Set, Tuple
+
+from functions import build_event, invoke, load_functions, response_bytes
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+class FunctionServer:
+    def __init__(self, functions: Dict[str, Any], threads: int):
+        self.functions = functions
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='handler')
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.in_flight = 0
+        self.handled = 0
+        self.draining = False
+        self.idle: Set[asyncio.StreamWriter] = set()
+    
+    async def start(self, host: str = '127.0.0.1', port: int = 0, sock: Optional[socket.socket] = None) -> int:
+        '''Listens on host:port, or accepts on an already listening sock (tools/prefork.py).'''
+        if sock is not None:
+            self.server = await asyncio.start_server(self.handle_connection, sock=sock, limit=MAX_HEADER_BYTES)
+        else:
+            self.server = await asyncio.start_server(self.handle_connection, host, port, limit=MAX_HEADER_BYTES, backlog=1024)
+        return self.server.sockets[0].getsockname()[1]
+    
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        peer = writer.get_extra_info('peername') or ('127.0.0.1', 0)
+        try:
+            while not self.draining:
+                self.idle.add(writer)
+                request = await read_request(reader)
+                self.idle.discard(writer)
+                if request is None:
+                    break
+                method, target, headers, body, keep_alive = request
+                self.in_flight += 1
+                try:
+                    status, response_headers, payload = await self.dispatch(method, target, headers, body, peer[0])
+                finally:
+                    self.in_flight -= 1
+                    self.handled += 1
+                keep_alive = keep_alive and not self.draining
+                writer.write(encode_response(status, response_headers, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.idle.discard(writer)
+            writer.close()
+    
+    async def dispatch(self, method: str, target: str, headers: Dict[str, str], body: bytes, source_ip: str) -> Tuple[int, Dict[str, str], bytes]:
+        if method == 'GET' and target == '/metrics':
+            from devserver import render_metrics
+            return 200, {'Content-Type': 'text/plain; version=0.0.4'}, render_metrics(self.functions).encode()
+        
+        name, _, rest = target.lstrip('/').partition('/')
+        name, _, query = name.partition('?')
+        module = self.functions.get(name)
+        if module is None:
+            return 404, {'Content-Type': 'application/json'}, json.dumps({'error': f'Unknown function {name}'}).encode()
+        
+        event = build_event(method, '/' + rest + (f'?{query}' if query else ''), headers, body, source_ip)
+        loop = asyncio.get_running_loop()
+        try:
+            response = await loop.run_in_executor(self.executor, invoke, module, name, event)
+        except Exception as error:
+            print(f'{name} raised {error!r}', file=sys.stderr)
+            return 502, {'Content-Type': 'application/json'}, json.dumps({'error': 'Function crashed'}).encode()
+        
+        return response.get('statusCode', 200), response.get('headers') or {}, response_bytes(response)
+    
+    async def drain(self, timeout: float) -> bool:
+        '''
+        Stops accepting, closes idle keep-alive connections and waits up to timeout
+        for requests in flight; True when they all finished.
+        '''
+        self.draining = True
+        if self.server is not None:
+            self.server.close()
+        for writer in list(self.idle):
+            writer.close()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.in_flight and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        return not self.in_flight
+    
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        self.executor.shutdown(wait=False)
+
+async def read_request(reader: asyncio.StreamReader) -> Optional[Tuple[str, str, Dict[str, str], bytes, bool]]:
+    '''(method, target, headers, body, keep_alive), or None when the client closed the connection.'''
+    try:
+        head = await reader.readuntil(b'\r\n\r\n')
+    except asyncio.IncompleteReadError as error:
+        if not error.partial:
+            return None
+        raise
+    
+    lines = head.decode('latin-1').split('\r\n')
+    method, target, version = lines[0].split(' ', 2)
+    headers: Dict[str, str] = {}
+    for line in lines[1:]:
+        if line:
+            key, _, value = line.partition(':')
+            headers[key.strip()] = value.strip()
+    
+    lowered = {key.lower(): value for key, value in headers.items()}
+    length = int(lowered.get('content-length', '0'))
+    if length > MAX_BODY_BYTES:
+        raise ValueError('request body too large')
+    body = await reader.readexactly(length) if length else b''
+    
+    connection = lowered.get('connection', '').lower()
+    keep_alive = connection != 'close' if version == 'HTTP/1.1' else connection == 'keep-alive'
+    return method.upper(), target, headers, body, keep_alive
+
+def encode_response(status: int, headers: Dict[str, str], body: bytes, keep_alive: bool) -> bytes:
+    try:
+        reason = HTTPStatus(status).phrase
+    except ValueError:
+        reason = ''
+    lines = [f'HTTP/1.1 {status} {reason}']
+    lines.extend(f'{key}: {value}' for key, value in headers.items())
+    lines.append(f'Content-Length: {len(body)}')
+    lines.append(f"Connection: {'keep-alive' if keep_alive else 'close'}")
+    # Headers and body in one write, like the devserver (avoids the Nagle/delayed-ACK stall).
+    return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+def start_in_thread(functions: Dict[str, Any], port: int = 0, threads: int = 32) -> Tuple[FunctionServer, int, asyncio.AbstractEventLoop]:
+    '''Runs the server on its own event loop thread (used by devserver load); returns (server, port, loop).'''
+    loop = asyncio.new_event_loop()
+    server = FunctionServer(functions, threads)
+    bound = loop.run_until_complete(server.start('127.0.0.1', port))
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return server, bound, loop
+
+def stop_in_thread(server: FunctionServer, loop: asyncio.AbstractEventLoop):
+    asyncio.run_coroutine_threadsafe(server.close(), loop).result(timeout=10)
+    loop.call_soon_threadsafe(loop.stop)
+
+async def serve(host: str, port: int, threads: int):
+    server = FunctionServer(load_functions(), threads)
+    bound = await server.start(host, port)
+    print(f"Serving {', '.join(server.functions)} on http://{host}:{bound}/<function> ({threads} handler threads)")
+    try:
+        await server.server.serve_forever()
+    finally:
+        await server.close()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--threads', type=int, default=int(os.environ.get('AIOSERVER_THREADS', '32')), help='handler pool size')
+    args = parser.parse_args()
+    
+    try:
+        asyncio.run(serve(args.host, args.port, args.threads))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+'''
+Benchmarks for the auth hot paths.
+
+  python tools/bench_auth.py --output bench-auth.json
+  python tools/bench_auth.py --compare bench-auth.json      # after a change
+
+Micro benchmarks (no database): JWT sign/verify with the configured key and
+per algorithm (HS256, plus EdDSA and RS256 when cryptography is installed), and
+password hashing, the current hash_password plus PBKDF2 at each --hash-costs
+iteration count as the reference for a slower, salted scheme.
+
+Handler benchmarks: register, login and profile through auth.handler against a
+disposable database created next to DATABASE_URL and seeded to each --users
+size (default 10k and 1M rows). Skipped with --no-db.
+'''
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import random
+import sys
+from typing import Dict, Any, List
+
+from benchlib import DisposableDatabase, compare_results, measure, print_results, write_results
+from functions import build_event, invoke, load_function
+
+BENCH_PASSWORD = 'bench-password-123'
+
+def micro_benchmarks(auth: Any, hash_costs: List[int], iterations: int) -> Dict[str, Dict[str, Any]]:
+    results: Dict[str, Dict[str, Any]] = {}
+    token = auth.generate_jwt(42, 'bench@example.com', 42)
+    
+    results['jwt.generate'] = measure(lambda: auth.generate_jwt(42, 'bench@example.com', 42), iterations)
+    results['jwt.verify'] = measure(lambda: auth.verify_jwt(token), iterations)
+    results['jwt.verify_bad_signature'] = measure(lambda: auth.verify_jwt(token[:-2] + 'xx'), iterations)
+    results['hash_password.current'] = measure(lambda: auth.hash_password(BENCH_PASSWORD), iterations)
+    
+    salt = os.urandom(16)
+    for cost in hash_costs:
+        cost_iterations = max(3, min(iterations, int(2_000_000 / cost)))
+        results[f'hash_password.pbkdf2_sha256.{cost}'] = measure(
+            lambda: hashlib.pbkdf2_hmac('sha256', BENCH_PASSWORD.encode(), salt, cost),
+            cost_iterations,
+            rounds=3
+        )
+    
+    results.update(jwt_algorithm_benchmarks(auth.local_modules['jwt_keys'], iterations))
+    return results
+
+def jwt_algorithm_benchmarks(jwt_keys: Any, iterations: int) -> Dict[str, Dict[str, Any]]:
+    results: Dict[str, Dict[str, Any]] = {}
+    payload = json.dumps({'user_id': 42, 'email': 'bench@example.com', 'sid': 42, 'exp': 2000000000}).encode()
+    
+    pairs = [(jwt_keys.hmac_signer('bench-secret'), jwt_keys.hmac_verifier('bench-secret'))]
+    if jwt_keys.InvalidSignature is not None:
+        from jwt_keygen import generate_pem
+        
+        for alg in ('EdDSA', 'RS256'):
+            signer = jwt_keys.private_key_signer(generate_pem(alg), f'bench-{alg}')
+            pairs.append((signer, jwt_keys.jwk_verifier(signer.public_jwk)[1]))
+    
+    for signer, verify in pairs:
+        signing_input = f'{signer.header}.{jwt_keys.b64url_encode(payload)}'.encode()
+        signature = signer.sign(signing_input)
+        assert verify(signing_input, signature)
+        
+        # RSA signing is two orders of magnitude slower than the rest; keep its run short.
+        alg_iterations = max(10, iterations // 20) if signer.alg == 'RS256' else iterations
+        results[f'jwt.{signer.alg}.sign'] = measure(lambda: signer.sign(signing_input), alg_iterations)
+        results[f'jwt.{signer.alg}.verify'] = measure(lambda: verify(signing_input, signature), iterations)
+    
+    return results
+
+def seed_users(database_url: str, target: int, password_hash: str):
+    import psycopg2
+    
+    conn = psycopg2.connect(database_url)
+    cur = conn.cursor()
+    cur.execute("SELECT COUNT(*) FROM users WHERE email LIKE 'user%%@bench.local'")
+    current = cur.fetchone()[0]
+    if current < target:
+        # Ids come from the directory, as in registration (one database, so every user is on shard 0).
+        cur.execute(
+            "INSERT INTO user_directory (email) SELECT 'user' || n || '@bench.local' FROM generate_series(%s, %s) AS n ON CONFLICT (email) DO NOTHING",
+            (current + 1, target)
+        )
+        cur.execute(
+            """
+            INSERT INTO users (id, email, password_hash, first_name, last_name, created_at)
+            SELECT d.id, d.email, %s, 'Bench', 'User ' || n, NOW() - n * INTERVAL '1 second'
+            FROM generate_series(%s, %s) AS n JOIN user_directory d ON d.email = 'user' || n || '@bench.local'
+            """,
+            (password_hash, current + 1, target)
+        )
+        conn.commit()
+    conn.autocommit = True
+    cur.execute("VACUUM ANALYZE users")
+    cur.execute("VACUUM ANALYZE user_directory")
+    cur.close()
+    conn.close()
+
+def handler_benchmarks(auth: Any, size: int, iterations: int) -> Dict[str, Dict[str, Any]]:
+    results: Dict[str, Dict[str, Any]] = {}
+    counter = itertools.count()
+    run_id = random.randrange(1_000_000)
+    
+    def register():
+        email = f'new-{run_id}-{next(counter)}@bench.local'
+        response = invoke(auth, 'auth', build_event('POST', '/?action=register', {}, json.dumps({
+            'email': email, 'password': BENCH_PASSWORD, 'first_name': 'New', 'last_name': 'User'
+        }).encode()))
+        assert response['statusCode'] == 200, response
+    
+    def login():
+        email = f'user{random.randint(1, size)}@bench.local'
+        response = invoke(auth, 'auth', build_event('POST', '/?action=login', {}, json.dumps({
+            'email': email, 'password': BENCH_PASSWORD
+        }).encode()))
+        assert response['statusCode'] == 200, response
+    
+    tokens = [auth.generate_jwt(user_id, f'user{user_id}@bench.local', user_id) for user_id in random.sample(range(1, size + 1), min(size, 1000))]
+    
+    def profile():
+        response = invoke(auth, 'auth', build_event('GET', '/?action=profile', {'X-Auth-Token': random.choice(tokens)}))
+        assert response['statusCode'] == 200, response
+    
+    results[f'handler.login.{size}'] = measure(login, iterations)
+    results[f'handler.profile.{size}'] = measure(profile, iterations)
+    results[f'handler.register.{size}'] = measure(register, iterations)
+    return results
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=2000, help='calls per round for micro benchmarks')
+    parser.add_argument('--db-iterations', type=int, default=200, help='calls per round for handler benchmarks')
+    parser.add_argument('--hash-costs', default='1000,100000,600000', help='PBKDF2 iteration counts to measure')
+    parser.add_argument('--users', default='10000,1000000', help='seeded table sizes for handler benchmarks')
+    parser.add_argument('--no-db', action='store_true', help='only run micro benchmarks')
+    parser.add_argument('--keep-db', action='store_true', help='do not drop the seeded database')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='previous results JSON to diff against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='slowdown that counts as a regression')
+    args = parser.parse_args()
+    
+    auth = load_function('auth')
+    hash_costs = [int(cost) for cost in args.hash_costs.split(',') if cost]
+    sizes = [int(size) for size in args.users.split(',') if size]
+    
+    results = micro_benchmarks(auth, hash_costs, args.iterations)
+    
+    if not args.no_db:
+        with DisposableDatabase(os.environ['DATABASE_URL'], keep=args.keep_db) as database:
+            os.environ['DATABASE_URL'] = database.url
+            for size in sorted(sizes):
+                print(f'seeding {size} users...', file=sys.stderr)
+                seed_users(database.url, size, auth.hash_password(BENCH_PASSWORD))
+                results.update(handler_benchmarks(auth, size, args.db_iterations))
+    
+    print_results(results)
+    
+    if args.output:
+        write_results(args.output, 'auth', results, {
+            'iterations': args.iterations,
+            'db_iterations': args.db_iterations,
+            'hash_costs': hash_costs,
+            'users': sizes if not args.no_db else []
+        })
+    
+    if args.compare:
+        return 1 if compare_results(args.compare, results, args.threshold) else 0
+    
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
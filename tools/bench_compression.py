@@ -0,0 +1,133 @@
+'''
+Measures response compression: bytes saved and CPU time per encoding for
+representative payloads of several sizes.
+
+  python tools/bench_compression.py --output bench-compression.json
+  python tools/bench_compression.py --compare bench-compression.json   # after a change
+
+Payloads are built like the real responses (admin users and activity-log pages,
+a chat reply, the JWKS) and scaled to each --sizes entry. Every encoding the
+router can use here (gzip always; br and zstd when brotli/zstandard are
+installed) is timed for the raw compression and for router.compress(), which
+adds the base64 step and, for Cache-Control: public responses, the cache.
+'''
+import argparse
+import json
+import random
+import string
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, Any, Callable, List
+
+from benchlib import compare_results, measure, print_results, write_results
+from functions import load_function
+
+ACTIONS = ['login', 'login_failed', 'register', 'oauth_login', 'password_reset', '2fa_verified']
+
+def word(length: int) -> str:
+    return ''.join(random.choice(string.ascii_lowercase) for _ in range(length))
+
+def user_row(user_id: int) -> Dict[str, Any]:
+    return {
+        'id': user_id,
+        'email': f'{word(8)}.{word(6)}@example.com',
+        'first_name': word(6).title(),
+        'last_name': word(9).title(),
+        'role': random.choice(['user', 'user', 'user', 'admin']),
+        'is_active': True,
+        'two_factor_enabled': random.random() < 0.3,
+        'created_at': (datetime(2026, 1, 1) + timedelta(seconds=random.randint(0, 2 ** 24))).isoformat()
+    }
+
+def activity_row(log_id: int) -> Dict[str, Any]:
+    return {
+        'id': log_id,
+        'user_id': random.randint(1, 10000),
+        'email': f'{word(8)}@example.com',
+        'action': random.choice(ACTIONS),
+        'ip_address': '.'.join(str(random.randint(1, 254)) for _ in range(4)),
+        'created_at': (datetime(2026, 10, 1) + timedelta(seconds=random.randint(0, 2 ** 20))).isoformat()
+    }
+
+def chat_reply(size: int) -> Dict[str, Any]:
+    words: List[str] = []
+    length = 0
+    while length < size:
+        words.append(word(random.randint(2, 10)))
+        length += len(words[-1]) + 1
+    return {'reply': ' '.join(words), 'model': 'gpt-4o-mini', 'session_id': 42, 'context': {'messages_sent': 12}}
+
+def rows_payload(key: str, row: Callable[[int], Dict[str, Any]], size: int) -> Dict[str, Any]:
+    rows: List[Dict[str, Any]] = []
+    length = 0
+    while length < size:
+        rows.append(row(len(rows) + 1))
+        length += len(json.dumps(rows[-1])) + 2
+    return {key: rows, 'total': len(rows) * 40, 'page': 1, 'pages': 40}
+
+def build_payloads(sizes: List[int]) -> Dict[str, Dict[str, Any]]:
+    payloads: Dict[str, Dict[str, Any]] = {}
+    for size in sizes:
+        payloads[f'admin_users.{size}'] = rows_payload('users', user_row, size)
+        payloads[f'activity_log.{size}'] = rows_payload('logs', activity_row, size)
+        payloads[f'chat_reply.{size}'] = chat_reply(size)
+    return payloads
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1024,8192,65536,524288', help='comma-separated payload sizes in bytes')
+    parser.add_argument('--iterations', type=int, default=50, help='calls per round for each benchmark')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='previous results JSON to diff against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='slowdown that counts as a regression')
+    args = parser.parse_args()
+    
+    random.seed(1)
+    router = load_function('auth').local_modules['router']
+    sizes = [int(size) for size in args.sizes.split(',')]
+    payloads = build_payloads(sizes)
+    payloads['jwks'] = {'keys': [{'kty': 'OKP', 'crv': 'Ed25519', 'kid': f'2026-{month:02}', 'x': word(43), 'use': 'sig', 'alg': 'EdDSA'} for month in range(1, 13)]}
+    
+    results: Dict[str, Dict[str, Any]] = {}
+    savings: List[Dict[str, Any]] = []
+    for name, payload in payloads.items():
+        public = name == 'jwks'
+        response = router.respond(200, payload, {'Cache-Control': 'public, max-age=300'} if public else None)
+        raw = response['body'].encode()
+        # Scale iterations down for large bodies so every benchmark takes similar time.
+        iterations = max(1, args.iterations * 8192 // max(len(raw), 8192))
+        
+        for encoding, encoder in router.ENCODERS.items():
+            compressed = encoder(raw)
+            stats = measure(lambda: encoder(raw), iterations)
+            results[f'compress.{name}.{encoding}'] = stats
+            results[f'respond.{name}.{encoding}'] = measure(lambda: router.compress(response, encoding), iterations)
+            savings.append({
+                'payload': name,
+                'encoding': encoding,
+                'bytes': len(raw),
+                'compressed': len(compressed),
+                'saved': 1 - len(compressed) / len(raw),
+                'mb_per_s': len(raw) / stats['mean_us'] if stats['mean_us'] else None
+            })
+    
+    print_results(results)
+    print(f"\n{'payload':24} {'encoding':8} {'bytes':>9} {'compressed':>11} {'saved':>7} {'MB/s':>8}")
+    for row in savings:
+        print(f"{row['payload']:24} {row['encoding']:8} {row['bytes']:>9} {row['compressed']:>11} {row['saved']:>7.1%} {row['mb_per_s']:>8.1f}")
+    
+    if args.output:
+        write_results(args.output, 'compression', results, {
+            'sizes': sizes,
+            'iterations': args.iterations,
+            'encodings': list(router.ENCODERS),
+            'min_bytes': router.COMPRESSION_MIN_BYTES,
+            'savings': savings
+        })
+        print(f'\nwrote {args.output}')
+    if args.compare:
+        return 1 if compare_results(args.compare, results, args.threshold) else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,144 @@
+'''
+Benchmarks the registered hot queries executed as plain statements (parsed
+and planned by Postgres on every call) against prepared ones (PREPARE once per
+connection, then EXECUTE by name).
+
+  python tools/bench_queries.py --output bench-queries.json
+  python tools/bench_queries.py --compare bench-queries.json      # after a change
+
+Runs every read statement registered through db.statement() in the auth,
+two-factor, oauth and admin functions against a disposable database
+seeded with --users rows. The "planning" column is the Planning Time Postgres reports for
+the plain statement, i.e. the work a prepared statement saves per call once its
+generic plan is cached.
+'''
+import argparse
+import os
+import random
+import sys
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Tuple
+
+from benchlib import DisposableDatabase, compare_results, measure, print_results, write_results
+from bench_auth import BENCH_PASSWORD, seed_users
+from functions import load_function
+
+FUNCTIONS = ['auth', 'two-factor', 'oauth', 'admin']
+
+def sample_params(name: str, size: int) -> Tuple[Any, ...]:
+    '''Parameters for a read statement; None for statements that write.'''
+    user_id = random.randint(1, size)
+    email = f'user{user_id}@bench.local'
+    return {
+        'directory_find': (email,),
+        'directory_find_identity': ('google', f'g-{user_id}'),
+        'oauth_find_identity_user': ('google', f'g-{user_id}'),
+        'auth_login_user': (user_id, 'not-the-hash'),
+        'auth_select_profile': (user_id,),
+        'auth_select_reset_token': ('missing-token',),
+        'auth_count_reset_requests': (email, datetime.now() - timedelta(hours=1), '203.0.113.7', datetime.now() - timedelta(hours=1)),
+        'auth_claim_reset_request': (datetime.now() - timedelta(hours=1),),
+        'tfa_find_code': (user_id, '000000'),
+        'tfa_select_status': (user_id,),
+        'admin_select_role': (user_id,),
+        'admin_list_users': (50, random.randint(0, 20) * 50),
+        'admin_count_users': (),
+        'admin_list_inactive_users': (datetime.now() - timedelta(days=180), 20, 0),
+        'admin_count_inactive_users': (datetime.now() - timedelta(days=180),),
+        'admin_count_stale': (datetime.now() - timedelta(days=180),),
+        'admin_list_activity': (50, 0),
+        'admin_count_activity': (),
+        'admin_count_admins': (),
+        'admin_count_two_factor': (),
+        'admin_count_active': (),
+        'admin_timeseries_hourly': (['login', 'login_failed'], datetime.now() - timedelta(days=1), datetime.now()),
+        'admin_timeseries_daily': (['login', 'login_failed'], datetime.now() - timedelta(days=30), datetime.now()),
+        'admin_rollup_watermark': (),
+        'activity_next_batch_end': (0, 50000, 60),
+        'session_select_for_refresh': (user_id,),
+        'session_recent_revocations': (900,),
+    }.get(name)
+
+def collect_statements() -> List[Any]:
+    '''Registered statements across the functions, deduplicated by name (sessions.py is shared).'''
+    statements: Dict[str, Any] = {}
+    for name in FUNCTIONS:
+        db = load_function(name).local_modules['db']
+        statements.update(db.STATEMENTS)
+    return [statements[name] for name in sorted(statements)]
+
+def planning_ms(cur: Any, sql: str, params: Tuple[Any, ...]) -> float:
+    cur.execute(f'EXPLAIN (SUMMARY ON, FORMAT JSON) {sql}', params)
+    plan = cur.fetchone()[0]
+    cur.connection.rollback()
+    return plan[0]['Planning Time']
+
+def query_benchmarks(database_url: str, size: int, iterations: int) -> Tuple[Dict[str, Dict[str, Any]], Dict[str, float]]:
+    import psycopg2
+    
+    results: Dict[str, Dict[str, Any]] = {}
+    planning: Dict[str, float] = {}
+    conn = psycopg2.connect(database_url)
+    cur = conn.cursor()
+    
+    for stmt in collect_statements():
+        if sample_params(stmt.name, size) is None:
+            continue
+        
+        def plain():
+            cur.execute(stmt.sql, sample_params(stmt.name, size))
+            cur.fetchall()
+            conn.rollback()
+        
+        def prepared():
+            cur.execute(stmt.execute_sql, sample_params(stmt.name, size))
+            cur.fetchall()
+            conn.rollback()
+        
+        cur.execute(stmt.prepare_sql)
+        conn.commit()
+        results[f'query.{stmt.name}.plain.{size}'] = measure(plain, iterations)
+        results[f'query.{stmt.name}.prepared.{size}'] = measure(prepared, iterations)
+        planning[stmt.name] = planning_ms(cur, stmt.sql, sample_params(stmt.name, size))
+    
+    cur.close()
+    conn.close()
+    return results, planning
+
+def print_savings(results: Dict[str, Dict[str, Any]], planning: Dict[str, float], size: int):
+    print(f"\n{'statement':36} {'plain us':>10} {'prepared us':>12} {'saved':>8} {'planning us':>12}")
+    for name, planning_time in planning.items():
+        plain = results[f'query.{name}.plain.{size}']['mean_us']
+        prepared = results[f'query.{name}.prepared.{size}']['mean_us']
+        saved = (plain - prepared) / plain if plain else 0.0
+        print(f'{name:36} {plain:>10.1f} {prepared:>12.1f} {saved:>8.1%} {planning_time * 1000:>12.1f}')
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=500, help='calls per round for each statement')
+    parser.add_argument('--users', type=int, default=10000, help='seeded users table size')
+    parser.add_argument('--keep-db', action='store_true', help='do not drop the seeded database')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='previous results JSON to diff against')
+    parser.add_argument('--threshold', type=float, default=0.10, help='slowdown that counts as a regression')
+    args = parser.parse_args()
+    
+    auth = load_function('auth')
+    with DisposableDatabase(os.environ['DATABASE_URL'], keep=args.keep_db) as database:
+        print(f'seeding {args.users} users...', file=sys.stderr)
+        seed_users(database.url, args.users, auth.hash_password(BENCH_PASSWORD))
+        results, planning = query_benchmarks(database.url, args.users, args.iterations)
+    
+    print_results(results)
+    print_savings(results, planning, args.users)
+    
+    if args.output:
+        write_results(args.output, 'queries', results, {'iterations': args.iterations, 'users': args.users})
+    
+    if args.compare:
+        return 1 if compare_results(args.compare, results, args.threshold) else 0
+    
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
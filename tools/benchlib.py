@@ -0,0 +1,129 @@
+'''
+Small timing harness shared by the tools/bench_*.py scripts: repeated timed
+rounds, percentile stats, JSON result files and comparison between runs.
+'''
+import json
+import os
+import platform
+import statistics
+import subprocess
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, Any, List, Optional
+from urllib.parse import urlsplit, urlunsplit
+
+from functions import ROOT_DIR, apply_migrations
+
+def measure(func: Callable[[], Any], iterations: int, rounds: int = 5, warmup: int = 1) -> Dict[str, Any]:
+    '''
+    Calls func iterations times per round after warmup calls; per-call times are
+    derived from each round so timer overhead does not dominate fast operations.
+    '''
+    for _ in range(warmup):
+        func()
+    
+    per_call: List[float] = []
+    samples: List[float] = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        for _ in range(iterations):
+            func()
+        elapsed = time.perf_counter() - started
+        per_call.append(elapsed / iterations)
+    
+    # Single-call samples for the latency distribution.
+    for _ in range(min(iterations, 200)):
+        started = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    
+    mean = statistics.mean(per_call)
+    return {
+        'iterations': iterations,
+        'rounds': rounds,
+        'mean_us': round(mean * 1e6, 2),
+        'min_us': round(min(per_call) * 1e6, 2),
+        'stdev_us': round(statistics.pstdev(per_call) * 1e6, 2),
+        'p50_us': round(samples[len(samples) // 2] * 1e6, 2),
+        'p95_us': round(samples[int(len(samples) * 0.95) - 1] * 1e6, 2),
+        'ops_per_s': round(1 / mean, 1) if mean else None
+    }
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def write_results(path: str, suite: str, results: Dict[str, Dict[str, Any]], parameters: Dict[str, Any]):
+    document = {
+        'suite': suite,
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'parameters': parameters,
+        'results': results
+    }
+    with open(path, 'w') as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+
+def compare_results(baseline_path: str, results: Dict[str, Dict[str, Any]], threshold: float) -> int:
+    '''
+    Prints mean-time change per benchmark against a previous results file and
+    returns the number of benchmarks that got slower by more than threshold.
+    '''
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    
+    regressions = 0
+    print(f"\ncompared with {baseline_path} (commit {baseline.get('commit')})")
+    for name, stats in sorted(results.items()):
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            print(f'  {name:48} new')
+            continue
+        change = (stats['mean_us'] - before['mean_us']) / before['mean_us']
+        flag = ''
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"  {name:48} {before['mean_us']:>12.2f} -> {stats['mean_us']:>12.2f} us  {change:+7.1%}{flag}")
+    return regressions
+
+def print_results(results: Dict[str, Dict[str, Any]]):
+    print(f"{'benchmark':48} {'mean us':>12} {'p50 us':>12} {'p95 us':>12} {'ops/s':>12}")
+    for name, stats in results.items():
+        print(f"{name:48} {stats['mean_us']:>12.2f} {stats['p50_us']:>12.2f} {stats['p95_us']:>12.2f} {stats['ops_per_s']:>12}")
+
+class DisposableDatabase:
+    '''
+    Creates a uniquely named database next to the one in DATABASE_URL, applies the
+    migrations and drops it on exit unless keep is set.
+    '''
+    def __init__(self, database_url: str, keep: bool = False):
+        self.admin_url = database_url
+        self.keep = keep
+        self.name = f'bench_{os.getpid()}_{int(time.time())}'
+        parts = urlsplit(database_url)
+        self.url = urlunsplit((parts.scheme, parts.netloc, f'/{self.name}', parts.query, parts.fragment))
+    
+    def __enter__(self) -> 'DisposableDatabase':
+        self._execute(f'CREATE DATABASE {self.name} ENCODING \'UTF8\' TEMPLATE template0')
+        apply_migrations(self.url)
+        return self
+    
+    def __exit__(self, *exc_info: Any):
+        if not self.keep:
+            self._execute(f'DROP DATABASE IF EXISTS {self.name} WITH (FORCE)')
+    
+    def _execute(self, statement: str):
+        import psycopg2
+        
+        conn = psycopg2.connect(self.admin_url)
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute(statement)
+        cur.close()
+        conn.close()
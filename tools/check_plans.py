@@ -0,0 +1,113 @@
+'''
+Checks with EXPLAIN that every hot query is served by an index.
+
+  python tools/check_plans.py [--users 5000] [--verbose]
+
+Builds a disposable database next to DATABASE_URL with all migrations, seeds
+--users rows and explains each read statement registered through db.statement()
+in the auth, two-factor, oauth and admin functions with enable_seqscan
+off: a Seq Scan that remains means no index can answer the query at all.
+Statements in EXPECTED_INDEXES must also use the named index for their table.
+Exits 1 on any violation.
+'''
+import argparse
+import os
+import sys
+from typing import Dict, Any, Iterator, List
+
+from bench_auth import BENCH_PASSWORD, seed_users
+from bench_queries import collect_statements, sample_params
+from benchlib import DisposableDatabase
+from functions import load_function
+
+INDEX_SCANS = {'Index Scan', 'Index Only Scan', 'Bitmap Index Scan'}
+
+# statement -> index it is expected to use; catches a migration that silently
+# drops or replaces an index the query depends on.
+EXPECTED_INDEXES = {
+    'directory_find': 'user_directory_email_key',
+    'directory_find_identity': 'oauth_identities_pkey',
+    'oauth_find_identity_user': 'idx_users_oauth_identity',
+    'auth_login_user': 'users_pkey',
+    'auth_select_profile': 'users_pkey',
+    'auth_select_reset_token': 'password_reset_tokens_token_key',
+    'auth_count_reset_requests': 'idx_password_reset_requests_email',
+    'auth_claim_reset_request': 'idx_password_reset_requests_pending',
+    'tfa_find_code': 'idx_two_factor_codes_user_id',
+    'tfa_select_status': 'users_pkey',
+    'admin_select_role': 'users_pkey',
+    'admin_list_users': 'idx_users_created_at',
+    'admin_list_inactive_users': 'idx_users_last_active',
+    'admin_count_inactive_users': 'idx_users_last_active',
+    'admin_count_stale': 'idx_users_last_active',
+    'admin_list_activity': 'idx_user_activity_log_created_at',
+    'admin_timeseries_hourly': 'activity_rollup_hourly_pkey',
+    'admin_timeseries_daily': 'activity_rollup_daily_pkey',
+    'activity_next_batch_end': 'user_activity_log_pkey',
+    'session_select_for_refresh': 'auth_sessions_pkey',
+    'session_recent_revocations': 'idx_auth_sessions_revoked_at',
+}
+
+# Whole-table aggregates for the admin dashboard; an index only changes how the
+# full table is read.
+FULL_SCAN_ALLOWED = {'admin_count_users', 'admin_count_activity', 'admin_count_two_factor', 'admin_count_active'}
+
+def plan_nodes(node: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    yield node
+    for child in node.get('Plans', []):
+        yield from plan_nodes(child)
+
+def check_plans(database_url: str, size: int, verbose: bool) -> List[str]:
+    import psycopg2
+    
+    failures: List[str] = []
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SET enable_seqscan = off")
+    
+    for stmt in collect_statements():
+        params = sample_params(stmt.name, size)
+        if params is None:
+            continue
+        cur.execute(f'EXPLAIN (FORMAT JSON) {stmt.sql}', params)
+        nodes = list(plan_nodes(cur.fetchone()[0][0]['Plan']))
+        
+        scans = [f"{node['Node Type']} on {node.get('Index Name') or node.get('Relation Name')}" for node in nodes if 'Scan' in node['Node Type']]
+        used = {node.get('Index Name') for node in nodes if node['Node Type'] in INDEX_SCANS}
+        problems = []
+        if stmt.name not in FULL_SCAN_ALLOWED and any(node['Node Type'] == 'Seq Scan' for node in nodes):
+            problems.append('sequential scan')
+        expected = EXPECTED_INDEXES.get(stmt.name)
+        if expected and expected not in used:
+            problems.append(f'does not use {expected}')
+        
+        status = 'FAIL' if problems else 'ok  '
+        print(f"{status} {stmt.name:32} {', '.join(scans)}")
+        if problems:
+            failures.append(f"{stmt.name}: {', '.join(problems)}")
+        if verbose or problems:
+            print(f'     {stmt.sql}')
+    
+    cur.close()
+    conn.close()
+    return failures
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=5000, help='seeded users table size')
+    parser.add_argument('--verbose', action='store_true', help='print every statement')
+    args = parser.parse_args()
+    
+    auth = load_function('auth')
+    with DisposableDatabase(os.environ['DATABASE_URL']) as database:
+        seed_users(database.url, args.users, auth.hash_password(BENCH_PASSWORD))
+        failures = check_plans(database.url, args.users, args.verbose)
+    
+    print(f'{len(failures)} failure(s)')
+    for failure in failures:
+        print(f'  {failure}')
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,437 @@
+'''
+Local runner for all backend functions.
+
+  python tools/devserver.py serve [--port 8000]
+      Mounts every function behind one HTTP server at /<function-name>
+      (names from backend/func2url.json), e.g. POST /auth?action=login.
+      GET /metrics serves the Prometheus exposition when METRICS_PROMETHEUS=true.
+  
+  python tools/devserver.py [--migrate] [--openai-stub] test [function ...] [--seed]
+      Replays each function's tests.json as a conformance suite.
+  
+  python tools/devserver.py load [--duration 10] [--concurrency 16] [--scenario auth|tests]
+                                 [--server threaded|asyncio]
+      Generates load over HTTP and reports throughput and p50/p95/p99 latency
+      per action, against this threaded server or tools/aioserver.py.
+
+All modes use DATABASE_URL (a local Postgres); --migrate first applies the
+pending db_migrations with tools/migrate.py. --shards N splits the users over
+DATABASE_URL and N - 1 more local databases (<name>_shard1, ... next to it,
+created and migrated when missing) through DATABASE_SHARD_URLS; start it on an
+empty DATABASE_URL, since existing users are not moved to their shard.
+'''
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlsplit, urlunsplit
+
+from functions import apply_migrations, build_event, discover_functions, invoke, load_functions, load_tests, response_bytes
+
+TYPE_PLACEHOLDERS = {
+    'string': str,
+    'number': (int, float),
+    'boolean': bool,
+    'object': dict,
+    'array': list
+}
+
+def make_request_handler(functions: Dict[str, Any]):
+    class FunctionRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Buffer headers and body into one write; separate small writes hit the
+        # Nagle/delayed-ACK stall and add ~40 ms to every keep-alive request.
+        wbufsize = -1
+        
+        def handle_any(self):
+            if self.command == 'GET' and self.path == '/metrics':
+                self.send_raw(200, {'Content-Type': 'text/plain; version=0.0.4'}, render_metrics(functions).encode())
+                return
+            
+            name, _, rest = self.path.lstrip('/').partition('/')
+            name, _, query = name.partition('?')
+            module = functions.get(name)
+            
+            length = int(self.headers.get('Content-Length', '0'))
+            body = self.rfile.read(length) if length else b''
+            
+            if module is None:
+                self.send_raw(404, {'Content-Type': 'application/json'}, json.dumps({'error': f'Unknown function {name}'}).encode())
+                return
+            
+            target = '/' + rest + (f'?{query}' if query else '')
+            event = build_event(self.command, target, dict(self.headers.items()), body, self.client_address[0])
+            
+            try:
+                response = invoke(module, name, event)
+            except Exception as error:
+                self.log_error('%s raised %r', name, error)
+                self.send_raw(502, {'Content-Type': 'application/json'}, json.dumps({'error': 'Function crashed'}).encode())
+                return
+            
+            self.send_raw(response.get('statusCode', 200), response.get('headers') or {}, response_bytes(response))
+        
+        def send_raw(self, status: int, headers: Dict[str, str], body: bytes):
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, str(value))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        
+        do_GET = do_POST = do_PUT = do_DELETE = do_PATCH = do_OPTIONS = handle_any
+        
+        def log_message(self, format: str, *args: Any):
+            if os.environ.get('DEVSERVER_QUIET') != '1':
+                super().log_message(format, *args)
+    
+    return FunctionRequestHandler
+
+def render_metrics(functions: Dict[str, Any]) -> str:
+    '''Merges the Prometheus exposition of every loaded function (METRICS_PROMETHEUS=true).'''
+    lines: List[str] = []
+    seen_types = set()
+    for module in functions.values():
+        metrics = getattr(module, 'local_modules', {}).get('metrics')
+        if metrics is None:
+            continue
+        for line in metrics.render_prometheus().splitlines():
+            if line.startswith('# TYPE'):
+                if line in seen_types:
+                    continue
+                seen_types.add(line)
+            lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+def start_server(functions: Dict[str, Any], port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_request_handler(functions))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def matches(expected: Any, actual: Any, exact: bool) -> bool:
+    if isinstance(expected, str) and expected in TYPE_PLACEHOLDERS:
+        expected_type = TYPE_PLACEHOLDERS[expected]
+        return isinstance(actual, expected_type) and not (expected == 'number' and isinstance(actual, bool))
+    if isinstance(expected, dict):
+        if not isinstance(actual, dict):
+            return False
+        if exact and set(expected) != set(actual):
+            return False
+        return all(key in actual and matches(value, actual[key], exact) for key, value in expected.items())
+    if isinstance(expected, list):
+        return isinstance(actual, list) and len(expected) == len(actual) and all(
+            matches(e, a, exact) for e, a in zip(expected, actual)
+        )
+    return expected == actual
+
+def run_test(module: Any, name: str, test: Dict[str, Any]) -> Tuple[bool, str]:
+    body = test.get('body')
+    event = build_event(
+        test.get('method', 'GET'),
+        test.get('path', '/'),
+        test.get('headers', {}),
+        json.dumps(body).encode() if body is not None else b''
+    )
+    response = invoke(module, name, event)
+    status = response.get('statusCode')
+    raw = response_bytes(response)
+    
+    if status != test.get('expectedStatus', 200):
+        return False, f"status {status} != {test.get('expectedStatus')}: {raw[:200]!r}"
+    
+    if 'expectedBody' in test:
+        try:
+            actual = json.loads(raw)
+        except ValueError:
+            return False, f'body is not JSON: {raw[:200]!r}'
+        if not matches(test['expectedBody'], actual, test.get('bodyMatcher') == 'exact'):
+            return False, f'body mismatch: {raw[:200]!r}'
+    
+    return True, f'status {status}'
+
+def seed_database(functions: Dict[str, Any]):
+    '''
+    Makes the fixed accounts used by tests.json match what the tests expect:
+    test@example.com exists with the documented password, newuser@example.com does not.
+    '''
+    import psycopg2
+    
+    # The user row is on one of the shards and the directory entry in DATABASE_URL; clearing every database covers both.
+    for database_url in database_urls():
+        conn = psycopg2.connect(database_url)
+        cur = conn.cursor()
+        cur.execute("DELETE FROM auth_sessions WHERE user_id IN (SELECT id FROM user_directory WHERE email = %s)", ('newuser@example.com',))
+        cur.execute("UPDATE user_activity_log SET user_id = NULL WHERE user_id IN (SELECT id FROM users WHERE email = %s)", ('newuser@example.com',))
+        cur.execute("DELETE FROM users WHERE email = %s", ('newuser@example.com',))
+        cur.execute("DELETE FROM user_directory WHERE email = %s", ('newuser@example.com',))
+        conn.commit()
+        cur.close()
+        conn.close()
+    
+    if 'auth' in functions:
+        invoke(functions['auth'], 'auth', build_event('POST', '/?action=register', {}, json.dumps({
+            'email': 'test@example.com',
+            'password': 'testpassword123',
+            'first_name': 'Test',
+            'last_name': 'User'
+        }).encode()))
+
+def database_urls() -> List[str]:
+    urls = [os.environ['DATABASE_URL']]
+    for url in os.environ.get('DATABASE_SHARD_URLS', '').split(','):
+        if url and url not in urls:
+            urls.append(url)
+    return urls
+
+def shard_databases(database_url: str, count: int) -> List[str]:
+    '''database_url and count - 1 sibling databases, created and migrated when missing.'''
+    import psycopg2
+    
+    parts = urlsplit(database_url)
+    name = parts.path.lstrip('/')
+    urls = [database_url]
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    cur = conn.cursor()
+    for number in range(1, count):
+        shard_name = f'{name}_shard{number}'
+        cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (shard_name,))
+        if not cur.fetchone():
+            cur.execute(f"CREATE DATABASE {shard_name} ENCODING 'UTF8' TEMPLATE template0")
+        urls.append(urlunsplit((parts.scheme, parts.netloc, f'/{shard_name}', parts.query, parts.fragment)))
+    cur.close()
+    conn.close()
+    
+    for url in urls:
+        apply_migrations(url)
+    return urls
+
+def command_test(args: argparse.Namespace) -> int:
+    functions = load_functions(args.functions or None)
+    if args.seed:
+        seed_database(functions)
+    
+    failures = 0
+    for name, module in functions.items():
+        for test in load_tests(name):
+            try:
+                passed, detail = run_test(module, name, test)
+            except Exception as error:
+                passed, detail = False, f'raised {error!r}'
+            failures += 0 if passed else 1
+            print(f"{'ok  ' if passed else 'FAIL'} {name}: {test.get('name', '')} ({detail})")
+    
+    print(f'{failures} failure(s)')
+    return 1 if failures else 0
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+class LoadClient:
+    def __init__(self, port: int):
+        self.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    
+    def request(self, method: str, path: str, body: Optional[Dict[str, Any]] = None, token: str = '') -> Tuple[int, Dict[str, Any]]:
+        headers = {'Content-Type': 'application/json'}
+        if token:
+            headers['X-Auth-Token'] = token
+        payload = json.dumps(body).encode() if body is not None else None
+        try:
+            self.connection.request(method, path, body=payload, headers=headers)
+            response = self.connection.getresponse()
+            raw = response.read()
+        except (http.client.HTTPException, OSError):
+            self.connection.close()
+            raise
+        try:
+            return response.status, json.loads(raw or b'{}')
+        except ValueError:
+            return response.status, {}
+
+def auth_scenario(client: LoadClient, record, stop: threading.Event):
+    '''One virtual user: register once, then alternate login and profile reads.'''
+    email = f'load-{uuid.uuid4().hex[:12]}@example.com'
+    password = 'loadtest-password'
+    
+    status, body = record('auth:POST register', client.request, 'POST', '/auth?action=register', {
+        'email': email, 'password': password, 'first_name': 'Load', 'last_name': 'Test'
+    })
+    token = body.get('token', '')
+    
+    while not stop.is_set():
+        status, body = record('auth:POST login', client.request, 'POST', '/auth?action=login', {
+            'email': email, 'password': password
+        })
+        token = body.get('token', token)
+        for _ in range(4):
+            if stop.is_set():
+                break
+            record('auth:GET profile', client.request, 'GET', '/auth?action=profile', None, token)
+        record('two-factor:GET status', client.request, 'GET', '/two-factor?action=status', None, token)
+
+def tests_scenario(client: LoadClient, record, stop: threading.Event):
+    '''Replays every tests.json entry in a loop (register tests will mostly return 400 after the first run).'''
+    cases = []
+    for name in discover_functions():
+        for test in load_tests(name):
+            cases.append((name, test))
+    
+    while not stop.is_set():
+        for name, test in cases:
+            if stop.is_set():
+                break
+            path = test.get('path', '/')
+            query = path.split('?', 1)[1] if '?' in path else ''
+            action = dict(pair.split('=', 1) for pair in query.split('&') if '=' in pair).get('action', '')
+            label = f"{name}:{test.get('method', 'GET')} {action}".rstrip()
+            record(label, client.request, test.get('method', 'GET'), f'/{name}{path if path.startswith("/") else "/" + path}', test.get('body'))
+
+def command_load(args: argparse.Namespace) -> int:
+    functions = load_functions()
+    os.environ['DEVSERVER_QUIET'] = '1'
+    if args.server == 'asyncio':
+        import aioserver
+        async_server, port, loop = aioserver.start_in_thread(functions, 0, args.threads)
+    else:
+        server = start_server(functions, 0)
+        port = server.server_address[1]
+    
+    latencies: Dict[str, List[float]] = defaultdict(list)
+    errors: Dict[str, int] = defaultdict(int)
+    lock = threading.Lock()
+    stop = threading.Event()
+    scenario = auth_scenario if args.scenario == 'auth' else tests_scenario
+    
+    def record(label: str, call, *call_args):
+        started = time.perf_counter()
+        try:
+            status, body = call(*call_args)
+        except Exception:
+            status, body = 0, {}
+        elapsed = (time.perf_counter() - started) * 1000
+        with lock:
+            latencies[label].append(elapsed)
+            if status == 0 or status >= 500:
+                errors[label] += 1
+        return status, body
+    
+    def worker():
+        client = LoadClient(port)
+        while not stop.is_set():
+            try:
+                scenario(client, record, stop)
+            except Exception:
+                client = LoadClient(port)
+    
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(args.concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=30)
+    elapsed = time.perf_counter() - started
+    if args.server == 'asyncio':
+        aioserver.stop_in_thread(async_server, loop)
+    else:
+        server.shutdown()
+    
+    report = {
+        'scenario': args.scenario,
+        'server': args.server,
+        'concurrency': args.concurrency,
+        'duration_s': round(elapsed, 2),
+        'actions': {}
+    }
+    print(f"{'action':32} {'count':>8} {'rps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for label in sorted(latencies):
+        values = sorted(latencies[label])
+        stats = {
+            'count': len(values),
+            'rps': round(len(values) / elapsed, 1),
+            'p50_ms': round(percentile(values, 0.50), 2),
+            'p95_ms': round(percentile(values, 0.95), 2),
+            'p99_ms': round(percentile(values, 0.99), 2),
+            'errors': errors[label]
+        }
+        report['actions'][label] = stats
+        print(f"{label:32} {stats['count']:>8} {stats['rps']:>9} {stats['p50_ms']:>9} {stats['p95_ms']:>9} {stats['p99_ms']:>9} {stats['errors']:>7}")
+    
+    total = sum(len(values) for values in latencies.values())
+    print(f'total {total} requests, {total / elapsed:.1f} req/s')
+    
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    
+    return 0
+
+def command_serve(args: argparse.Namespace) -> int:
+    functions = load_functions()
+    server = ThreadingHTTPServer((args.host, args.port), make_request_handler(functions))
+    server.daemon_threads = True
+    print(f"Serving {', '.join(functions)} on http://{args.host}:{args.port}/<function>")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--migrate', action='store_true', help='apply pending db_migrations to DATABASE_URL first')
+    parser.add_argument('--openai-stub', action='store_true', help='point the chat function at tools/openai_stub.py')
+    parser.add_argument('--shards', type=int, default=0, help='shard the users over this many local databases')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    serve = commands.add_parser('serve')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    
+    test = commands.add_parser('test')
+    test.add_argument('functions', nargs='*')
+    test.add_argument('--seed', action='store_true', help='create/remove the fixed accounts tests.json relies on')
+    
+    load = commands.add_parser('load')
+    load.add_argument('--duration', type=float, default=10)
+    load.add_argument('--concurrency', type=int, default=16)
+    load.add_argument('--scenario', choices=['auth', 'tests'], default='auth')
+    load.add_argument('--server', choices=['threaded', 'asyncio'], default='threaded')
+    load.add_argument('--threads', type=int, default=32, help='handler pool size for --server asyncio')
+    load.add_argument('--output', help='write the report as JSON')
+    
+    args = parser.parse_args()
+    
+    if args.migrate:
+        applied = apply_migrations(os.environ['DATABASE_URL'])
+        print(f'applied {applied} migration file(s)')
+    
+    if args.shards > 1:
+        # Before the functions are loaded: db.py reads DATABASE_SHARD_URLS at import.
+        os.environ['DATABASE_SHARD_URLS'] = ','.join(shard_databases(os.environ['DATABASE_URL'], args.shards))
+    
+    # Links in the emails auth sends point at the Vite dev server unless configured.
+    os.environ.setdefault('APP_URL', 'http://localhost:5173')
+    
+    if args.openai_stub:
+        import openai_stub
+        stub = openai_stub.start_stub(0)
+        os.environ['OPENAI_API_KEY'] = os.environ.get('OPENAI_API_KEY') or 'stub'
+        os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{stub.server_address[1]}/v1'
+    
+    return {'serve': command_serve, 'test': command_test, 'load': command_load}[args.command](args)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+'''
+Helpers for running the cloud functions in backend/ locally: discovery, isolated
+loading of each function directory and conversion between HTTP requests and
+the platform's event/response dicts.
+'''
+import base64
+import importlib.util
+import json
+import os
+import sys
+import uuid
+from types import ModuleType, SimpleNamespace
+from typing import Dict, Any, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+BACKEND_DIR = os.path.join(ROOT_DIR, 'backend')
+MIGRATIONS_DIR = os.path.join(ROOT_DIR, 'db_migrations')
+
+# The functions refuse to issue or accept tokens without key material; local
+# runs get a throwaway HMAC key unless one is configured.
+os.environ.setdefault('JWT_SECRET_KEY', 'local-development-only')
+
+def discover_functions() -> List[str]:
+    '''
+    Function names from func2url.json first (deployed names), then any other
+    backend/<name>/index.py that has not been deployed yet (e.g. chat).
+    '''
+    names: List[str] = []
+    func2url = os.path.join(BACKEND_DIR, 'func2url.json')
+    if os.path.exists(func2url):
+        with open(func2url) as f:
+            names.extend(json.load(f).keys())
+    
+    for entry in sorted(os.listdir(BACKEND_DIR)):
+        if entry not in names and os.path.exists(os.path.join(BACKEND_DIR, entry, 'index.py')):
+            names.append(entry)
+    
+    return [name for name in names if os.path.exists(os.path.join(BACKEND_DIR, name, 'index.py'))]
+
+def load_function(name: str) -> ModuleType:
+    '''
+    Imports backend/<name>/index.py the way the platform does (function directory
+    first on sys.path) without letting sibling modules with the same file name in
+    other function directories shadow each other.
+    '''
+    directory = os.path.join(BACKEND_DIR, name)
+    local_modules = {entry[:-3] for entry in os.listdir(directory) if entry.endswith('.py') and entry != 'index.py'}
+    saved = {module: sys.modules.pop(module) for module in local_modules if module in sys.modules}
+    
+    spec = importlib.util.spec_from_file_location(f'function_{name.replace("-", "_")}', os.path.join(directory, 'index.py'))
+    module = importlib.util.module_from_spec(spec)
+    
+    sys.path.insert(0, directory)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(directory)
+        module.local_modules = {local: sys.modules.pop(local) for local in local_modules if local in sys.modules}
+        sys.modules.update(saved)
+    
+    return module
+
+def load_functions(names: Optional[List[str]] = None) -> Dict[str, ModuleType]:
+    '''
+    Loads the given (default: all) functions; one that fails to import, e.g. chat
+    without OPENAI_API_KEY, is reported and skipped instead of stopping the rest.
+    '''
+    functions: Dict[str, ModuleType] = {}
+    for name in names or discover_functions():
+        try:
+            functions[name] = load_function(name)
+        except Exception as error:
+            print(f'skipping {name}: {error}', file=sys.stderr)
+    return functions
+
+def load_tests(name: str) -> List[Dict[str, Any]]:
+    path = os.path.join(BACKEND_DIR, name, 'tests.json')
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f).get('tests', [])
+
+def build_event(
+    method: str,
+    target: str,
+    headers: Optional[Dict[str, str]] = None,
+    body: Optional[bytes] = None,
+    source_ip: str = '127.0.0.1'
+) -> Dict[str, Any]:
+    '''
+    Builds the platform event for a request; target is the path with query string
+    relative to the function root (e.g. "/?action=login").
+    '''
+    parts = urlsplit(target)
+    raw_body = body or b''
+    
+    try:
+        text_body = raw_body.decode('utf-8')
+        is_base64 = False
+    except UnicodeDecodeError:
+        text_body = base64.b64encode(raw_body).decode()
+        is_base64 = True
+    
+    return {
+        'httpMethod': method.upper(),
+        'path': parts.path or '/',
+        'headers': {key.lower(): value for key, value in (headers or {}).items()},
+        'queryStringParameters': dict(parse_qsl(parts.query, keep_blank_values=True)),
+        'body': text_body,
+        'isBase64Encoded': is_base64,
+        'requestContext': {
+            'requestId': str(uuid.uuid4()),
+            'identity': {'sourceIp': source_ip}
+        }
+    }
+
+def make_context(name: str, event: Dict[str, Any]) -> SimpleNamespace:
+    return SimpleNamespace(
+        request_id=event.get('requestContext', {}).get('requestId', str(uuid.uuid4())),
+        function_name=name
+    )
+
+def invoke(module: ModuleType, name: str, event: Dict[str, Any]) -> Dict[str, Any]:
+    return module.handler(event, make_context(name, event))
+
+def response_bytes(response: Dict[str, Any]) -> bytes:
+    body = response.get('body') or ''
+    if isinstance(body, (dict, list)):
+        body = json.dumps(body)
+    if response.get('isBase64Encoded'):
+        return base64.b64decode(body)
+    return body.encode('utf-8')
+
+def apply_migrations(database_url: str) -> int:
+    '''
+    Applies the pending db_migrations/V*.sql files with tools/migrate.py. A
+    schema created before the runner (users table present, no
+    schema_migrations) is left alone until it is baselined. Returns the number
+    of files applied.
+    '''
+    import psycopg2
+    import migrate
+    
+    conn = psycopg2.connect(database_url)
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('public.users'), to_regclass('public.schema_migrations')")
+    users, history = cur.fetchone()
+    cur.close()
+    conn.close()
+    if users and not history:
+        print('schema predates tools/migrate.py; run "python tools/migrate.py baseline --version N" first', file=sys.stderr)
+        return 0
+    
+    return len({step['version'] for step in migrate.migrate(database_url)})
@@ -0,0 +1,51 @@
+'''
+Generates a JWT signing key for backend/*/jwt_keys.py.
+
+  python tools/jwt_keygen.py --alg EdDSA --kid 2026-10 --out jwt-2026-10.pem
+
+Writes the private key (JWT_SIGNING_KEY for auth and oauth) and prints the
+public JWK. Add the JWK to the JWKS document (JWT_JWKS) the verifiers read
+before switching JWT_SIGNING_KID to the new key.
+'''
+import argparse
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'auth'))
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+
+from jwt_keys import private_key_signer
+
+def generate_pem(alg: str) -> str:
+    if alg == 'EdDSA':
+        private_key = ed25519.Ed25519PrivateKey.generate()
+    else:
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    return private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.PKCS8,
+        serialization.NoEncryption()
+    ).decode()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--alg', choices=['EdDSA', 'RS256'], default='EdDSA')
+    parser.add_argument('--kid', required=True, help='key id put in the token header')
+    parser.add_argument('--out', help='write the private key here instead of stdout')
+    args = parser.parse_args()
+    
+    pem = generate_pem(args.alg)
+    if args.out:
+        with open(os.open(args.out, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+            f.write(pem)
+    else:
+        print(pem)
+    
+    print(json.dumps(private_key_signer(pem, args.kid).public_jwk, indent=2))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
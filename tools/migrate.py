@@ -0,0 +1,466 @@
+'''
+Applies db_migrations/V<version>__<description>.sql to DATABASE_URL and to every
+database in DATABASE_SHARD_URLS (each shard carries the full schema), and
+records each applied version in that database's schema_migrations.
+
+  python tools/migrate.py status
+  python tools/migrate.py migrate [--target 6] [--dry-run]
+  python tools/migrate.py baseline --version 5      # schema created before the runner
+
+The files stay plain SQL that Flyway can run as written. The runner only
+changes how some statements are executed, so that large tables stay writable:
+
+  CREATE INDEX / DROP INDEX run CONCURRENTLY in autocommit, outside the
+  migration's transaction. An invalid index left by an interrupted concurrent
+  build is dropped and built again.
+  
+  An UPDATE preceded by a "-- migrate:batch key=id size=5000 sleep=0.05"
+  comment runs in key ranges of size rows, one transaction per range, sleeping
+  between ranges.
+  
+  ALTER TABLE ... VALIDATE CONSTRAINT runs in a transaction of its own, so
+  the scan it does holds only its SHARE UPDATE EXCLUSIVE lock and not the
+  ACCESS EXCLUSIVE lock of the ADD CONSTRAINT ... NOT VALID before it.
+  
+  Everything else runs in one transaction per group of consecutive statements
+  with lock_timeout (MIGRATE_LOCK_TIMEOUT), so DDL waiting for a lock gives up
+  instead of queueing every login behind it; the group is retried
+  MIGRATE_LOCK_RETRIES times.
+
+Steps outside a transaction are not undone when a later step fails, so
+migrations must be re-runnable (IF NOT EXISTS). Each step is printed with its
+duration.
+'''
+import argparse
+import hashlib
+import os
+import re
+import sys
+import time
+from typing import Dict, Any, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from functions import MIGRATIONS_DIR
+
+LOCK_TIMEOUT = os.environ.get('MIGRATE_LOCK_TIMEOUT', '5s')
+LOCK_RETRIES = int(os.environ.get('MIGRATE_LOCK_RETRIES', '5'))
+ADVISORY_LOCK_ID = 7_301_955  # any constant shared by all runners
+
+FILE_PATTERN = re.compile(r'^V(\d+)__(\w+)\.sql$')
+BATCH_DIRECTIVE = re.compile(r'^\s*--\s*migrate:batch\b(.*)$', re.M)
+CREATE_INDEX = re.compile(r'^\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+(CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?(?:([\w."]+)\s+)?ON\b', re.I)
+DROP_INDEX = re.compile(r'^\s*DROP\s+INDEX\s+(?!CONCURRENTLY\b)(?:IF\s+EXISTS\s+)?[\w."]+\s*$', re.I)
+NON_TRANSACTIONAL = re.compile(r'^\s*(DROP\s+INDEX\s+CONCURRENTLY|REINDEX\b.*\bCONCURRENTLY|VACUUM)\b', re.I | re.S)
+VALIDATE_CONSTRAINT = re.compile(r'^\s*ALTER\s+TABLE\s+(?:IF\s+EXISTS\s+)?(?:ONLY\s+)?[\w."]+\s+VALIDATE\s+CONSTRAINT\b', re.I)
+UPDATE_TABLE = re.compile(r'^\s*UPDATE\s+(?:ONLY\s+)?([\w."]+)', re.I)
+
+SCHEMA_MIGRATIONS = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    description VARCHAR(200) NOT NULL,
+    checksum VARCHAR(64) NOT NULL,
+    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    duration_ms INTEGER
+)
+"""
+
+class Migration:
+    def __init__(self, version: int, description: str, path: str):
+        self.version = version
+        self.description = description
+        self.path = path
+        with open(path) as f:
+            self.sql = f.read()
+        self.checksum = hashlib.sha256(self.sql.encode()).hexdigest()
+    
+    @property
+    def label(self) -> str:
+        return f'V{self.version:04d}'
+
+class Step:
+    '''kind is "transaction" (statements run together), "validate", "concurrent" or "batch" (one statement).'''
+    def __init__(self, kind: str, statements: List[str], options: Optional[Dict[str, str]] = None):
+        self.kind = kind
+        self.statements = statements
+        self.options = options or {}
+    
+    @property
+    def summary(self) -> str:
+        first = ' '.join(strip_comments(self.statements[0]).split())
+        more = f' (+{len(self.statements) - 1} more)' if len(self.statements) > 1 else ''
+        return f'{first[:80]}{more}'
+
+def mask(sql: str) -> str:
+    '''
+    sql with the same length where comments, quoted strings, dollar-quoted bodies
+    and everything inside parentheses are blanked, so keywords and semicolons
+    found in the result are at the top level of a statement.
+    '''
+    out = list(sql)
+    i, depth, length = 0, 0, len(sql)
+    
+    def blank(start: int, end: int):
+        for j in range(start, end):
+            if out[j] != '\n':
+                out[j] = ' '
+    
+    while i < length:
+        char = sql[i]
+        if sql.startswith('--', i):
+            end = sql.find('\n', i)
+            end = length if end == -1 else end
+            blank(i, end)
+            i = end
+        elif sql.startswith('/*', i):
+            nesting, j = 1, i + 2
+            while j < length and nesting:
+                if sql.startswith('/*', j):
+                    nesting, j = nesting + 1, j + 2
+                elif sql.startswith('*/', j):
+                    nesting, j = nesting - 1, j + 2
+                else:
+                    j += 1
+            blank(i, j)
+            i = j
+        elif char == "'":
+            # E'...' strings treat backslash as an escape; '' is an escaped quote in both.
+            backslash = i > 0 and sql[i - 1] in 'eE' and (i < 2 or not (sql[i - 2].isalnum() or sql[i - 2] == '_'))
+            j = i + 1
+            while j < length:
+                if backslash and sql[j] == '\\':
+                    j += 2
+                    continue
+                if sql[j] == "'":
+                    if sql.startswith("''", j):
+                        j += 2
+                        continue
+                    break
+                j += 1
+            blank(i, j + 1)
+            i = j + 1
+        elif char == '"':
+            end = sql.find('"', i + 1)
+            end = length - 1 if end == -1 else end
+            if depth:
+                blank(i, end + 1)
+            i = end + 1
+        elif char == '$' and (i == 0 or not (sql[i - 1].isalnum() or sql[i - 1] == '_')):
+            match = re.match(r'\$([A-Za-z_][A-Za-z_0-9]*)?\$', sql[i:])
+            if match is None:
+                i += 1
+                continue
+            tag = match.group(0)
+            end = sql.find(tag, i + len(tag))
+            end = length if end == -1 else end + len(tag)
+            blank(i, end)
+            i = end
+        elif char == '(':
+            depth += 1
+            i += 1
+        elif char == ')':
+            depth = max(depth - 1, 0)
+            i += 1
+        else:
+            if depth:
+                blank(i, i + 1)
+            i += 1
+    
+    return ''.join(out)
+
+def strip_comments(statement: str) -> str:
+    return '\n'.join(line for line in statement.splitlines() if not line.lstrip().startswith('--')).strip()
+
+def split_statements(sql: str) -> List[str]:
+    '''Splits a file on top-level semicolons; comments stay with the statement that follows them.'''
+    masked = mask(sql)
+    statements: List[str] = []
+    start = 0
+    for index, char in enumerate(masked):
+        if char == ';':
+            statements.append(sql[start:index])
+            start = index + 1
+    statements.append(sql[start:])
+    return [statement.strip() for statement in statements if mask(statement).strip()]
+
+def parse_options(text: str) -> Dict[str, str]:
+    return dict(pair.split('=', 1) for pair in text.split() if '=' in pair)
+
+def plan_statement(statement: str) -> Tuple[str, str, Dict[str, str]]:
+    '''Returns (kind, sql to run, options) for one statement.'''
+    masked = mask(statement)
+    directive = BATCH_DIRECTIVE.search(statement)
+    if directive is not None:
+        if not UPDATE_TABLE.match(masked):
+            raise ValueError(f'migrate:batch only applies to UPDATE statements: {statement[:80]}')
+        if re.search(r'\bRETURNING\b', masked, re.I):
+            raise ValueError('migrate:batch UPDATE cannot use RETURNING')
+        return 'batch', statement, parse_options(directive.group(1))
+    
+    create = CREATE_INDEX.match(masked)
+    if create is not None or DROP_INDEX.match(masked):
+        options = {'index': create.group(2)} if create is not None and create.group(2) else {}
+        if create is not None and create.group(1):
+            return 'concurrent', statement, options
+        position = re.search(r'\bINDEX\b', masked, re.I).end()
+        return 'concurrent', f'{statement[:position]} CONCURRENTLY{statement[position:]}', options
+    
+    if NON_TRANSACTIONAL.match(masked):
+        return 'concurrent', statement, {}
+    
+    if VALIDATE_CONSTRAINT.match(masked):
+        return 'validate', statement, {}
+    
+    return 'transaction', statement, {}
+
+def plan(migration: Migration) -> List[Step]:
+    steps: List[Step] = []
+    for statement in split_statements(migration.sql):
+        kind, sql, options = plan_statement(statement)
+        if kind == 'transaction' and steps and steps[-1].kind == 'transaction':
+            steps[-1].statements.append(sql)
+        else:
+            steps.append(Step(kind, [sql], options))
+    return steps
+
+def discover_migrations() -> List[Migration]:
+    migrations = []
+    for entry in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = FILE_PATTERN.match(entry)
+        if match is not None:
+            migrations.append(Migration(int(match.group(1)), match.group(2).replace('_', ' '), os.path.join(MIGRATIONS_DIR, entry)))
+    migrations.sort(key=lambda migration: migration.version)
+    return migrations
+
+def applied_versions(cur: Any) -> Dict[int, str]:
+    cur.execute("SELECT to_regclass('public.schema_migrations')")
+    if not cur.fetchone()[0]:
+        return {}
+    cur.execute("SELECT version, checksum FROM schema_migrations")
+    return dict(cur.fetchall())
+
+def run_transaction(conn: Any, step: Step) -> int:
+    import psycopg2
+    
+    cur = conn.cursor()
+    for attempt in range(LOCK_RETRIES + 1):
+        try:
+            # The connection is in autocommit mode for the concurrent steps.
+            cur.execute("BEGIN")
+            cur.execute("SELECT set_config('lock_timeout', %s, true)", (LOCK_TIMEOUT,))
+            rows = 0
+            for statement in step.statements:
+                cur.execute(statement)
+                rows += max(cur.rowcount, 0)
+            cur.execute("COMMIT")
+            cur.close()
+            return rows
+        except psycopg2.Error as exc:
+            cur.execute("ROLLBACK")
+            if not isinstance(exc, psycopg2.errors.LockNotAvailable) or attempt == LOCK_RETRIES:
+                raise
+            delay = min(2 ** attempt, 30)
+            print(f'  lock not available within {LOCK_TIMEOUT}, retrying in {delay}s', file=sys.stderr)
+            time.sleep(delay)
+    return 0
+
+def run_concurrent(conn: Any, step: Step) -> int:
+    cur = conn.cursor()
+    index = step.options.get('index')
+    if index:
+        cur.execute(
+            "SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+            (index.replace('"', ''),)
+        )
+        row = cur.fetchone()
+        if row and row[0]:
+            print(f'  dropping invalid index {index} left by an earlier build', file=sys.stderr)
+            cur.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {index}')
+    cur.execute(step.statements[0])
+    cur.close()
+    return 0
+
+def run_batch(conn: Any, step: Step) -> int:
+    '''Runs the UPDATE once per [low, low + size) range of the key column.'''
+    statement = step.statements[0]
+    key = step.options.get('key', 'id')
+    size = int(step.options.get('size', '5000'))
+    sleep = float(step.options.get('sleep', '0.05'))
+    
+    masked = mask(statement)
+    table = UPDATE_TABLE.match(masked).group(1)
+    where = re.search(r'\bWHERE\b', masked, re.I)
+    if where is None:
+        ranged = f"{statement.replace('%', '%%')}\nWHERE {key} >= %s AND {key} < %s"
+    else:
+        head = statement[:where.start()].replace('%', '%%')
+        condition = statement[where.end():].replace('%', '%%')
+        ranged = f'{head}WHERE ({condition}\n) AND {key} >= %s AND {key} < %s'
+    
+    cur = conn.cursor()
+    cur.execute(f'SELECT MIN({key}), MAX({key}) FROM {table}')
+    low, high = cur.fetchone()
+    rows = batches = 0
+    while low is not None and low <= high:
+        cur.execute(ranged, (low, low + size))
+        rows += cur.rowcount
+        batches += 1
+        low += size
+        if sleep and low <= high:
+            time.sleep(sleep)
+    cur.close()
+    print(f'  {batches} batch(es) of up to {size} {key} values', file=sys.stderr)
+    return rows
+
+RUNNERS = {'transaction': run_transaction, 'validate': run_transaction, 'concurrent': run_concurrent, 'batch': run_batch}
+
+def apply_migration(conn: Any, migration: Migration, dry_run: bool = False) -> List[Dict[str, Any]]:
+    steps = plan(migration)
+    report: List[Dict[str, Any]] = []
+    started = time.perf_counter()
+    for number, step in enumerate(steps, 1):
+        print(f'{migration.label} step {number}/{len(steps)} {step.kind:11} {step.summary}')
+        if dry_run:
+            for statement in step.statements:
+                print('    ' + strip_comments(statement).replace('\n', '\n    ') + ';')
+            continue
+        
+        step_started = time.perf_counter()
+        rows = RUNNERS[step.kind](conn, step)
+        elapsed_ms = (time.perf_counter() - step_started) * 1000
+        print(f'  {elapsed_ms:.1f} ms, {rows} row(s)')
+        report.append({'version': migration.version, 'step': number, 'kind': step.kind, 'summary': step.summary, 'ms': round(elapsed_ms, 1), 'rows': rows})
+    
+    if not dry_run:
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO schema_migrations (version, description, checksum, duration_ms) VALUES (%s, %s, %s, %s)",
+            (migration.version, migration.description, migration.checksum, int((time.perf_counter() - started) * 1000))
+        )
+        cur.close()
+    return report
+
+def connect(database_url: str) -> Any:
+    import psycopg2
+    
+    conn = psycopg2.connect(database_url)
+    conn.autocommit = True
+    return conn
+
+def migrate(database_url: str, target: Optional[int] = None, dry_run: bool = False) -> List[Dict[str, Any]]:
+    '''Applies pending migrations up to target in version order; returns the per-step report.'''
+    conn = connect(database_url)
+    cur = conn.cursor()
+    # One runner at a time; a second one waits here and then finds nothing pending.
+    cur.execute("SELECT pg_advisory_lock(%s)", (ADVISORY_LOCK_ID,))
+    try:
+        if not dry_run:
+            cur.execute(SCHEMA_MIGRATIONS)
+        applied = applied_versions(cur)
+        report: List[Dict[str, Any]] = []
+        for migration in discover_migrations():
+            if migration.version in applied or (target is not None and migration.version > target):
+                continue
+            report.extend(apply_migration(conn, migration, dry_run))
+        return report
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (ADVISORY_LOCK_ID,))
+        cur.close()
+        conn.close()
+
+def baseline(database_url: str, version: int) -> int:
+    '''Marks every migration up to version as applied without running it.'''
+    conn = connect(database_url)
+    cur = conn.cursor()
+    cur.execute(SCHEMA_MIGRATIONS)
+    marked = 0
+    for migration in discover_migrations():
+        if migration.version <= version:
+            cur.execute(
+                "INSERT INTO schema_migrations (version, description, checksum) VALUES (%s, %s, %s) ON CONFLICT (version) DO NOTHING",
+                (migration.version, migration.description, migration.checksum)
+            )
+            marked += cur.rowcount
+    cur.close()
+    conn.close()
+    return marked
+
+def database_urls(database_url: str, shards: bool = True) -> List[str]:
+    '''database_url, then the DATABASE_SHARD_URLS entries other than it.'''
+    urls = [database_url]
+    if shards:
+        for url in os.environ.get('DATABASE_SHARD_URLS', '').split(','):
+            if url.strip() and url.strip() not in urls:
+                urls.append(url.strip())
+    return urls
+
+def describe(database_url: str) -> str:
+    '''host/database without the credentials.'''
+    parts = urlsplit(database_url)
+    return f"{parts.hostname or 'localhost'}{parts.path}"
+
+def command_status(args: argparse.Namespace) -> int:
+    urls = database_urls(args.database_url, not args.no_shards)
+    for database_url in urls:
+        if len(urls) > 1:
+            print(f'== {describe(database_url)}')
+        conn = connect(database_url)
+        cur = conn.cursor()
+        applied = applied_versions(cur)
+        cur.close()
+        conn.close()
+        
+        for migration in discover_migrations():
+            checksum = applied.get(migration.version)
+            if checksum is None:
+                state = 'pending'
+            else:
+                state = 'applied' if checksum == migration.checksum else 'applied (file changed since)'
+            print(f'{migration.label}  {migration.description:40} {state}')
+    return 0
+
+def command_migrate(args: argparse.Namespace) -> int:
+    urls = database_urls(args.database_url, not args.no_shards)
+    for database_url in urls:
+        if len(urls) > 1:
+            print(f'== {describe(database_url)}')
+        report = migrate(database_url, args.target, args.dry_run)
+        if args.dry_run:
+            continue
+        if not report:
+            print('nothing to apply')
+            continue
+        
+        print(f"\n{'version':8} {'step':>4} {'kind':11} {'ms':>10} {'rows':>10}  statement")
+        for entry in report:
+            print(f"V{entry['version']:04d}    {entry['step']:>4} {entry['kind']:11} {entry['ms']:>10.1f} {entry['rows']:>10}  {entry['summary']}")
+        print(f"total {sum(entry['ms'] for entry in report):.1f} ms")
+    return 0
+
+def command_baseline(args: argparse.Namespace) -> int:
+    for database_url in database_urls(args.database_url, not args.no_shards):
+        print(f'{describe(database_url)}: marked {baseline(database_url, args.version)} migration(s) as applied')
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'), help='defaults to DATABASE_URL')
+    parser.add_argument('--no-shards', action='store_true', help='leave the DATABASE_SHARD_URLS databases alone')
+    commands = parser.add_subparsers(dest='command', required=True)
+    
+    commands.add_parser('status')
+    
+    run = commands.add_parser('migrate')
+    run.add_argument('--target', type=int, help='stop after this version')
+    run.add_argument('--dry-run', action='store_true', help='print the steps without running them')
+    
+    mark = commands.add_parser('baseline')
+    mark.add_argument('--version', type=int, required=True, help='last version already present in the schema')
+    
+    args = parser.parse_args()
+    if not args.database_url:
+        parser.error('DATABASE_URL is not set')
+    
+    return {'status': command_status, 'migrate': command_migrate, 'baseline': command_baseline}[args.command](args)
+
+if __name__ == '__main__':
+    sys.exit(main())
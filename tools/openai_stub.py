@@ -0,0 +1,154 @@
+'''
+Local stand-in for the OpenAI chat completions API, used to exercise the chat
+function's timeout, retry and concurrency policy without a real API key.
+
+Usage: python tools/openai_stub.py            # run all scenarios against the chat handler
+       python tools/openai_stub.py --serve    # only serve the stub on --port
+'''
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List
+
+from functions import load_function
+
+# Mutable behaviour of the stub; scenarios change it between runs.
+behaviour: Dict[str, Any] = {
+    'delay': 0.05,
+    'fail_first': 0,
+    'status': 500
+}
+request_count = 0
+count_lock = threading.Lock()
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        global request_count
+        length = int(self.headers.get('Content-Length', '0'))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        
+        with count_lock:
+            request_count += 1
+            number = request_count
+        
+        time.sleep(behaviour['delay'])
+        
+        if number <= behaviour['fail_first']:
+            self.send_json(behaviour['status'], {'error': {'message': 'stub failure', 'type': 'server_error'}})
+            return
+        
+        self.send_json(200, {
+            'id': f'chatcmpl-stub-{number}',
+            'object': 'chat.completion',
+            'created': int(time.time()),
+            'model': request.get('model', 'gpt-4o-mini'),
+            'choices': [{
+                'index': 0,
+                'message': {'role': 'assistant', 'content': f'stub reply #{number}'},
+                'finish_reason': 'stop'
+            }],
+            'usage': {'prompt_tokens': 1, 'completion_tokens': 1, 'total_tokens': 2}
+        })
+    
+    def send_json(self, status: int, payload: Dict[str, Any]):
+        body = json.dumps(payload).encode()
+        try:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # The client already gave up (timeout scenarios).
+            pass
+    
+    def log_message(self, format: str, *args: Any):
+        pass
+
+def start_stub(port: int) -> ThreadingHTTPServer:
+    server = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def load_chat_function(port: int):
+    os.environ['OPENAI_API_KEY'] = 'stub'
+    os.environ['OPENAI_BASE_URL'] = f'http://127.0.0.1:{port}/v1'
+    os.environ.setdefault('CHAT_UPSTREAM_READ_TIMEOUT', '0.5')
+    os.environ.setdefault('CHAT_UPSTREAM_MAX_CONCURRENCY', '2')
+    
+    return load_function('chat')
+
+def run_requests(chat: Any, count: int) -> List[Dict[str, Any]]:
+    event = {
+        'httpMethod': 'POST',
+        'body': json.dumps({'messages': [{'role': 'user', 'content': 'Создай лендинг для кофейни'}]})
+    }
+    
+    def one(_: int) -> Dict[str, Any]:
+        started = time.perf_counter()
+        response = chat.handler(event, None)
+        body = json.loads(response['body'])
+        return {
+            'status': response['statusCode'],
+            'elapsed_ms': round((time.perf_counter() - started) * 1000, 1),
+            'upstream': body.get('context', {}).get('upstream_calls'),
+            'error': body.get('error')
+        }
+    
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        return list(pool.map(one, range(count)))
+
+def scenario(chat: Any, name: str, count: int, expected: List[int], **settings: Any) -> bool:
+    global request_count
+    behaviour.update({'delay': 0.05, 'fail_first': 0, 'status': 500})
+    behaviour.update(settings)
+    request_count = 0
+    
+    results = run_requests(chat, count)
+    statuses = sorted(result['status'] for result in results)
+    passed = statuses == sorted(expected)
+    
+    print(f"{'ok  ' if passed else 'FAIL'} {name}: statuses={statuses} expected={sorted(expected)}")
+    for result in results:
+        print(f"       {result}")
+    return passed
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--serve', action='store_true')
+    args = parser.parse_args()
+    
+    server = start_stub(args.port)
+    
+    if args.serve:
+        print(f'OpenAI stub listening on http://127.0.0.1:{args.port}/v1')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            server.shutdown()
+        return 0
+    
+    chat = load_chat_function(args.port)
+    chat.UPSTREAM_BACKOFF_BASE = 0.01
+    
+    results = [
+        scenario(chat, 'healthy upstream', 2, [200, 200]),
+        scenario(chat, 'transient 500 is retried', 1, [200], fail_first=1),
+        scenario(chat, 'rate limit is retried', 1, [200], fail_first=2, status=429),
+        scenario(chat, 'persistent 500 gives 502', 1, [502], fail_first=10),
+        scenario(chat, 'slow upstream gives 504', 1, [504], delay=1.0),
+        scenario(chat, 'saturation gives fast 503', 4, [200, 200, 503, 503], delay=0.3)
+    ]
+    
+    server.shutdown()
+    return 0 if all(results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
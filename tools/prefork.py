@@ -0,0 +1,253 @@
+'''
+Pre-fork supervisor: N worker processes serving every function on one port.
+
+  python tools/prefork.py [--port 8000] [--workers 4] [--threads 16]
+  kill -HUP <supervisor pid>     # reload: start new workers, drain the old ones
+  kill -USR1 <supervisor pid>    # print per-worker load now
+
+The supervisor binds the listening socket (SO_REUSEADDR and SO_REUSEPORT, so a
+new supervisor can bind next to a running one during an upgrade), imports every
+function (key rings, statement registry, OAuth provider registry), loads the
+JWKS, freezes the garbage collector's view of that heap and only then forks.
+Workers inherit the socket and the imported state copy-on-write; each one runs
+the tools/aioserver.py event loop and handler pool and opens its own database
+connections after the fork.
+
+Workers that crash are restarted, with backoff when they keep dying right after
+the start. SIGHUP re-imports the functions in the supervisor, forks a new
+generation and sends SIGTERM to the old one (a SIGHUP while a generation is
+still draining is refused: the slots hold two generations); on SIGTERM a worker stops
+accepting, closes idle keep-alive connections, finishes the requests in flight
+(up to --drain seconds) and exits. SIGTERM or SIGINT to the supervisor drains
+all workers and exits.
+
+Each worker publishes its pid, requests handled, requests in flight and a
+heartbeat in a shared memory slot; the supervisor prints the table every
+--report seconds and on SIGUSR1. /metrics on a worker only covers that worker.
+'''
+import argparse
+import asyncio
+import gc
+import mmap
+import os
+import signal
+import socket
+import struct
+import sys
+import time
+from typing import Dict, Any, List, Optional
+
+import aioserver
+from functions import load_functions
+
+# pid, generation, requests handled, requests in flight, heartbeat (unix time)
+SLOT = struct.Struct('<iiQQd')
+PUBLISH_SECONDS = 0.5
+FAST_CRASH_SECONDS = 2.0
+
+class Worker:
+    def __init__(self, pid: int, slot: int, generation: int):
+        self.pid = pid
+        self.slot = slot
+        self.generation = generation
+        self.started_at = time.monotonic()
+        self.stopping_since: Optional[float] = None
+
+def preload() -> Dict[str, Any]:
+    '''Imports every function and loads state that would otherwise be built per worker.'''
+    functions = load_functions()
+    for module in functions.values():
+        jwt_keys = getattr(module, 'local_modules', {}).get('jwt_keys')
+        if jwt_keys is not None and jwt_keys.JWKS_SOURCE:
+            jwt_keys.key_ring.reload(jwt_keys.key_ring.loaded_at)
+    gc.collect()
+    # Objects created so far are never scanned again, so collections in the
+    # workers do not write to (and un-share) the preloaded pages.
+    gc.freeze()
+    return functions
+
+def listen(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    sock.setblocking(False)
+    return sock
+
+def publish(memory: mmap.mmap, slot: int, generation: int, server: Optional[aioserver.FunctionServer]):
+    handled, in_flight = (server.handled, server.in_flight) if server is not None else (0, 0)
+    SLOT.pack_into(memory, slot * SLOT.size, os.getpid(), generation, handled, in_flight, time.time())
+
+async def worker_main(functions: Dict[str, Any], sock: socket.socket, args: argparse.Namespace, memory: mmap.mmap, slot: int, generation: int):
+    server = aioserver.FunctionServer(functions, args.threads)
+    await server.start(sock=sock)
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    
+    async def heartbeat():
+        while True:
+            publish(memory, slot, generation, server)
+            await asyncio.sleep(PUBLISH_SECONDS)
+    
+    task = asyncio.create_task(heartbeat())
+    await stop.wait()
+    if not await server.drain(args.drain):
+        print(f'worker {os.getpid()}: {server.in_flight} request(s) still running after {args.drain}s drain', file=sys.stderr)
+    task.cancel()
+    publish(memory, slot, generation, server)
+    await server.close()
+
+def run_worker(functions: Dict[str, Any], sock: socket.socket, args: argparse.Namespace, memory: mmap.mmap, slot: int, generation: int) -> int:
+    for signum in (signal.SIGHUP, signal.SIGUSR1):
+        signal.signal(signum, signal.SIG_DFL)
+    # Ctrl-C reaches the whole process group; the supervisor decides how workers stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    publish(memory, slot, generation, None)
+    try:
+        asyncio.run(worker_main(functions, sock, args, memory, slot, generation))
+    except Exception as error:
+        print(f'worker {os.getpid()} failed: {error!r}', file=sys.stderr)
+        return 1
+    return 0
+
+class Supervisor:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.sock = listen(args.host, args.port)
+        self.memory = mmap.mmap(-1, SLOT.size * args.workers * 2)
+        self.free_slots = list(range(args.workers * 2))
+        self.workers: Dict[int, Worker] = {}
+        self.generation = 0
+        self.functions: Dict[str, Any] = {}
+        self.signals: List[int] = []
+        self.stopping = False
+        self.fast_crashes = 0
+        self.last_report = (time.monotonic(), {})
+    
+    def spawn(self) -> bool:
+        '''Forks a worker of the current generation; False when every slot is taken.'''
+        if not self.free_slots:
+            print(f'no free worker slot ({len(self.workers)} workers running); not starting another', file=sys.stderr)
+            return False
+        slot = self.free_slots.pop(0)
+        SLOT.pack_into(self.memory, slot * SLOT.size, 0, self.generation, 0, 0, 0.0)
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = run_worker(self.functions, self.sock, self.args, self.memory, slot, self.generation)
+            finally:
+                os._exit(code)
+        self.workers[pid] = Worker(pid, slot, self.generation)
+        return True
+    
+    def start_generation(self):
+        self.functions = preload()
+        self.generation += 1
+        for _ in range(self.args.workers):
+            self.spawn()
+        print(f"generation {self.generation}: {self.args.workers} worker(s) serving {', '.join(self.functions)} on http://{self.args.host}:{self.sock.getsockname()[1]}/<function>")
+    
+    def retire(self, generation: Optional[int] = None):
+        '''Sends SIGTERM to the workers of older generations (all workers when generation is None).'''
+        now = time.monotonic()
+        for worker in self.workers.values():
+            if worker.stopping_since is None and (generation is None or worker.generation < generation):
+                worker.stopping_since = now
+                os.kill(worker.pid, signal.SIGTERM)
+    
+    def draining(self) -> int:
+        return sum(1 for worker in self.workers.values() if worker.stopping_since is not None)
+    
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            worker = self.workers.pop(pid, None)
+            if worker is None:
+                continue
+            self.free_slots.append(worker.slot)
+            if worker.stopping_since is not None or self.stopping:
+                continue
+            
+            if worker.generation != self.generation:
+                continue
+            lived = time.monotonic() - worker.started_at
+            print(f'worker {pid} (slot {worker.slot}) exited with status {os.waitstatus_to_exitcode(status)} after {lived:.1f}s; restarting', file=sys.stderr)
+            self.fast_crashes = self.fast_crashes + 1 if lived < FAST_CRASH_SECONDS else 0
+            if self.fast_crashes:
+                time.sleep(min(2 ** self.fast_crashes, 30))
+            self.spawn()
+    
+    def kill_overdue(self):
+        deadline = self.args.drain + 5
+        for worker in self.workers.values():
+            if worker.stopping_since is not None and time.monotonic() - worker.stopping_since > deadline:
+                os.kill(worker.pid, signal.SIGKILL)
+    
+    def report(self):
+        now = time.monotonic()
+        previous_at, previous = self.last_report
+        elapsed = max(now - previous_at, 1e-6)
+        current = {}
+        print(f"{'slot':>4} {'pid':>8} {'gen':>4} {'handled':>10} {'in flight':>10} {'req/s':>8} {'heartbeat':>10}")
+        for worker in sorted(self.workers.values(), key=lambda worker: worker.slot):
+            pid, generation, handled, in_flight, heartbeat = SLOT.unpack_from(self.memory, worker.slot * SLOT.size)
+            rate = (handled - previous.get(worker.pid, handled)) / elapsed
+            age = f'{time.time() - heartbeat:.1f}s ago' if heartbeat else 'starting'
+            state = ' draining' if worker.stopping_since is not None else ''
+            print(f'{worker.slot:>4} {worker.pid:>8} {generation:>4} {handled:>10} {in_flight:>10} {rate:>8.1f} {age:>10}{state}')
+            current[worker.pid] = handled
+        self.last_report = (now, current)
+    
+    def run(self) -> int:
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT, signal.SIGUSR1, signal.SIGCHLD):
+            signal.signal(signum, lambda received, frame: self.signals.append(received))
+        self.start_generation()
+        next_report = time.monotonic() + self.args.report if self.args.report else float('inf')
+        
+        while self.workers or not self.stopping:
+            while self.signals:
+                received = self.signals.pop(0)
+                if received == signal.SIGHUP and not self.stopping and self.draining():
+                    print(f'reload refused: {self.draining()} worker(s) of an older generation still draining', file=sys.stderr)
+                elif received == signal.SIGHUP and not self.stopping:
+                    print(f'reloading: starting generation {self.generation + 1}, draining {self.generation}')
+                    self.start_generation()
+                    self.retire(self.generation)
+                elif received in (signal.SIGTERM, signal.SIGINT) and not self.stopping:
+                    print(f'stopping: draining {len(self.workers)} worker(s)')
+                    self.stopping = True
+                    self.retire()
+                elif received == signal.SIGUSR1:
+                    self.report()
+            self.reap()
+            self.kill_overdue()
+            if time.monotonic() >= next_report:
+                self.report()
+                next_report = time.monotonic() + self.args.report
+            time.sleep(0.1)
+        
+        self.sock.close()
+        return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=16, help='handler threads per worker')
+    parser.add_argument('--drain', type=float, default=30, help='seconds a stopping worker waits for requests in flight')
+    parser.add_argument('--report', type=float, default=60, help='seconds between load reports (0 disables)')
+    args = parser.parse_args()
+    return Supervisor(args).run()
+
+if __name__ == '__main__':
+    sys.exit(main())
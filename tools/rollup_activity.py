@@ -0,0 +1,43 @@
+'''
+Folds new user_activity_log rows into the hourly/daily rollup tables.
+
+  python tools/rollup_activity.py                 # one catch-up run (cron: every minute)
+  python tools/rollup_activity.py --every 60      # keep running
+
+Uses the rollup() in backend/admin/activity.py against DATABASE_URL, or against
+each database in DATABASE_SHARD_URLS (every shard rolls up its own log); the
+admin function's POST ?action=rollup runs the same code.
+'''
+import argparse
+import os
+import sys
+import time
+
+from functions import load_function
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--every', type=float, default=0, help='repeat every N seconds (0 runs once)')
+    args = parser.parse_args()
+    
+    if not os.environ.get('DATABASE_URL'):
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 1
+    
+    admin = load_function('admin')
+    db = admin.local_modules['db']
+    activity = admin.local_modules['activity']
+    
+    while True:
+        started = time.perf_counter()
+        results = db.fan_out(activity.rollup, write=True)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        for shard, result in enumerate(results):
+            label = f'shard {shard}: ' if len(results) > 1 else ''
+            print(f"{label}{result['batches']} batch(es) in {elapsed_ms:.0f} ms; watermark id {result['last_id']} ({result['last_created_at']})")
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+if __name__ == '__main__':
+    sys.exit(main())
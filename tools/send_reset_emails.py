@@ -0,0 +1,40 @@
+'''
+Sends the queued password reset emails (password_reset_requests).
+
+  python tools/send_reset_emails.py               # one run (cron: every minute)
+  python tools/send_reset_emails.py --every 30    # keep running
+
+reset-password-request only queues a row and starts a delivery run on its own
+instance's thread. A run cut short because the platform froze or dropped that
+instance, or stopped by an SMTP failure, leaves the rows queued; this picks
+them up. Uses deliver_reset_requests() in backend/auth/index.py against
+DATABASE_URL, with the auth function's SMTP_* and APP_URL settings.
+'''
+import argparse
+import os
+import sys
+import time
+
+from functions import load_function
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--every', type=float, default=0, help='repeat every N seconds (0 runs once)')
+    args = parser.parse_args()
+    
+    if not os.environ.get('DATABASE_URL'):
+        print('DATABASE_URL is not set', file=sys.stderr)
+        return 1
+    
+    auth = load_function('auth')
+    
+    while True:
+        started = time.perf_counter()
+        sent = auth.deliver_reset_requests()
+        print(f'{sent} reset email(s) in {(time.perf_counter() - started) * 1000:.0f} ms')
+        if not args.every:
+            return 0
+        time.sleep(args.every)
+
+if __name__ == '__main__':
+    sys.exit(main())